@@ -0,0 +1,72 @@
+"""
+Alignment of reads with bowtie streamed straight into a sorted and indexed bam file.
+The SAM output of bowtie is piped into samtools sort so no intermediate SAM or unsorted
+bam files are written. The exit code of each stage is checked and the time spent in each
+stage is returned.
+run_pipeline runs any other chain of piped commands the same way.
+"""
+
+import subprocess
+import time
+from collections import OrderedDict
+from log_parsers import parse_bowtie_log
+
+
+def check_returncode(name, returncode):
+    if returncode != 0:
+        raise OSError(name + " exited with code " + str(returncode))
+
+
+def run_pipeline(commands):
+    #run the commands connected through pipes (the first command reads nothing, the last one writes its own output)
+    #and return the elapsed time in seconds
+    start = time.time()
+    processes = []
+    for command in commands:
+        stdin = processes[-1].stdout if processes else None
+        stdout = subprocess.PIPE if len(processes) < len(commands) - 1 else None
+        processes.append(subprocess.Popen(command, stdin=stdin, stdout=stdout))
+        if stdin is not None:
+            stdin.close()
+    returncodes = [p.wait() for p in processes]
+    for command, returncode in zip(commands, returncodes):
+        check_returncode(" ".join(command[:2]), returncode)
+    return time.time() - start
+
+
+def align_to_sorted_bam(index, fastq, sortedbam, bowtie_log, threads="1", mismatches="2", all_alignments=False):
+    #bowtie -S | samtools sort, then samtools index
+    #one alignment is reported per read (-k 1), or all of them (-a) when the index holds several references
+    #returns the elapsed time (in seconds) of each stage
+    timings = OrderedDict()
+    start = time.time()
+    reported = ["-a"] if all_alignments else ["-k", "1"]
+    with open(bowtie_log, "w") as log:
+        aligning = subprocess.Popen(["bowtie", "-q", "-v", str(mismatches)] + reported + ["-p", str(threads), "-x", index, fastq, "-S"], stdout=subprocess.PIPE, stderr=log)
+        sorting = subprocess.Popen(["samtools", "sort", "-@", str(threads), "-o", sortedbam, "-"], stdin=aligning.stdout)
+        #only samtools sort reads the pipe, so bowtie gets SIGPIPE if samtools sort fails
+        aligning.stdout.close()
+        aligning_returncode = aligning.wait()
+        timings["bowtie"] = time.time() - start
+        sorting_returncode = sorting.wait()
+        timings["samtools_sort"] = time.time() - start - timings["bowtie"]
+    check_returncode("bowtie", aligning_returncode)
+    check_returncode("samtools sort", sorting_returncode)
+
+    start = time.time()
+    check_returncode("samtools index", subprocess.call(["samtools", "index", sortedbam]))
+    timings["samtools_index"] = time.time() - start
+    return timings
+
+
+def bowtie_aligned_reads(bowtie_log):
+    #number of reads with at least one alignment reported in the bowtie log
+    read_counts = parse_bowtie_log(bowtie_log)["reads_aligned"]
+    if read_counts is None:
+        return None
+    print("# reads with at least one alignment: " + str(read_counts))
+    return str(read_counts)
+
+
+def format_timings(timings):
+    return ", ".join(stage + " " + "{:.1f}".format(elapsed) + " s" for stage, elapsed in timings.items())
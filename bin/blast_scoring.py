@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+Scoring of the blast hits used to select the best hit for each virus/viroid species.
+Each hit receives points when it has the highest naccs, alignment length, av-pident
+or coverage of its species and when its description indicates a complete (or
+partial) genome.
+Run this script directly to benchmark the scoring on a synthetic blast summary:
+# blast_scoring.py --benchmark_rows 500000
+"""
+
+import argparse
+import re
+import time
+import numpy as np
+import pandas as pd
+
+#points given to the hits with the highest value of each metric within a species
+MAX_SCORES = [("naccs", "naccs_score", 1),
+            ("length", "length_score", 2),
+            ("av-pident", "avpid_score", 1),
+            ("cov", "cov_score", 1)]
+
+#the complete genome patterns take precedence over the partial ones
+COMPLETE_PATTERN = re.compile("complete sequence|complete genome|polyprotein gene complete cds|polyprotein 1 gene complete cds|polyprotein 2 gene complete cds")
+PARTIAL_PATTERN = re.compile("nearly complete sequence|partial|polymerase protein|RNA-dependent RNA polymerase")
+
+
+def completeness_score(title):
+    title = str(title)
+    if COMPLETE_PATTERN.search(title):
+        return 3
+    elif PARTIAL_PATTERN.search(title):
+        return -3
+    else:
+        return 0
+
+
+def score_hits(raw_data, group="Species_updated"):
+    #add the component scores and the total_score in place
+    grouped = raw_data.groupby(group)
+    for column, score, points in MAX_SCORES:
+        raw_data[score] = np.where(raw_data[column] == grouped[column].transform("max"), points, 0)
+
+    #titles repeat across hits, only match each unique title once
+    titles = raw_data["stitle"].astype(str)
+    title_scores = {title: completeness_score(title) for title in titles.unique()}
+    raw_data["completeness_score"] = titles.map(title_scores).astype(int)
+
+    raw_data["total_score"] = raw_data["length_score"] + raw_data["naccs_score"] + raw_data["avpid_score"] + raw_data["cov_score"] + raw_data["completeness_score"]
+    return raw_data
+
+
+def synthetic_blast_summary(rows, species=2000, seed=0):
+    rng = np.random.RandomState(seed)
+    titles = np.array(["Citrus tristeza virus isolate %d complete genome",
+                    "Hop stunt viroid isolate %d complete sequence",
+                    "Grapevine leafroll associated virus 3 isolate %d polyprotein gene partial cds",
+                    "Apple stem grooving virus isolate %d RNA dependent RNA polymerase gene",
+                    "Prunus necrotic ringspot virus isolate %d segment RNA2"])
+    title_ids = rng.randint(0, len(titles), rows)
+    isolates = rng.randint(0, 5000, rows)
+    return pd.DataFrame({"Species_updated": ["species_" + str(i) for i in rng.randint(0, species, rows)],
+                        "naccs": rng.randint(1, 20, rows),
+                        "length": rng.randint(40, 10000, rows),
+                        "av-pident": np.round(rng.uniform(70, 100, rows), 2),
+                        "cov": np.round(rng.uniform(0, 100, rows), 2),
+                        "stitle": [titles[t] % i for t, i in zip(title_ids, isolates)]})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the scoring of blast hits")
+    parser.add_argument("--benchmark_rows", type=int, default=500000)
+    args = parser.parse_args()
+
+    raw_data = synthetic_blast_summary(args.benchmark_rows)
+    start = time.time()
+    score_hits(raw_data)
+    elapsed = time.time() - start
+    print("Scored " + str(len(raw_data)) + " blast hits in " + "{:.2f}".format(elapsed) + " s")
+    print(raw_data["total_score"].value_counts().sort_index())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+"""
+Summary of blast tabular (outfmt 6) results per subject accession, replacing BlastTools.jar.
+For each sacc, report the number of distinct alignments (naccs), the alignment length
+merged across the alignments (length), the subject length (slen), the fraction of the
+subject covered (cov), the alignment length weighted average identity (av-pident), the
+subject title and the list of query ids.
+The calculations, number formats and order of the subjects (java.util.HashMap order) follow
+BlastTools.jar so the summaries are unchanged (test/blast_summary holds blast hits, the jar and
+the summaries expected from it, reconstructed from its bytecode until they are regenerated with java):
+# blast_summary.py --blast sample_top5Hits_virus_viroids.txt --program blastn
+writes summary_sample_top5Hits_virus_viroids.txt like java -jar BlastTools.jar -t blastn did.
+"""
+
+import argparse
+import os
+import re
+from collections import OrderedDict
+from decimal import Decimal, ROUND_HALF_EVEN
+
+#0-based column of each field in the blastn and blastp (blastx/tblastn) tabular outputs used by VirReport
+BLAST_COLUMNS = {"blastn": {"qseqid": 0, "sacc": 2, "sstart": 10, "send": 11, "stitle": 17, "pident": 4, "sstrand": 13, "slen": 12},
+                "blastp": {"qseqid": 1, "sacc": 0, "sstart": 12, "send": 13, "stitle": 19, "pident": 2, "slen": 14}}
+
+SUMMARY_COLUMNS = ["sacc", "naccs", "length", "slen", "cov", "av-pident", "stitle", "qseqids"]
+#characters removed by java.lang.String.trim
+JAVA_WHITESPACE = "".join(chr(i) for i in range(33))
+
+
+class SubjectHits(object):
+    #alignments to one subject accession, as (start, end, qseqid, pident) ranges
+    def __init__(self, title, slen):
+        self.title = title
+        self.slen = slen
+        self.ranges = []
+        self.keys = set()
+
+    def add_range(self, start, end, qseqid, pident):
+        #the same alignment of a query is only counted once
+        key = (start, end, qseqid)
+        if key in self.keys:
+            return
+        self.keys.add(key)
+        self.ranges.append((start, end, qseqid, pident))
+
+    def summary(self):
+        #ranges are sorted by start (stable), each range adds its length minus the sum of its overlaps with each of the
+        #previous ranges, so a region shared by several ranges is subtracted once per previous range, as in BlastTools.jar
+        #once a range ends before the start of the current range it cannot overlap the next ones and is no longer compared
+        ranges = sorted(self.ranges, key=lambda r: r[0])
+        length = 0
+        previous_ranges = []
+        for r in ranges:
+            previous_ranges = [previous for previous in previous_ranges if previous[1] >= r[0]]
+            overlap = sum(range_overlap(r, previous) for previous in previous_ranges)
+            length += (r[1] - r[0]) - overlap
+            previous_ranges.append(r)
+        cov = java_divide(length, self.slen)
+        aligned = sum(r[1] - r[0] for r in ranges)
+        weighted_pident = sum((r[1] - r[0]) * r[3] for r in ranges)
+        av_pident = java_divide(weighted_pident, aligned)
+        return [len(ranges), length, self.slen, java_decimal(cov), java_decimal(av_pident), self.title, ",".join(r[2] for r in ranges)]
+
+
+def range_overlap(a, b):
+    #overlap of two (start, end) ranges as defined in BlastTools.jar
+    a_start, a_end = a[0], a[1]
+    b_start, b_end = b[0], b[1]
+    if a_start > b_end or b_start > a_end:
+        return 0
+    if a_start < b_start and a_end >= b_start:
+        return a_end - b_start + 1
+    if b_start < a_start and b_end >= a_start:
+        return b_end - a_start + 1
+    if a_start >= b_start and a_end <= b_end:
+        return a_end - a_start + 1
+    if b_start >= a_start and b_end <= a_end:
+        return b_end - b_start + 1
+    return 0
+
+
+def java_divide(numerator, denominator):
+    #floating point division of java, a division by zero gives an infinity or NaN
+    if denominator == 0:
+        if numerator == 0 or numerator != numerator:
+            return float("nan")
+        return float("inf") if numerator > 0 else float("-inf")
+    return numerator / denominator
+
+
+def java_decimal(value, digits=3):
+    #the #,##0.### pattern of java.text.DecimalFormat: grouped thousands, at most 3 decimals rounded half even from the
+    #exact value of the double, no trailing zeros, and a minus sign kept when a negative value rounds to zero
+    if value != value:
+        return "NaN"
+    if value in (float("inf"), float("-inf")):
+        return ("-" if value < 0 else "") + "\u221e"
+    rounded = Decimal(value).quantize(Decimal(1).scaleb(-digits), rounding=ROUND_HALF_EVEN)
+    text = "{:,f}".format(rounded)
+    if "." in text:
+        text = text.rstrip("0").rstrip(".")
+    return text
+
+
+def java_string_hash(value):
+    #java.lang.String.hashCode on the UTF-16 code units, as an unsigned 32 bit integer
+    h = 0
+    units = value.encode("utf-16-be")
+    for i in range(0, len(units), 2):
+        h = (31 * h + (units[i] << 8 | units[i + 1])) & 0xFFFFFFFF
+    return h
+
+
+def java_hashmap_order(keys):
+    #iteration order of the distinct keys (in insertion order) of a java.util.HashMap of default capacity: by bucket of the
+    #final table, then by insertion within a bucket (a bucket with more than 8 keys, stored as a tree by java, is not modelled)
+    capacity = 16
+    for size in range(1, len(keys) + 1):
+        if size > capacity * 3 // 4:
+            capacity *= 2
+    def bucket(key):
+        h = java_string_hash(key)
+        return (h ^ (h >> 16)) & (capacity - 1)
+    return sorted(keys, key=bucket)
+
+
+def is_int(value):
+    #java Integer.parseInt: an optional sign and decimal digits within the range of an int
+    if not re.fullmatch(r"[+-]?\d+", value):
+        return False
+    return -2 ** 31 <= int(value) < 2 ** 31
+
+
+def is_float(value):
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+
+def summarise_blast(blastfile, program="blastn"):
+    #return an OrderedDict of sacc -> summary row (without the sacc), subjects in the order written by BlastTools.jar
+    columns = BLAST_COLUMNS[program]
+    stranded = "sstrand" in columns
+    subjects = OrderedDict()
+    with open(blastfile, 'r') as f:
+        for line in f:
+            #java String.split drops the trailing empty fields
+            elements = line.rstrip("\n").split("\t")
+            while elements and not elements[-1]:
+                elements.pop()
+            #skip truncated or malformed lines
+            if len(elements) <= 11:
+                continue
+            if not elements[columns["sacc"]] or not elements[columns["qseqid"]]:
+                continue
+            if stranded and not elements[columns["sstrand"]]:
+                continue
+            if not (is_int(elements[columns["sstart"]]) and is_int(elements[columns["send"]]) and is_int(elements[columns["slen"]]) and is_float(elements[columns["pident"]])):
+                continue
+            start = int(elements[columns["sstart"]])
+            end = int(elements[columns["send"]])
+            if stranded and elements[columns["sstrand"]] == "minus":
+                start, end = end, start
+            sacc = elements[columns["sacc"]].strip(JAVA_WHITESPACE)
+            if sacc not in subjects:
+                subjects[sacc] = SubjectHits(elements[columns["stitle"]].strip(JAVA_WHITESPACE), int(elements[columns["slen"]]))
+            subjects[sacc].add_range(start, end, elements[columns["qseqid"]].strip(JAVA_WHITESPACE), float(elements[columns["pident"]]))
+    return OrderedDict((sacc, subjects[sacc].summary()) for sacc in java_hashmap_order(list(subjects)))
+
+
+def summary_rows(blastfile, program="blastn"):
+    return [[sacc] + row for sacc, row in summarise_blast(blastfile, program).items()]
+
+
+def format_summary(rows):
+    return "\t".join(SUMMARY_COLUMNS) + "\n" + "".join("\t".join(str(value) for value in row) + "\n" for row in rows)
+
+
+def write_summary(rows, out):
+    with open(out, "w", encoding="utf-8") as f:
+        f.write(format_summary(rows))
+
+
+def summary_file_name(blastfile):
+    #summary_<file name without extension>.txt in the working directory, as named by BlastTools.jar
+    return "summary_" + os.path.splitext(os.path.basename(blastfile))[0] + ".txt"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarise blast results per subject accession")
+    parser.add_argument("--blast", type=str, required=True)
+    parser.add_argument("--program", type=str, default="blastn", choices=["blastn", "blastp"])
+    parser.add_argument("--out", type=str)
+    args = parser.parse_args()
+    blastfile = args.blast
+    program = args.program
+    out = args.out if args.out is not None else summary_file_name(blastfile)
+
+    write_summary(summary_rows(blastfile, program), out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Retrieve the top N hits of each query from a blast tabular (outfmt 6) file in a single pass.
+Blast writes the hits of a query consecutively and ranked, so the top hits are the first N
+lines of each block of lines sharing the same qseqid (column 1).
+Several top N cut-offs can be written in the same pass, each with an optional subset
+restricted to the hits to viruses and viroids (case insensitive match on the whole line).
+# blast_top_hits.py --blast sample_blastn_vs_NT.bls --top 1 5 --out sample_top1Hits.txt sample_top5Hits.txt --virus_out sample_top1Hits_virus_viroids.txt sample_top5Hits_virus_viroids.txt
+"""
+
+import argparse
+import re
+
+VIRUS_PATTERN = re.compile("virus|viroid", re.IGNORECASE)
+
+
+def top_hits(blastfile):
+    #yield each hit line with its rank (starting at 1) within its query
+    query = None
+    rank = 0
+    with open(blastfile, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            qseqid = line.split("\t", 1)[0]
+            if qseqid != query:
+                query = qseqid
+                rank = 0
+            rank += 1
+            yield rank, line
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Retrieve the top hits of each query from a blast tabular file")
+    parser.add_argument("--blast", type=str, required=True)
+    parser.add_argument("--top", type=int, nargs="+", default=[5])
+    parser.add_argument("--out", type=str, nargs="+", required=True)
+    parser.add_argument("--virus_out", type=str, nargs="*", default=[])
+    args = parser.parse_args()
+    blastfile = args.blast
+    tops = args.top
+    outs = args.out
+    virus_outs = args.virus_out
+
+    if len(outs) != len(tops):
+        parser.error("--out requires one file per --top value")
+    if virus_outs and len(virus_outs) != len(tops):
+        parser.error("--virus_out requires one file per --top value")
+
+    handles = [open(out, "w") for out in outs]
+    virus_handles = [open(out, "w") for out in virus_outs]
+    max_top = max(tops)
+    for rank, line in top_hits(blastfile):
+        if rank > max_top:
+            continue
+        is_virus = virus_handles and VIRUS_PATTERN.search(line) is not None
+        for i, top in enumerate(tops):
+            if rank <= top:
+                handles[i].write(line)
+                if is_virus:
+                    virus_handles[i].write(line)
+    for handle in handles + virus_handles:
+        handle.close()
+
+
+if __name__ == "__main__":
+    main()
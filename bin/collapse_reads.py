@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+"""
+Collapse the reads of a fastq file into distinct sequences with their number of reads,
+written as a tab separated table (gzipped when --tsv ends with .gz) and/or a fasta file.
+The collapsed reads are built once from the quality trimmed reads and read by the steps that
+only need the read sequences and counts (read length distribution, RNA source profile).
+# collapse_reads.py --fastq sample_quality_trimmed.fastq --tsv sample_collapsed_reads.tsv.gz
+"""
+
+import argparse
+from collapsed_reads import collapse_fastq, write_collapsed_tsv, write_collapsed_fasta
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Collapse the reads of a fastq file into distinct sequences with their number of reads")
+    parser.add_argument("--fastq", type=str, required=True)
+    parser.add_argument("--tsv", type=str)
+    parser.add_argument("--fasta", type=str)
+    args = parser.parse_args()
+    if args.tsv is None and args.fasta is None:
+        parser.error("at least one of --tsv and --fasta is required")
+
+    print("Collapsing reads")
+    counts = collapse_fastq(args.fastq)
+    print(str(sum(counts.values())) + " reads collapsed into " + str(len(counts)) + " distinct sequences")
+    if args.tsv is not None:
+        write_collapsed_tsv(counts, args.tsv)
+    if args.fasta is not None:
+        write_collapsed_fasta(counts, args.fasta)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Collapsed reads: each distinct read sequence is kept once with the number of reads having
+this sequence. Small RNA libraries are very redundant, so the steps that only depend on the
+sequence of the reads can process the collapsed reads instead of every read, weighting each
+sequence by its number of reads.
+The collapsed reads are written as a fasta file, the name of each sequence is
+<index>_x<count>, or as a (gzipped) tab separated table with a sequence and count column,
+from the most to the least abundant sequence. Both are read back with read_collapsed.
+"""
+
+import gzip
+import itertools
+from fastq_utils import open_fastq
+
+COLLAPSED_COLUMNS = ["sequence", "count"]
+
+
+def collapse_fastq(fastq):
+    #number of reads of each distinct sequence (bytes) of a plain or gzipped fastq file
+    counts = {}
+    with open_fastq(fastq) as f:
+        lines = iter(f)
+        for header, seq, plus, qual in zip(lines, lines, lines, lines):
+            seq = seq.rstrip(b"\r\n")
+            counts[seq] = counts.get(seq, 0) + 1
+    return counts
+
+
+def sort_collapsed(counts):
+    return sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+
+
+def write_collapsed_fasta(counts, fasta):
+    #returns the sequences and their number of reads in the order of their index in the fasta file
+    collapsed = sort_collapsed(counts)
+    with open(fasta, 'wb') as out:
+        for index, (seq, count) in enumerate(collapsed):
+            out.write(b">" + str(index).encode() + b"_x" + str(count).encode() + b"\n" + seq + b"\n")
+    return collapsed
+
+
+def write_collapsed_tsv(counts, tsv):
+    #gzipped when the file name ends with .gz
+    collapsed = sort_collapsed(counts)
+    with (gzip.open(tsv, 'wb', compresslevel=6) if tsv.endswith(".gz") else open(tsv, 'wb')) as out:
+        out.write("\t".join(COLLAPSED_COLUMNS).encode() + b"\n")
+        for seq, count in collapsed:
+            out.write(seq + b"\t" + str(count).encode() + b"\n")
+    return collapsed
+
+
+def collapsed_index(name):
+    #index of a collapsed sequence from its name (bytes)
+    return int(name.split(b"_x")[0])
+
+
+def read_collapsed(path, min_length=0, max_length=None):
+    #yields the sequence (bytes) and number of reads of each collapsed sequence of a fasta or tsv file,
+    #only keeping the sequences between min_length and max_length
+    with open_fastq(path) as f:
+        lines = iter(f)
+        first = next(lines, b"")
+        if first.startswith(b">"):
+            #the count is at the end of the name of each sequence, each sequence is on a single line
+            names = itertools.chain([first], lines)
+            records = ((seq.rstrip(b"\r\n"), name.rstrip(b"\r\n").split(b"_x")[-1]) for name, seq in zip(names, lines))
+        else:
+            #the first line is the header of the table
+            records = (line.rstrip(b"\r\n").split(b"\t") for line in lines)
+        for seq, count in records:
+            if len(seq) >= min_length and (max_length is None or len(seq) <= max_length):
+                yield seq, int(count)
+
+
+def collapsed_read_count(path, min_length=0, max_length=None):
+    #number of reads between min_length and max_length
+    return sum(count for seq, count in read_collapsed(path, min_length, max_length))
+
+
+def collapsed_length_counts(path, min_length=0, max_length=None):
+    #number of reads of each read length
+    length_counts = {}
+    for seq, count in read_collapsed(path, min_length, max_length):
+        length_counts[len(seq)] = length_counts.get(len(seq), 0) + count
+    return length_counts
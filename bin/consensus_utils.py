@@ -0,0 +1,51 @@
+"""
+Variant calling and consensus sequence of a target, with the bcftools steps streamed
+through pipes instead of writing and indexing a file after each step:
+samtools mpileup | bcftools call -> <prefix>.vcf.gz (used for the consensus)
+bcftools norm | bcftools filter --IndelGap 5 -> <prefix>_sequence_variants.vcf.gz
+The positions with zero coverage are masked in memory before bcftools consensus.
+"""
+
+import os
+import subprocess
+import time
+from collections import OrderedDict
+from alignment_utils import check_returncode, run_pipeline
+from coverage_utils import depth_array, zero_coverage_intervals, mask_sequence, write_fasta
+
+
+def build_consensus(fastafile, bamfile, prefix, maskedfasta, refname, refseq):
+    #returns the consensus fasta file and the elapsed time (in seconds) of each stage
+    timings = OrderedDict()
+    vcfout = prefix + ".vcf.gz"
+    variants = prefix + "_sequence_variants.vcf.gz"
+    consensus = prefix + ".consensus.fasta"
+
+    #variant calling
+    timings["mpileup_call"] = run_pipeline([["samtools", "mpileup", "-uf", fastafile, bamfile],
+                                            ["bcftools", "call", "-c", "-Oz", "-o", vcfout]])
+    start = time.time()
+    check_returncode("bcftools index", subprocess.call(["bcftools", "index", vcfout]))
+    timings["index_calls"] = time.time() - start
+
+    #normalise indels and filter adjacent indels within 5bp
+    timings["norm_filter"] = run_pipeline([["bcftools", "norm", "-f", fastafile, vcfout, "-Ou"],
+                                            ["bcftools", "filter", "--IndelGap", "5", "-Oz", "-o", variants]])
+    start = time.time()
+    check_returncode("bcftools index", subprocess.call(["bcftools", "index", variants]))
+    timings["index_variants"] = time.time() - start
+
+    #assign N to nucleotide positions that have zero coverage
+    start = time.time()
+    zero_cov = zero_coverage_intervals(depth_array(bamfile, refname, len(refseq)))
+    write_fasta(refname, mask_sequence(refseq, zero_cov), maskedfasta)
+    timings["mask"] = time.time() - start
+
+    start = time.time()
+    check_returncode("bcftools consensus", subprocess.call(["bcftools", "consensus", "-f", maskedfasta, vcfout, "-o", consensus]))
+    timings["consensus"] = time.time() - start
+
+    for fl in (vcfout, vcfout + ".csi", maskedfasta):
+        if os.path.exists(fl):
+            os.remove(fl)
+    return consensus, timings
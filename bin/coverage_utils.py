@@ -0,0 +1,94 @@
+"""
+Coverage statistics derived in-process from a sorted bam file, used instead of
+picard CollectWgsMetrics and bedtools genomecov/maskfasta.
+The metrics follow the CollectWgsMetrics definitions (default filters of
+mapping quality >= 20 and base quality >= 20, depth capped at 250x, genome
+territory restricted to non-N reference bases).
+"""
+
+import subprocess
+import numpy as np
+from alignment_utils import check_returncode
+
+COVERAGE_CAP = 250
+PCT_THRESHOLDS = (1, 5, 10, 20)
+
+
+def read_fasta(fastafile):
+    #return the name (first word of the header) and sequence of the first record of a fasta file
+    #blastdbcmd output is wrapped in single quotes (-outfmt "'%f'")
+    name = None
+    seq = []
+    with open(fastafile, 'r') as f:
+        for line in f:
+            line = line.strip().replace("'", "")
+            if not line or line == "--":
+                continue
+            if line.startswith(">"):
+                if name is not None:
+                    break
+                name = line[1:].split()[0]
+            elif name is not None:
+                seq.append(line)
+    return name, "".join(seq)
+
+
+def depth_array(bamfile, refname, reflen, min_mapq=0, min_baseq=0):
+    #per base depth of a reference, including positions with zero coverage
+    depth = np.zeros(reflen, dtype=np.int64)
+    command = ["samtools", "depth", "-a", "-q", str(min_baseq), "-Q", str(min_mapq), bamfile]
+    p = subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True)
+    for line in p.stdout:
+        elements = line.rstrip("\n").split("\t")
+        if elements[0] != refname:
+            continue
+        pos = int(elements[1]) - 1
+        if pos < reflen:
+            depth[pos] = int(elements[2])
+    check_returncode("samtools depth", p.wait())
+    return depth
+
+
+def wgs_metrics(depth, sequence, coverage_cap=COVERAGE_CAP):
+    #mean depth and fraction of the genome territory covered at 1X, 5X, 10X and 20X
+    territory = np.array([base not in "Nn" for base in sequence], dtype=bool)
+    capped = np.minimum(depth[territory], coverage_cap)
+    metrics = {"GENOME_TERRITORY": int(territory.sum())}
+    if len(capped) == 0:
+        metrics["MEAN_COVERAGE"] = 0.0
+        for threshold in PCT_THRESHOLDS:
+            metrics["PCT_" + str(threshold) + "X"] = 0.0
+        return metrics
+    metrics["MEAN_COVERAGE"] = float(capped.mean())
+    for threshold in PCT_THRESHOLDS:
+        metrics["PCT_" + str(threshold) + "X"] = float((capped >= threshold).mean())
+    return metrics
+
+
+def write_metrics(metrics, outfile):
+    columns = ["GENOME_TERRITORY", "MEAN_COVERAGE"] + ["PCT_" + str(threshold) + "X" for threshold in PCT_THRESHOLDS]
+    with open(outfile, "w") as out:
+        out.write("\t".join(columns) + "\n")
+        out.write("\t".join(str(metrics[column]) for column in columns) + "\n")
+
+
+def zero_coverage_intervals(depth):
+    #0-based half open intervals of positions with no coverage, equivalent to the $4==0 lines of bedtools genomecov -bga
+    zero = np.concatenate(([False], depth == 0, [False]))
+    edges = np.flatnonzero(zero[1:] != zero[:-1])
+    return list(zip(edges[::2].tolist(), edges[1::2].tolist()))
+
+
+def mask_sequence(sequence, intervals):
+    #replace the positions within the intervals with N
+    seq = list(sequence)
+    for start, end in intervals:
+        seq[start:end] = "N" * (end - start)
+    return "".join(seq)
+
+
+def write_fasta(name, sequence, outfile, width=60):
+    with open(outfile, "w") as out:
+        out.write(">" + name + "\n")
+        for i in range(0, len(sequence), width):
+            out.write(sequence[i:i + width] + "\n")
@@ -0,0 +1,75 @@
+"""
+Per-target checkpoints of the coverage statistics so that a rerun of the COVSTATS steps
+(e.g. a retry after running out of memory) only processes the targets not completed yet.
+<checkpoint_dir>/<sample>_<read_size>/<accession>/<key>/stats.json holds the metrics of the
+target and the other files of the entry are the output files of the target (bam, consensus,
+coverage metrics, logs), restored in the working directory when the checkpoint is reused.
+<key> is the sha1 of the settings and of the inputs of the target (path, size and modification
+time of the reads filtered by size, raw read count, checksum of the reference sequence), so a
+checkpoint is only reused for identical inputs without hashing the whole fastq file.
+Entries are written to a temporary directory and renamed so a crash never leaves a partial
+checkpoint behind.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from reference_cache import file_checksum
+
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def file_signature(path):
+    #identify a large input file by its real path (nextflow stages inputs as links), size and modification time
+    stat = os.stat(path)
+    return [os.path.realpath(path), stat.st_size, stat.st_mtime_ns]
+
+
+class TargetCheckpoints(object):
+    def __init__(self, checkpoint_dir, sample, read_size, settings):
+        #settings: list of the values every target of this sample depends on (input checksums, dedup...)
+        self.sample_dir = os.path.join(checkpoint_dir, sample + "_" + read_size)
+        self.settings = settings
+        os.makedirs(self.sample_dir, exist_ok=True)
+
+    def _entry_dir(self, refid, fastafile):
+        reference_checksum = file_checksum(fastafile)
+        key = hashlib.sha1(json.dumps([refid, reference_checksum] + self.settings).encode()).hexdigest()
+        return os.path.join(self.sample_dir, refid.replace("/", "_"), key)
+
+    def load(self, refid, fastafile):
+        #restore the output files of the target and return its metrics, or None if it has not been completed
+        entry_dir = self._entry_dir(refid, fastafile)
+        stats_file = os.path.join(entry_dir, "stats.json")
+        if not os.path.exists(stats_file):
+            return None
+        with open(stats_file, 'r') as f:
+            stats = json.load(f)
+        for fl in os.listdir(entry_dir):
+            if fl != "stats.json" and not os.path.exists(fl):
+                link_or_copy(os.path.join(entry_dir, fl), fl)
+        return stats
+
+    def save(self, refid, fastafile, stats, files):
+        entry_dir = self._entry_dir(refid, fastafile)
+        if os.path.exists(entry_dir):
+            return entry_dir
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(entry_dir), prefix=".tmp_")
+        for fl in files:
+            link_or_copy(fl, os.path.join(tmp_dir, os.path.basename(fl)))
+        with open(os.path.join(tmp_dir, "stats.json"), "w") as f:
+            json.dump(stats, f, indent=1)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            #another attempt saved the same target in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return entry_dir
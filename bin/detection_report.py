@@ -2,9 +2,14 @@
 import argparse
 import pandas as pd
 import numpy as np
-from functools import reduce
-import glob
 import time
+from table_loader import load_tables, read_table
+
+#columns of the per-sample tables of the top scoring targets with their coverage statistics kept in the report:
+#the blast columns are required, the coverage statistics may be missing from the tables of the samples without any target
+REPORT_COLUMNS = ["Sample","Species","sacc","naccs","length","slen","cov","av-pident","stitle","qseqids","contig_ind_lengths","cumulative_contig_len","contig_lenth_min","contig_lenth_max","longest_contig_fasta"]
+#text columns, read as such even when they look like numbers in a sample
+TEXT_COLUMNS = {column: str for column in ["Sample", "Species", "sacc", "stitle", "qseqids", "contig_ind_lengths", "longest_contig_fasta", "consensus_fasta"]}
 
 
 def main():
@@ -30,19 +35,18 @@ def main():
 
     timestr = time.strftime("%Y%m%d-%H%M%S")
 
-    run_data = pd.DataFrame()
-    for fl in glob.glob("*_top_scoring_targets_with_cov_stats*.txt"):
-        sample_data = pd.read_csv(fl, header=0, sep="\t",index_col=None)
-        run_data = run_data.append(sample_data)
+    if dedup == "true":
+        stat_columns = ["mean_read_depth","read_count","dedup_read_count","duplication_rate"]
+    elif viral_db == "true":
+        stat_columns = ["mean_read_depth","read_count","RPM"]
+    else:
+        stat_columns = ["mean_read_depth","read_count"]
+    stat_columns = stat_columns + ["FPKM","PCT_5X","PCT_10X","consensus_fasta"]
+    run_data = load_tables("*_top_scoring_targets_with_cov_stats*.txt", REPORT_COLUMNS, TEXT_COLUMNS, optional=stat_columns)
     print (run_data)
-    run_data["read size"] = readsize
+    run_data = run_data[REPORT_COLUMNS + stat_columns]
     
     if viral_db == "true":
-        if dedup == "true":
-            run_data = run_data[["Sample","Species","sacc","naccs","length","slen","cov","av-pident","stitle","qseqids","contig_ind_lengths","cumulative_contig_len","contig_lenth_min","contig_lenth_max","longest_contig_fasta","mean_read_depth","read_count","dedup_read_count","duplication_rate","FPKM","PCT_5X","PCT_10X", "consensus_fasta"]]
-        else:
-            run_data = run_data[["Sample","Species","sacc","naccs","length","slen","cov","av-pident","stitle", "qseqids","contig_ind_lengths","cumulative_contig_len","contig_lenth_min","contig_lenth_max","longest_contig_fasta","mean_read_depth","read_count","RPM","FPKM","PCT_5X","PCT_10X","consensus_fasta"]]
-        
         contamination_flag(run_data,threshold)
 
         run_data = run_data.sort_values(["Sample", "stitle"], ascending = (True, True))
@@ -57,15 +61,15 @@ def main():
             run_data.drop_duplicates()
 
             run_data["SSG_category"] = run_data["stitle"]
-            run_data["SSG_category"] = run_data["SSG_category"].str.replace('^.*Type:', '')
-            run_data["SSG_category"] = run_data["SSG_category"].str.replace('|', '')
+            run_data["SSG_category"] = run_data["SSG_category"].str.replace('^.*Type:', '', regex=True)
+            run_data["SSG_category"] = run_data["SSG_category"].str.replace('|', '', regex=False)
 
             grouped_summary=run_data[['Sample', 'viral_species']]
             grouped_summary = grouped_summary.groupby('Sample', as_index=False).agg(','.join)
             grouped_summary["viral_species"] = grouped_summary["viral_species"].str.replace(",",", ")
 
             if sampleinfo is not None:
-                sampleinfo_data = pd.read_csv(sampleinfo, header=0, sep="\t",index_col=None)
+                sampleinfo_data = read_table(sampleinfo, ["Sample"], {"Sample": str})
                 run_data = pd.merge(sampleinfo_data, run_data, on="Sample", how='outer').fillna('NA')
                 grouped_summary = pd.merge(sampleinfo_data, grouped_summary, on="Sample", how='outer').fillna('NA')
             
@@ -77,11 +81,6 @@ def main():
     
     #For NT analysis
     else:
-        if dedup == "true":
-            run_data = run_data[["Sample","Species","sacc","naccs","length","slen","cov","av-pident","stitle","qseqids","contig_ind_lengths","cumulative_contig_len","contig_lenth_min","contig_lenth_max","longest_contig_fasta","mean_read_depth","read_count","dedup_read_count","duplication_rate","FPKM","PCT_5X","PCT_10X","consensus_fasta"]]
-        else:
-            run_data = run_data[["Sample","Species","sacc","naccs","length","slen","cov","av-pident","stitle","qseqids","contig_ind_lengths","cumulative_contig_len","contig_lenth_min","contig_lenth_max","longest_contig_fasta","mean_read_depth","read_count","FPKM","PCT_5X","PCT_10X","consensus_fasta"]]
-
         contamination_flag(run_data,threshold)
     
         run_data = run_data.sort_values(["Sample", "Species"], ascending = (True, True))
@@ -112,7 +111,7 @@ def main():
             #print(grouped_summary)
 
             if sampleinfo is not None:
-                sampleinfo_data = pd.read_csv(sampleinfo, header=0, sep="\t",index_col=None)
+                sampleinfo_data = read_table(sampleinfo, ["Sample"], {"Sample": str})
                 run_data = pd.merge(sampleinfo_data, run_data, on="Sample", how='outer').fillna('NA')
                 grouped_summary = pd.merge(sampleinfo_data, grouped_summary, on="Sample", how='outer').fillna('NA')
             
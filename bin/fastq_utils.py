@@ -0,0 +1,91 @@
+"""
+Constant memory helpers to read plain or gzipped fastq files.
+Gzipped files are decompressed with pigz when it is available (or python-isal),
+otherwise with the gzip module.
+"""
+
+import gzip
+import shutil
+import subprocess
+from log_parsers import read_counts
+
+try:
+    from isal import igzip
+except ImportError:
+    igzip = None
+
+CHUNK_SIZE = 16 * 1024 * 1024
+
+
+class _PigzReader(object):
+    #file-like wrapper around the stdout of a pigz process
+    def __init__(self, path):
+        self.proc = subprocess.Popen(["pigz", "-dc", path], stdout=subprocess.PIPE, bufsize=CHUNK_SIZE)
+
+    def read(self, size=-1):
+        return self.proc.stdout.read(size)
+
+    def __iter__(self):
+        return iter(self.proc.stdout)
+
+    def close(self):
+        self.proc.stdout.close()
+        if self.proc.wait() != 0:
+            raise OSError("pigz failed to decompress the fastq file")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def is_gzipped(path):
+    with open(path, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+
+def open_fastq(path):
+    #open a plain or gzipped file in binary mode
+    if not is_gzipped(path):
+        return open(path, 'rb', buffering=CHUNK_SIZE)
+    if shutil.which("pigz") is not None:
+        return _PigzReader(path)
+    if igzip is not None:
+        return igzip.open(path, 'rb')
+    return gzip.open(path, 'rb')
+
+
+def count_lines(path):
+    lines = 0
+    last = b'\n'
+    with open_fastq(path) as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            lines += chunk.count(b'\n')
+            last = chunk[-1:]
+    #last line without a trailing newline
+    if last != b'\n':
+        lines += 1
+    return lines
+
+
+def count_fastq_reads(path):
+    return count_lines(path) // 4
+
+
+def read_count_from_log(logfile, counts="input"):
+    #number of reads processed (input) or written (output) recorded in a cutadapt or umi_tools log
+    return read_counts(logfile)[counts]
+
+
+def raw_read_count(fastq, logfile=None):
+    #reuse the count recorded in the log of the step that read this fastq file, only scan the file when it is not available
+    if logfile is not None:
+        read_counts = read_count_from_log(logfile, counts="input")
+        if read_counts is not None:
+            return read_counts
+        print("No read count found in " + logfile + ", counting reads in " + fastq)
+    return count_fastq_reads(fastq)
@@ -4,9 +4,24 @@ import pandas as pd
 import numpy as np
 import os
 import subprocess
-from functools import reduce
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 from subprocess import run, PIPE
+from fastq_utils import raw_read_count
+from blast_scoring import score_hits
+from stitle_rules import load_rules, normalise_titles
+from alignment_utils import align_to_sorted_bam, bowtie_aligned_reads, check_returncode, format_timings
+from profiling import Profiler
+from reference_cache import ReferenceCache, fetch_references, fetch_viral_db_references
+from covstats_checkpoint import TargetCheckpoints, file_signature
+from coverage_utils import read_fasta, depth_array, wgs_metrics, write_metrics
+from consensus_utils import build_consensus
+
+#metrics of each target in the order of the columns of the summary table
+TARGET_STAT_COLUMNS = ["mean_read_depth", "read_count", "dedup_read_count", "duplication_rate", "RPM", "FPKM", "PCT_1X", "PCT_5X", "PCT_10X", "PCT_20X", "consensus_fasta"]
+#blast columns of the summary table in ncbi mode, between the Sample column and the metrics of each target
+NCBI_TARGET_COLUMNS = ["sacc", "Species", "naccs", "length", "slen", "cov", "av-pident", "stitle", "qseqids", "contig_ind_lengths", "cumulative_contig_len", "contig_lenth_min", "contig_lenth_max", "longest_contig_fasta", "total_score"]
 
 def main():
     ################################################################################
@@ -15,6 +30,7 @@ def main():
     # All the required arguments #
     parser.add_argument("--results", type=str)
     parser.add_argument("--rawfastq", type=str)
+    parser.add_argument("--rawfastq_log", type=str)
     parser.add_argument("--fastqfiltbysize", type=str)
     parser.add_argument("--sample", type=str)
     parser.add_argument("--read_size", type=str)
@@ -23,11 +39,18 @@ def main():
     parser.add_argument("--dedup", type=str)
     parser.add_argument("--cpu", type=str)
     parser.add_argument("--mode", type=str)
+    parser.add_argument("--stitle_rules", type=str)
+    parser.add_argument("--parallel_targets", type=int, default=1)
+    parser.add_argument("--alignment", type=str, default="per_target", choices=["per_target", "combined"])
+    parser.add_argument("--reference_cache", type=str)
+    parser.add_argument("--reference_fallback_fasta", type=str)
+    parser.add_argument("--checkpoint_dir", type=str)
     args = parser.parse_args()
     
     results_path = args.results
     sample = args.sample
     rawfastq = args.rawfastq
+    rawfastq_log = args.rawfastq_log
     fastqfiltbysize = args.fastqfiltbysize
     read_size = args.read_size
     taxonomy = args.taxonomy
@@ -35,10 +58,21 @@ def main():
     dedup = args.dedup
     cpus = args.cpu
     mode = args.mode
+    stitle_rules = args.stitle_rules
+    parallel_targets = args.parallel_targets
+    alignment = args.alignment
+    reference_fallback_fasta = args.reference_fallback_fasta
+    checkpoint_dir = args.checkpoint_dir
+    reference_cache = None
+    if args.reference_cache is not None:
+        #the cache is only evicted once per run, by reference_cache_evict.py
+        reference_cache = ReferenceCache(args.reference_cache)
+    profiler = Profiler(sample, read_size)
 
     
     if mode == "ncbi":
-        raw_data = pd.read_csv(results_path, header=0, sep="\t",index_col=None)
+        with profiler.stage("load_blast_summary", inputs=[results_path]):
+            raw_data = pd.read_csv(results_path, header=0, sep="\t",index_col=None)
         if len(raw_data) == 0:
             print("DataFrame is empty!")
             csv_file1 = open(sample + "_" + read_size + "_all_targets_with_scores.txt", "w")
@@ -47,12 +81,7 @@ def main():
             csv_file2 = open(sample + "_" + read_size + "_top_scoring_targets.txt", "w")
             csv_file2.write("sacc\tnaccs\tlength\tslen\tcov\tav-pident\tstitle\tqseqids\tcontig_ind_lengths\tcumulative_contig_len\tcontig_lenth_min\tcontig_lenth_max\tlongest_contig_fasta\tSpecies\tRNA_type\tSpecies_updated\tnaccs_score\tlength_score\tavpid_score\tcov_score\tcompleteness_score\ttotal_score") 
             csv_file2.close()
-            csv_file3 = open(sample + "_" + read_size + "_top_scoring_targets_with_cov_stats.txt", "w")
-            if dedup == "true": 
-                csv_file3.write("Sample\tsacc\tnaccs\tlength\tslen\tcov\tav-pident\tstitle\tqseqids\tcontig_ind_lengths\tcumulative_contig_len\tcontig_lenth_min\tcontig_lenth_max\tlongest_contig_fasta\tSpecies\tnaccs_score\tlength_score\tavpid_score\tcov_score\tcompleteness_score\ttotal_score\tmean_read_depth\tread_count\tdedup_read_count\tduplication_rate\tRPM\tFPKM\tPCT_1X\tPCT_10X\tPCT_20X\tconsensus_fasta")
-            else:
-                csv_file3.write("Sample\tsacc\tnaccs\tlength\tslen\tcov\tav-pident\tstitle\tqseqids\tcontig_ind_lengths\tcumulative_contig_len\tcontig_lenth_min\tcontig_lenth_max\tlongest_contig_fasta\tSpecies\tnaccs_score\tlength_score\tavpid_score\tcov_score\tcompleteness_score\ttotal_score\tmean_read_depth\tread_count\tRPM\tFPKM\tPCT_1X\tPCT_10X\tPCT_20X\tconsensus_fasta")
-            csv_file3.close()
+            write_empty_cov_stats(sample + "_" + read_size + "_top_scoring_targets_with_cov_stats.txt", NCBI_TARGET_COLUMNS, dedup)
             exit ()
 
         #load list of target viruses and viroids and matching official ICTV name
@@ -70,31 +99,13 @@ def main():
         #print(raw_data).head(10)
         print("Cleaning up the data")
         print("Remove double spacing")
-        raw_data = raw_data.replace("\s+", " ", regex=True)
+        with profiler.stage("normalise_titles"):
+            raw_data = raw_data.replace("\s+", " ", regex=True)
 
-        print("Remove hyphens")
-        raw_data["stitle"] = raw_data["stitle"].str.replace("-", " ")
-
-        print("Remove underscores")
-        raw_data["stitle"] = raw_data["stitle"].str.replace(",_"," ")
-        raw_data["stitle"] = raw_data["stitle"].str.replace("_"," ")
-
-        print("Remove commas")
-        raw_data["stitle"] = raw_data["stitle"].str.replace(","," ")
-
-        print("Remove problematic text in virus description names")
-        #this fixes virus names like "Prunus_necrotic_ringspot_virus_Acot_genomic_RNA,_segment_RNA2,_complete_sequence"
-        raw_data["stitle"] = raw_data["stitle"].str.replace(" genomic RNA segment","segment")
-        
-        raw_data["stitle"] = raw_data["stitle"].str.replace("{complete viroid sequence}","", regex=False)
-        #This is a complete genome
-        raw_data["stitle"] =  raw_data["stitle"].str.replace("Rubus yellow net virus isolate Canadian 2 hypothetical protein genes  partial cds; hypothetical proteins  polyprotein  ORF 6  and hypothetical protein genes  complete cds; and hypothetical protein genes  partial cds","Rubus yellow net virus isolate Canadian 2 complete cds")
-        #remove resistance genes from list of results
-        raw_data = raw_data[~raw_data["stitle"].str.contains("resistance gene")]
-        raw_data = raw_data[~raw_data["stitle"].str.contains("resistance protein")]
-        raw_data = raw_data[~raw_data["stitle"].str.contains("pararetrovirus")]
-        raw_data = raw_data[~raw_data["stitle"].str.contains("transposon")]
-        raw_data = raw_data[~raw_data["stitle"].str.contains("Petunia vein clearing virus like nonautonomous isolate")]
+            print("Remove hyphens, underscores, commas and problematic text in virus description names")
+            #remove resistance genes, pararetroviruses and transposons from list of results
+            raw_data["stitle"], excluded = normalise_titles(raw_data["stitle"], load_rules(stitle_rules))
+            raw_data = raw_data[~excluded]
         
         raw_data = pd.merge(raw_data, taxonomy_df, on=["sacc"])
         raw_data["Species"] = raw_data["Species"].str.replace("_", " ")
@@ -129,76 +140,33 @@ def main():
             csv_file2 = open(sample + "_" + read_size + "_top_scoring_targets.txt", "w")
             csv_file2.write("sacc\tnaccs\tlength\tslen\tcov\tav-pident\tstitle\tqseqids\tcontig_ind_lengths\tcumulative_contig_len\tcontig_lenth_min\tcontig_lenth_max\tlongest_contig_fasta\tSpecies\tRNA_type\tSpecies_updated\tnaccs_score\tlength_score\tavpid_score\tcov_score\tcompleteness_score\ttotal_score")
             csv_file2.close()
-            csv_file3 = open(sample + "_" + read_size + "_top_scoring_targets_with_cov_stats.txt", "w")
-            if dedup == "true":
-                csv_file3.write("Sample\tSpecies\tsacc\tnaccs\tlength\tslen\tcov\tav-pident\tstitle\tqseqids\tcontig_ind_lengths\tcumulative_contig_len\tcontig_lenth_min\tcontig_lenth_max\tlongest_contig_fasta\tmean_read_depth\tread_count\tdedup_read_count\tduplication_rate\tRPM\tFPKM\tPCT_1X\tPCT_5X\tPCT_10X\tPCT_20X\tconsensus_fasta")
-            else:
-                csv_file3.write("Sample\tSpecies\tsacc\tnaccs\tlength\tslen\tcov\tav-pident\tstitle\tqseqids\tcontig_ind_lengths\tcumulative_contig_len\tcontig_lenth_min\tcontig_lenth_max\tlongest_contig_fasta\tmean_read_depth\tread_count\tRPM\tFPKM\tPCT_1X\tPCT_5X\tPCT_10X\tPCT_20X\tconsensus_fasta")
-            csv_file3.close()
+            write_empty_cov_stats(sample + "_" + read_size + "_top_scoring_targets_with_cov_stats.txt", NCBI_TARGET_COLUMNS, dedup)
             exit ()
 
         print("Applying scoring to blast results to select best hit")
-        raw_data["naccs"] = raw_data["naccs"].astype(int)
-        raw_data["naccs_score"] = raw_data.groupby("Species_updated").apply(max_naccs)
-
-        raw_data["length"] = raw_data["length"].astype(int)
-        raw_data["length_score"] = raw_data.groupby("Species_updated").apply(max_length)
-
-        raw_data["av-pident"] = raw_data["av-pident"].astype(float)
-        raw_data["avpid_score"] = raw_data.groupby("Species_updated").apply(max_avpid)
-        
-        raw_data["cov"] = raw_data["cov"].astype(float)
-        raw_data["cov_score"] = raw_data.groupby("Species_updated").apply(max_cov)
-
-        raw_data["completeness_score"] = raw_data["stitle"].apply(completeness_score)
-        
-        raw_data["total_score"] = raw_data["length_score"] + raw_data["naccs_score"] + raw_data["avpid_score"] + raw_data["cov_score"] + raw_data["completeness_score"].astype(int)
+        with profiler.stage("score_hits"):
+            raw_data["naccs"] = raw_data["naccs"].astype(int)
+            raw_data["length"] = raw_data["length"].astype(int)
+            raw_data["av-pident"] = raw_data["av-pident"].astype(float)
+            raw_data["cov"] = raw_data["cov"].astype(float)
+            raw_data = score_hits(raw_data)
         
         print("Output all hits that match species of interest")
         raw_data.to_csv(sample + "_" + read_size + "_all_targets_with_scores.txt", index=None, sep="\t" )
 
         print("Remove seconday hits based on contig name")
-        unique_contigs = list(set([i.strip() for i in ",".join(raw_data["qseqids"]).split(",")]))
-
-        filtered_data = pd.DataFrame()
-        for contig in unique_contigs:
-            selected = pd.DataFrame()
-            selected = raw_data[raw_data["qseqids"].str.contains(contig)]
-            
-            if len(selected) == 1:
-                filtered_data = filtered_data.append(selected)
-            #If contigs hit to multiple viruses and viroids, choose best hit
-            elif len(selected)>1:
-                print(selected)
-                # Extract list of spp for a given contig
-                Species_updated_list = selected["Species_updated"].tolist()
-                #This should accomodate several RNAs per virus spp.
-                if len(Species_updated_list) == 1:
-                    filtered_data = filtered_data.append(selected)
-                # If there are several contigs, retain the top hit, remove 2ary hits
-                elif len(Species_updated_list) > 1:
-                    topmatch = selected["naccs"].max()
-                    selected = selected[selected["naccs"] == topmatch]
-                    # Check if there is a tie when selecting by max naccs:
-                    Species_updated_list = selected["Species_updated"].tolist()
-                    if len(Species_updated_list) == 1:
-                        filtered_data = filtered_data.append(selected)
-                    # If there is a tie, select next based on av-pidentity
-                    else:
-                        topmatch = selected["av-pident"].max()
-                        selected = selected[selected["av-pident"] == topmatch]
-                        filtered_data = filtered_data.append(selected)
-                
-        filtered_data = filtered_data.drop_duplicates()
-
-        print("Only retain the top hits")
-        idx = filtered_data.groupby(["Species_updated"])["total_score"].transform(max) == filtered_data["total_score"]
-        filtered_data = filtered_data[idx]
-        #print(filtered_data.dtypes)
-
-        #select one random hit if tie for top hits:
-        print("If there is a tie, select a random sequence out of the top scoring hit")
-        filtered_data = filtered_data.drop_duplicates(subset="Species_updated", keep="first")
+        with profiler.stage("select_best_hits"):
+            filtered_data = best_hits_per_contig(raw_data)
+            filtered_data = filtered_data.drop_duplicates()
+
+            print("Only retain the top hits")
+            idx = filtered_data.groupby(["Species_updated"])["total_score"].transform(max) == filtered_data["total_score"]
+            filtered_data = filtered_data[idx]
+            #print(filtered_data.dtypes)
+
+            #select one random hit if tie for top hits:
+            print("If there is a tie, select a random sequence out of the top scoring hit")
+            filtered_data = filtered_data.drop_duplicates(subset="Species_updated", keep="first")
     
         #By setting keep on False, all duplicates are True
         #If there are duplicates in species name (ie RNA types present), then it will drop NaN
@@ -214,22 +182,19 @@ def main():
         filtered_data = filtered_data[["sacc","Species","Species_updated","naccs","length","slen","cov","av-pident","stitle","qseqids","contig_ind_lengths","cumulative_contig_len","contig_lenth_min","contig_lenth_max","longest_contig_fasta","total_score"]]
         print(filtered_data)
         #cov_stats (blastdbpath, cpus, dedup, fastqfiltbysize, filtered_data, rawfastq, read_size, sample, target_dict, mode, diagno)
-        cov_stats (blastdbpath, cpus, dedup, fastqfiltbysize, filtered_data, rawfastq, read_size, sample, target_dict, mode)
+        cov_stats (blastdbpath, cpus, dedup, fastqfiltbysize, filtered_data, rawfastq, read_size, sample, target_dict, mode, parallel_targets, alignment, rawfastq_log, reference_cache, reference_fallback_fasta, profiler, checkpoint_dir)
 
     elif mode == "viral_db":
-        final_data = pd.read_csv(results_path, header=0, sep="\t",index_col=None)
-        final_data = final_data.rename(columns={"Species": "Species_updated"})
+        with profiler.stage("load_blast_summary", inputs=[results_path]):
+            final_data = pd.read_csv(results_path, header=0, sep="\t",index_col=None)
+            final_data = final_data.rename(columns={"Species": "Species_updated"})
         if len(final_data) == 0:
             print("DataFrame is empty!")
             #if diagno == "true":
                 #extension = ("_top_scoring_targets_with_cov_stats_viral_db.txt", "_top_scoring_targets_with_cov_stats_viral_db_regulated.txt", "_top_scoring_targets_with_cov_stats_viral_db_endemic.txt")
                 #for ext in extension:
-            outfile = open(sample + "_" + read_size + "_top_scoring_targets_with_cov_stats_viral_db.txt", 'w')
-            if dedup == "true":
-                outfile.write("Sample\tSpecies\tsacc\tnaccs\tlength\tslen\tcov\tav-pident\tstitle\tqseqids\tcontig_ind_lengths\tcumulative_contig_len\tcontig_lenth_min\tcontig_lenth_max\tlongest_contig_fasta\tICTV_information\tmean_read_depth\tread_count\tdedup_read_count\tduplication_rate\tRPM\tFPKM\tPCT_1X\tPCT_5X\tPCT_10X\tPCT_20X\tconsensus_fasta")
-            else:
-                outfile.write("Sample\tSpecies\tsacc\tnaccs\tlength\tslen\tcov\tav-pident\tstitle\tqseqids\tcontig_ind_lengths\tcumulative_contig_len\tcontig_lenth_min\tcontig_lenth_max\tlongest_contig_fasta\tICTV_information\tmean_read_depth\tread_count\tRPM\tFPKM\tPCT_1X\tPCT_5X\tPCT_10X\tPCT_20X\tconsensus_fasta")
-            outfile.close()
+            #same columns as the results of the blast search followed by the metrics of each target
+            write_empty_cov_stats(sample + "_" + read_size + "_top_scoring_targets_with_cov_stats_viral_db.txt", list(final_data.rename(columns={"Species_updated": "Species"}).columns), dedup)
 
             exit ()
         final_data["stitle"] = final_data["stitle"].str.replace("\._", "_")
@@ -237,291 +202,82 @@ def main():
         target_dict = pd.Series(final_data.Species_updated.values,index=final_data.sacc).to_dict()
         print (target_dict)
 
-        cov_stats (blastdbpath, cpus, dedup, fastqfiltbysize, final_data, rawfastq, read_size, sample, target_dict, mode)
+        cov_stats (blastdbpath, cpus, dedup, fastqfiltbysize, final_data, rawfastq, read_size, sample, target_dict, mode, parallel_targets, alignment, rawfastq_log, reference_cache, reference_fallback_fasta, profiler, checkpoint_dir)
 
-def cov_stats(blastdbpath, cpus, dedup, fastqfiltbysize, final_data, rawfastq, read_size, sample, target_dict, mode):
+def cov_stats(blastdbpath, cpus, dedup, fastqfiltbysize, final_data, rawfastq, read_size, sample, target_dict, mode, parallel_targets=1, alignment="per_target", rawfastq_log=None, reference_cache=None, reference_fallback_fasta=None, profiler=None, checkpoint_dir=None):
     print("Align reads and derive coverage and depth for best hit")
-    rawfastq_read_counts = (len(open(rawfastq).readlines(  ))/4)
-
-
-    cov_dict = {}
-    dedup_read_counts_dict = {}
-    dup_pc_dict = {}
-    fpkm_dict = {}
-    PCT_1X_dict = {}
-    PCT_5X_dict = {}
-    PCT_10X_dict = {}
-    PCT_20X_dict = {}
-    read_counts_dict = {}
-    rpm_dict = {}
-    consensus_dict = {}
-
-    read_counts_dedup_df = pd.DataFrame()
-    dup_pc_df = pd.DataFrame()
-    cov_df = pd.DataFrame()
-    read_counts_df = pd.DataFrame()
-    rpm_df = pd.DataFrame()
-    fpkm_df = pd.DataFrame()
-    PCT_1X_df = pd.DataFrame()
-    PCT_5X_df = pd.DataFrame()
-    PCT_10X_df = pd.DataFrame()
-    PCT_20X_df = pd.DataFrame()
-    consensus_df = pd.DataFrame()
+    if profiler is None:
+        profiler = Profiler(sample, read_size)
+    with profiler.stage("raw_read_count", inputs=[rawfastq]):
+        rawfastq_read_counts = raw_read_count(rawfastq, rawfastq_log)
+
+    with profiler.stage("prepare_references"):
+        reference_cache = prepare_references(target_dict, blastdbpath, read_size, sample, mode, reference_cache, reference_fallback_fasta)
+
+    #Reuse the targets completed by a previous attempt with the same inputs
+    checkpoints = None
+    completed = {}
+    if checkpoint_dir is not None:
+        with profiler.stage("restore_checkpoints", inputs=[fastqfiltbysize]):
+            checkpoints = TargetCheckpoints(checkpoint_dir, sample, read_size, [dedup, alignment, file_signature(fastqfiltbysize), int(rawfastq_read_counts)])
+            for refid, refspname in target_dict.items():
+                combinedid, fastafile, index = target_file_names(refid, refspname, read_size, sample)
+                stats = checkpoints.load(refid, fastafile)
+                if stats is not None:
+                    completed[refid] = stats
+        print("Reusing the checkpoints of " + str(len(completed)) + " target(s) out of " + str(len(target_dict)))
+    pending_dict = {refid: refspname for refid, refspname in target_dict.items() if refid not in completed}
+
+    #Align the reads once against all the targets instead of building one bowtie index per target
+    combined_bam = None
+    if alignment == "combined" and len(pending_dict) > 0:
+        with profiler.stage("combined_alignment", inputs=[fastqfiltbysize]):
+            combined_bam = combined_alignment(pending_dict, cpus, fastqfiltbysize, read_size, sample)
+
+    #Split the cpus allocated to the process between the targets that are processed concurrently
+    parallel_targets = max(1, min(int(parallel_targets), len(pending_dict)))
+    threads = str(max(1, int(cpus) // parallel_targets))
+    print("Processing " + str(parallel_targets) + " target(s) at a time using " + threads + " thread(s) each")
+
+    with ThreadPoolExecutor(max_workers=parallel_targets) as executor:
+        futures = {refid: executor.submit(target_cov_stats, refid, refspname, threads, dedup, fastqfiltbysize, rawfastq_read_counts, read_size, sample, combined_bam, reference_cache, profiler, checkpoints) for refid, refspname in pending_dict.items()}
+        #results are gathered in the order of the targets so the summary table does not depend on which target finishes first
+        target_results = [completed[refid] if refid in completed else futures[refid].result() for refid in target_dict]
+
+    if combined_bam is not None:
+        subprocess.call(["rm","-r", combined_bam])
+        subprocess.call(["rm","-r", combined_bam + ".bai"])
+
+    with profiler.stage("summary_table"):
+        print("Deriving summary table with coverage statistics")
+        full_table = summary_table(final_data, target_dict, target_results, sample, mode)
+
+    if mode == 'ncbi':
+        full_table.to_csv(sample + "_" + read_size + "_top_scoring_targets_with_cov_stats.txt", index=None, sep="\t",float_format="%.2f")
+    elif mode == 'viral_db':
+        full_table.to_csv(sample + "_" + read_size + "_top_scoring_targets_with_cov_stats_viral_db.txt", index=None, sep="\t",float_format="%.2f")
 
+    #per-stage wall time, cpu time, peak memory and file sizes of this sample
+    if mode == 'ncbi':
+        profiler.write(sample + "_" + read_size + "_covstats")
+    elif mode == 'viral_db':
+        profiler.write(sample + "_" + read_size + "_covstats_viral_db")
     
-    for refid, refspname in target_dict.items():
-        try:
-            print (refid)
-            print (refspname)
-            combinedid = str(refid + " " + refspname).replace("sp.","sp").replace(" ","_")
-
-            print("Extract sequence from blast database")
-            fastafile = (sample + "_" + read_size + "_" + combinedid + ".fa").replace(" ","_")
-            
-            if mode == "ncbi":
-                single_fasta_entry = open(fastafile, "w")
-                command_line = ["blastdbcmd","-db", blastdbpath, "-entry", refid, \
-                                "-outfmt","'%f'"]
-                subprocess.call(command_line, stdout=single_fasta_entry)
-
-                filesize = os.path.getsize(fastafile)
-
-                if filesize == 0:
-                    print("Retrieval from blast db failed")
-                    single_fasta_entry = open(fastafile, "w")
-                    p1 = subprocess.Popen(["esearch", "-db", "nucleotide", "-query", refid], stdout=subprocess.PIPE)
-                    p2 = subprocess.run(["efetch", "-format", "fasta"], stdin=p1.stdout, stdout=single_fasta_entry)
-                    single_fasta_entry.close()
-
-            elif mode == "viral_db":
-                #p1 = subprocess.Popen(["esearch", "-db", "nucleotide", "-query", refid], stdout=subprocess.PIPE)
-                #p2 = subprocess.run(["efetch", "-format", "fasta"], stdin=p1.stdout, stdout=single_fasta_entry)
-                #p1 = subprocess.Popen(["grep", "-A1", refid, blastdbpath], stdout=single_fasta_entry)
-                #single_fasta_entry.close()
-                
-                bowtie_index = ["grep", "-A1", refid, blastdbpath]
-                subprocess.call(bowtie_index, stdout=open(fastafile,"w"))
-
-            print("Building a bowtie index")
-            index=(sample + "_" + read_size + "_" + combinedid).replace(" ","_")
-            buildindex = ["bowtie-build","-f", fastafile, index]
-            subprocess.call(buildindex)
-
-            print("Aligning original reads")
-            samoutput = str(index + ".sam")
-            bowtie_output = str(index + "_bowtie_log.txt")
-            aligning = ["bowtie", "-q", "-v", "2", "-k", "1", "-p", cpus , "-x", index, fastqfiltbysize, "-S", samoutput]
-            subprocess.call(aligning, stderr=open(bowtie_output,"w"))
-
-            print("Derive a bam file")
-            bamoutput = str(index + ".bam")
-            derivebam = ["samtools", "view", "-@", cpus, "-bS", samoutput]
-            subprocess.call(derivebam, stdout=open(bamoutput,"w"))
-
-            subprocess.call(["rm","-r", samoutput])
-
-            print("Sorting bam file")
-            sortedbamoutput = str(index + ".sorted.bam")
-            sorting = ["samtools", "sort", "-@", cpus, bamoutput, "-o", sortedbamoutput]
-            subprocess.call(sorting)
-
-            print("Indexing bam file")
-            bamindex = str(index + ".sorted.bam.bai")
-            indexing = ["samtools", "index", sortedbamoutput]
-            subprocess.call(indexing, stdout=open(bamindex,"w"))
-
-            read_counts = ()
-            with open(bowtie_output) as bo:
-                a = " "
-                while(a):
-                    a = bo.readline()
-                    l = a.find("# reads with at least one alignment:") #Gives a non-negative value when there is a match
-                    if ( l >= 0 ):
-                        print(a)
-                        read_counts = a.split(" ")[7]
-            read_counts_dict[refspname] = read_counts
-
-            subprocess.call(["rm","-r", bamoutput])
-
-            #If data needs to be deduplicated
-            dedupbamoutput = str(index + ".dedup.bam")
-            umi_dedup_log = str(index + "_umi_tools.log")
-            dedupbamindex = str(index + ".dedup.bam.bai")
-            dedup_read_counts = ()
-            final_read_counts = ()
-            dup_pc = ()
-            finalbamoutput = ()
-            finalbamindex = ()
-            rpm = ()
-            fpkm = ()
-
-            if dedup == "true":
-                print("Deduping bam file")
-                umitools_dedup = ["umi_tools", "dedup", "-I", sortedbamoutput, "--method", "unique",  "-L", umi_dedup_log]
-                subprocess.call(umitools_dedup, stdout=open(dedupbamoutput,"w"))
-                
-                print("Indexing dedup bam file")
-                dedup_indexing = ["samtools", "index", dedupbamoutput]
-                subprocess.call(dedup_indexing, stdout=open(dedupbamindex,"w"))
-                p = run(["samtools", "view", "-c", "-F", "260", dedupbamoutput], stdout=PIPE, encoding='ascii')
-                
-                dedup_read_counts = int(p.stdout.replace("\n",""))
-                dedup_read_counts_dict[refspname] = dedup_read_counts
-                print(dedup_read_counts_dict)
-                
-                dup_pc = round(100-(int(dedup_read_counts)*100/int(read_counts)))
-                dup_pc_dict[refspname] = dup_pc
-                
-                read_counts_dedup_df = pd.DataFrame(dedup_read_counts_dict.items(),columns=["Species_updated", "dedup_read_count"]) 
-                dup_pc_df = pd.DataFrame(dup_pc_dict.items(),columns=["Species_updated", "duplication_rate"])
-                finalbamoutput = dedupbamoutput
-                finalbamindex = dedupbamindex
-                final_read_counts = dedup_read_counts            
-                
-                subprocess.call(["rm","-r", sortedbamoutput])
-                subprocess.call(["rm","-r", bamindex])
-
-            if dedup == "false":
-                finalbamoutput = sortedbamoutput
-                finalbamindex = bamindex
-                final_read_counts = read_counts
-
-            pileup = str(index + ".pileup")
-            derivepileup = ["samtools", "mpileup", "-uf", fastafile, finalbamoutput, "-o", pileup]
-            #subprocess.call(derivepileup, stdout=pileup)
-            subprocess.call(derivepileup)
-
-            #variant calling
-            vcfout = str(index + ".vcf.gz")
-            vcfcall = ["bcftools", "call", "-c", pileup, "-Oz", "-o", vcfout]
-            subprocess.call(vcfcall)
-            
-            vcfindex = ["bcftools", "index", vcfout]
-            subprocess.call(vcfindex)
-
-            # Normalise indels:
-            bcfnormout = str(index + "_norm.bcf")
-            bcfnorm = ["bcftools", "norm", "-f", fastafile, vcfout, "-Ob", "-o", bcfnormout]
-            subprocess.call(bcfnorm)
-            bcfnormoutindex = ["bcftools", "index", bcfnormout]
-            subprocess.call(bcfnormoutindex)
-
-            # Filter adjacent indels within 5bp
-            bcfnormoutfiltout = str(index + "_norm_flt_indels.bcf")
-            bcfnormoutfilt = ["bcftools", "filter", "--IndelGap", "5", bcfnormout, "-Ob", "-o", bcfnormoutfiltout]
-            subprocess.call(bcfnormoutfilt)
-            bcfnormoutfiltindex = ["bcftools", "index", bcfnormoutfiltout]
-            subprocess.call(bcfnormoutfiltindex)
-
-            # Convert bcf to vcf
-            vcfnormoutfiltout = str(index + "_sequence_variants.vcf.gz")
-            vcfnormoutfilt = ["bcftools", "view", "-Oz", "-o", vcfnormoutfiltout, bcfnormoutfiltout]
-            subprocess.call(vcfnormoutfilt)
-            vcfnormoutfiltindex = ["bcftools", "index", vcfnormoutfiltout]
-            subprocess.call(vcfnormoutfiltindex)
-
-            # Get consensus fasta file
-            genomecovbed = str(index + "_genome_cov.bed")
-            gencovcall = ["bedtools", "genomecov", "-ibam", finalbamoutput, "-bga"]
-            subprocess.call(gencovcall, stdout=open(genomecovbed,"w"))
-
-            # Assign N to nucleotide positions that have zero coverage
-            zerocovbed = str(index + "_zero_cov.bed")
-            zerocovcall = ["awk", "$4==0 {print}", genomecovbed]
-            subprocess.call(zerocovcall, stdout=open(zerocovbed,"w"))
 
-            maskedfasta = (sample + "_" + read_size + "_" + combinedid + "_masked.fa").replace(" ","_")
-            maskedfastaproc = ["bedtools", "maskfasta", "-fi",  fastafile, "-bed", zerocovbed, "-fo", maskedfasta]
-            subprocess.call(maskedfastaproc)
+def summary_table(final_data, target_dict, target_results, sample, mode):
+    #summary table of a sample: the blast results of each target (rows of final_data) followed by its metrics
+    #one row of metrics per target name, if several targets share a name the last value of each metric is kept
+    target_stats = OrderedDict()
+    for refspname, stats in zip(target_dict.values(), target_results):
+        target_stats.setdefault(refspname, {}).update(stats)
 
-            # Derive a consensus fasta file
-            consensus = str(index + ".consensus.fasta")
-            consensuscall = ["bcftools", "consensus", "-f",  maskedfasta, vcfout, "-o", consensus]
-            subprocess.call(consensuscall)
+    stat_columns = TARGET_STAT_COLUMNS
+    if not any("dedup_read_count" in stats for stats in target_stats.values()):
+        stat_columns = [column for column in TARGET_STAT_COLUMNS if column not in ("dedup_read_count", "duplication_rate")]
+    stats_df = pd.DataFrame([dict(stats, Species_updated=refspname) for refspname, stats in target_stats.items()], columns=["Species_updated"] + stat_columns)
 
-            consensus_seq = ""
-            with open(consensus, 'r') as f:
-                for line in f:
-                    if line[0] == ">":
-                        consensus_seq += line.strip()
-                        consensus_seq += ' '
-                    else:
-                        consensus_seq += line.strip()
-
-            consensus_seq = consensus_seq.replace('"', '')
-            consensus_dict[refspname] = consensus_seq
-            print(consensus_seq)
-
-            subprocess.call(["rm","-r", pileup])
-            subprocess.call(["rm","-r", vcfout])
-            subprocess.call(["rm","-r", genomecovbed])
-            subprocess.call(["rm","-r", zerocovbed])
-            subprocess.call(["rm","-r", maskedfasta])
-            subprocess.call(["rm","-r", bcfnormout])
-            subprocess.call(["rm","-r", bcfnormout + '.csi'])
-            subprocess.call(["rm","-r", bcfnormoutfiltout])
-            subprocess.call(["rm","-r", bcfnormoutfiltout + '.csi'])
-            
-
-            # Derive Picard statistics 
-            print("Running picard")
-            picard_output = (index + "_picard_metrics.txt")
-            picard = ["picard", "CollectWgsMetrics", "-I", str(finalbamoutput), "-O", str(picard_output), "-R", str(fastafile), "-READ_LENGTH","22", "-COUNT_UNPAIRED", "true"]
-            subprocess.call(picard)
-
-            reflen = ()
-            cov = ()
-            PCT_1X = ()
-            PCT_5X = ()
-            PCT_10X = ()
-            PCT_20X = ()
-            
-            with open(picard_output) as f:
-                a = " "
-                while(a):
-                    a = f.readline()
-                    l = a.find("MEAN_COVERAGE") #Gives a non-negative value when there is a match
-                    if ( l >= 0 ):
-                        line = f.readline()
-                        elements = line.split("\t")
-                        reflen, cov, PCT_1X, PCT_5X, PCT_10X, PCT_20X = elements[0], elements[1], elements[13], elements[14], elements[15],elements[17]
-            f.close()
-            cov_dict[refspname] = cov
-            PCT_1X_dict[refspname] = PCT_1X
-            PCT_5X_dict[refspname] = PCT_5X
-            PCT_10X_dict[refspname] = PCT_10X
-            PCT_20X_dict[refspname] = PCT_20X
-
-            fpkm = round(int(final_read_counts)/(int(reflen)/1000*int(rawfastq_read_counts)/1000000))
-            rpm = round(int(final_read_counts)*1000000/int(rawfastq_read_counts))
-
-            rpm_dict[refspname] = rpm
-            fpkm_dict[refspname] = fpkm
-
-            cov_df = pd.DataFrame(cov_dict.items(),columns=["Species_updated", "mean_read_depth"])
-            read_counts_df = pd.DataFrame(read_counts_dict.items(),columns=["Species_updated", "read_count"])
-            rpm_df = pd.DataFrame(rpm_dict.items(),columns=["Species_updated", "RPM"])
-            fpkm_df = pd.DataFrame(fpkm_dict.items(),columns=["Species_updated", "FPKM"])
-            PCT_1X_df = pd.DataFrame(PCT_1X_dict.items(),columns=["Species_updated", "PCT_1X"])
-            PCT_5X_df = pd.DataFrame(PCT_5X_dict.items(),columns=["Species_updated", "PCT_5X"])
-            PCT_10X_df = pd.DataFrame(PCT_10X_dict.items(),columns=["Species_updated", "PCT_10X"])
-            PCT_20X_df = pd.DataFrame(PCT_20X_dict.items(),columns=["Species_updated", "PCT_20X"])
-            consensus_df = pd.DataFrame(consensus_dict.items(),columns=["Species_updated", "consensus_fasta"])
-
-            project_files = glob(index + "*ebwt") + glob(index + ".vcf.gz*")
-            for fl in project_files:
-                subprocess.call(["rm","-r", fl])
-        except OSError as err:
-            print("OS error: {0}".format(err))
-
-    print("Deriving summary table with coverage statistics")
-
-    if read_counts_dedup_df.empty:
-        dfs = [final_data, cov_df, read_counts_df, rpm_df, fpkm_df, PCT_1X_df, PCT_5X_df, PCT_10X_df, PCT_20X_df, consensus_df]
-    else:
-        dfs = [final_data, cov_df, read_counts_df, read_counts_dedup_df, dup_pc_df, rpm_df, fpkm_df, PCT_1X_df, PCT_5X_df, PCT_10X_df, PCT_20X_df, consensus_df]
-
-    full_table = reduce(lambda left,right: pd.merge(left,right,on=["Species_updated"],how='outer'), dfs)
+    #the targets are the rows of final_data, a left merge keeps their order (an outer merge sorts them with pandas >= 2.2)
+    full_table = pd.merge(final_data, stats_df, on=["Species_updated"], how='left')
 
     full_table["mean_read_depth"] = full_table["mean_read_depth"].astype(float)
     full_table["PCT_1X"] = full_table["PCT_1X"].astype(float)
@@ -534,63 +290,271 @@ def cov_stats(blastdbpath, cpus, dedup, fastqfiltbysize, final_data, rawfastq, r
 
     if mode == 'ncbi':
         full_table = full_table.drop(["Species"], axis=1)
-        full_table = full_table.rename(columns={"Species_updated": "Species"})
-        full_table.to_csv(sample + "_" + read_size + "_top_scoring_targets_with_cov_stats.txt", index=None, sep="\t",float_format="%.2f")
-       
-    elif mode == 'viral_db':
-        full_table = full_table.rename(columns={"Species_updated": "Species"})
-        full_table.to_csv(sample + "_" + read_size + "_top_scoring_targets_with_cov_stats_viral_db.txt", index=None, sep="\t",float_format="%.2f")
-    
+    return full_table.rename(columns={"Species_updated": "Species"})
+
+def write_empty_cov_stats(path, target_columns, dedup):
+    #header of the summary table of a sample without any target, with the columns written by cov_stats
+    stat_columns = TARGET_STAT_COLUMNS
+    if dedup != "true":
+        stat_columns = [column for column in TARGET_STAT_COLUMNS if column not in ("dedup_read_count", "duplication_rate")]
+    with open(path, "w") as out:
+        out.write("\t".join(["Sample"] + target_columns + stat_columns) + "\n")
+
+def best_hits_per_contig(raw_data):
+    #Explode the comma separated contig names into one contig -> hit pair per line.
+    #If a contig hits multiple viruses and viroids, retain the hits with the highest naccs and,
+    #if there is a tie, the hits with the highest av-pident.
+    pairs = raw_data[["qseqids", "naccs", "av-pident"]].copy()
+    pairs["contig"] = pairs["qseqids"].astype(str).str.split(",")
+    pairs = pairs.explode("contig")
+    pairs["contig"] = pairs["contig"].str.strip()
+    pairs["row"] = pairs.index
+    pairs = pairs.drop_duplicates(subset=["row", "contig"])
+    pairs = pairs[pairs["naccs"] == pairs.groupby("contig")["naccs"].transform("max")]
+    pairs = pairs[pairs["av-pident"] == pairs.groupby("contig")["av-pident"].transform("max")]
+    return raw_data[raw_data.index.isin(pairs["row"])]
+
+def target_cov_stats(refid, refspname, threads, dedup, fastqfiltbysize, rawfastq_read_counts, read_size, sample, combined_bam=None, reference_cache=None, profiler=None, checkpoints=None):
+    #Align the reads to a single target and derive its coverage statistics and consensus sequence.
+    #All the files created are prefixed with the target name so several targets can be processed concurrently.
+    #If combined_bam is provided, the reads were already aligned to all the targets at once and the alignments
+    #of this target are extracted from it instead of building a dedicated bowtie index.
+    #The reference fasta file of the target is written beforehand by prepare_references.
+    #Each stage is recorded by the profiler with the target name.
+    #Once all the metrics are derived, they are saved with the output files of the target in the checkpoints.
+    stats = {}
+    if profiler is None:
+        profiler = Profiler(sample, read_size)
+    try:
+        print (refid)
+        print (refspname)
+        combinedid, fastafile, index = target_file_names(refid, refspname, read_size, sample)
+        sortedbamoutput = str(index + ".sorted.bam")
+        bamindex = str(index + ".sorted.bam.bai")
+
+        if combined_bam is None:
+            #reuse the bowtie index of the reference cache when available
+            with profiler.stage("bowtie_build", target=refspname, inputs=[fastafile]):
+                bowtie_index = reference_cache.bowtie_index(refid) if reference_cache is not None else None
+                if bowtie_index is None:
+                    print("Building a bowtie index")
+                    bowtie_index = index
+                    buildindex = ["bowtie-build","-f", fastafile, index]
+                    subprocess.call(buildindex)
+
+            print("Aligning original reads into a sorted and indexed bam file")
+            bowtie_output = str(index + "_bowtie_log.txt")
+            with profiler.stage("align", target=refspname, inputs=[fastqfiltbysize], outputs=[sortedbamoutput, bowtie_output]):
+                timings = align_to_sorted_bam(bowtie_index, fastqfiltbysize, sortedbamoutput, bowtie_output, threads)
+            print(format_timings(timings))
 
-def max_avpid(df):
-    max_row = df["av-pident"].max()
-    labels = np.where((df["av-pident"] == max_row),
-                    "1",
-                    "0")
-    return pd.DataFrame(labels, index=df.index).astype(int)
-
-def max_length(df):
-    max_row = df["length"].max()
-    labels = np.where((df["length"] == max_row),
-                        "2",
-                        "0")
-    return pd.DataFrame(labels, index=df.index).astype(int)
-
-def max_naccs(df):
-    max_row = df["naccs"].max()
-    labels = np.where((df["naccs"] == max_row),
-                        "1",
-                        "0")
-    return pd.DataFrame(labels, index=df.index).astype(int)
-
-def max_cov(df):
-    max_row = df["cov"].max()
-    labels = np.where((df["cov"] == max_row),
-                        "1",
-                        "0")
-    return pd.DataFrame(labels, index=df.index).astype(int)
-
-def completeness_score(x):
-    if "complete sequence" in str(x):
-        return 3
-    elif "complete genome" in str(x):
-        return 3
-    elif "polyprotein gene complete cds" in str(x):
-        return 3
-    elif "polyprotein 1 gene complete cds" in str(x):
-        return 3
-    elif "polyprotein 2 gene complete cds" in str(x):
-        return 3
-    elif "nearly complete sequence" in str(x):
-        return -3
-    if "partial" in str(x):
-        return -3
-    elif "polymerase protein" in str(x):
-        return -3
-    elif "RNA-dependent RNA polymerase" in str(x):
-        return -3
-    else:   
-        return 0
+            read_counts = bowtie_aligned_reads(bowtie_output)
+        else:
+            refname = read_fasta(fastafile)[0]
+            if refname is None:
+                print("No reference sequence retrieved for " + refid)
+                return stats
+
+            print("Extract alignments from the combined bam file")
+            with profiler.stage("split_combined_bam", target=refspname, inputs=[combined_bam], outputs=[sortedbamoutput]):
+                split_reference_bam(combined_bam, refname, sortedbamoutput)
+
+                print("Indexing bam file")
+                indexing = ["samtools", "index", sortedbamoutput]
+                subprocess.call(indexing, stdout=open(bamindex,"w"))
+
+                #a single alignment is kept per read so the number of mapped primary records equals the number of aligned reads
+                p = run(["samtools", "view", "-c", "-F", "260", sortedbamoutput], stdout=PIPE, encoding='ascii')
+                read_counts = p.stdout.replace("\n","")
+        stats["read_count"] = read_counts
+
+        #If data needs to be deduplicated
+        dedupbamoutput = str(index + ".dedup.bam")
+        umi_dedup_log = str(index + "_umi_tools.log")
+        dedupbamindex = str(index + ".dedup.bam.bai")
+        dedup_read_counts = ()
+        final_read_counts = ()
+        dup_pc = ()
+        finalbamoutput = ()
+        finalbamindex = ()
+        rpm = ()
+        fpkm = ()
+
+        if dedup == "true":
+            with profiler.stage("dedup", target=refspname, inputs=[sortedbamoutput], outputs=[dedupbamoutput]):
+                print("Deduping bam file")
+                umitools_dedup = ["umi_tools", "dedup", "-I", sortedbamoutput, "--method", "unique",  "-L", umi_dedup_log]
+                subprocess.call(umitools_dedup, stdout=open(dedupbamoutput,"w"))
+        
+                print("Indexing dedup bam file")
+                dedup_indexing = ["samtools", "index", dedupbamoutput]
+                subprocess.call(dedup_indexing, stdout=open(dedupbamindex,"w"))
+                p = run(["samtools", "view", "-c", "-F", "260", dedupbamoutput], stdout=PIPE, encoding='ascii')
+        
+                dedup_read_counts = int(p.stdout.replace("\n",""))
+                stats["dedup_read_count"] = dedup_read_counts
+                print(dedup_read_counts)
+        
+                dup_pc = duplication_rate(dedup_read_counts, read_counts)
+                if dup_pc is not None:
+                    stats["duplication_rate"] = dup_pc
+        
+            finalbamoutput = dedupbamoutput
+            finalbamindex = dedupbamindex
+            final_read_counts = dedup_read_counts            
+        
+            subprocess.call(["rm","-r", sortedbamoutput])
+            subprocess.call(["rm","-r", bamindex])
+
+        if dedup == "false":
+            finalbamoutput = sortedbamoutput
+            finalbamindex = bamindex
+            final_read_counts = read_counts
+
+        # Call the variants and derive a consensus fasta file, with positions that have zero coverage assigned to N
+        print("Deriving consensus sequence")
+        with profiler.stage("consensus", target=refspname, inputs=[finalbamoutput], outputs=[index + ".consensus.fasta"]):
+            refname, refseq = read_fasta(fastafile)
+            maskedfasta = (sample + "_" + read_size + "_" + combinedid + "_masked.fa").replace(" ","_")
+            consensus, timings = build_consensus(fastafile, finalbamoutput, index, maskedfasta, refname, refseq)
+            print(format_timings(timings))
+
+        consensus_seq = ""
+        with open(consensus, 'r') as f:
+            for line in f:
+                if line[0] == ">":
+                    consensus_seq += line.strip()
+                    consensus_seq += ' '
+                else:
+                    consensus_seq += line.strip()
+
+        consensus_seq = consensus_seq.replace('"', '')
+        stats["consensus_fasta"] = consensus_seq
+        print(consensus_seq)
+
+        # Derive coverage statistics (equivalent to picard CollectWgsMetrics)
+        print("Deriving coverage statistics")
+        with profiler.stage("coverage_metrics", target=refspname, inputs=[finalbamoutput]):
+            metrics = wgs_metrics(depth_array(finalbamoutput, refname, len(refseq), min_mapq=20, min_baseq=20), refseq)
+            write_metrics(metrics, index + "_coverage_metrics.txt")
+            reflen = metrics["GENOME_TERRITORY"]
+            stats["mean_read_depth"] = metrics["MEAN_COVERAGE"]
+            stats["PCT_1X"] = metrics["PCT_1X"]
+            stats["PCT_5X"] = metrics["PCT_5X"]
+            stats["PCT_10X"] = metrics["PCT_10X"]
+            stats["PCT_20X"] = metrics["PCT_20X"]
+
+        fpkm = round(int(final_read_counts)/(int(reflen)/1000*int(rawfastq_read_counts)/1000000))
+        rpm = round(int(final_read_counts)*1000000/int(rawfastq_read_counts))
+
+        stats["RPM"] = rpm
+        stats["FPKM"] = fpkm
+
+        project_files = glob(index + ".*ebwt") + glob(index + ".vcf.gz*")
+        for fl in project_files:
+            subprocess.call(["rm","-r", fl])
+
+        if checkpoints is not None:
+            checkpoints.save(refid, fastafile, stats, sorted(set(glob(index + ".*") + glob(index + "_*"))))
+    except Exception as err:
+        #a failure on one target leaves its coverage statistics empty instead of aborting the whole sample
+        print("Error deriving the coverage statistics of " + refid + ": {0}".format(err))
+        stats = {}
+    return stats
+
+def duplication_rate(dedup_read_counts, read_counts):
+    #percentage of duplicated reads, undefined for a target without any aligned read
+    if int(read_counts) == 0:
+        return None
+    return round(100-(int(dedup_read_counts)*100/int(read_counts)))
+
+def target_file_names(refid, refspname, read_size, sample):
+    combinedid = str(refid + " " + refspname).replace("sp.","sp").replace(" ","_")
+    fastafile = (sample + "_" + read_size + "_" + combinedid + ".fa").replace(" ","_")
+    index = (sample + "_" + read_size + "_" + combinedid).replace(" ","_")
+    return combinedid, fastafile, index
+
+def prepare_references(target_dict, blastdbpath, read_size, sample, mode, reference_cache=None, reference_fallback_fasta=None):
+    #Write the reference fasta file of each target and return the reference cache holding their bowtie indices.
+    #In ncbi mode, all the references are extracted from the blast database at once (or from the reference cache).
+    #In viral_db mode, the references are read from the indexed viral database fasta file (or from the reference cache).
+    if mode == "ncbi":
+        print("Extract sequences from blast database")
+        references = fetch_references(list(target_dict.keys()), blastdbpath, reference_cache, reference_fallback_fasta)
+    elif mode == "viral_db":
+        print("Extract sequences from the viral database")
+        reference_cache, references = fetch_viral_db_references(list(target_dict.keys()), blastdbpath, reference_cache)
+    for refid, refspname in target_dict.items():
+        combinedid, fastafile, index = target_file_names(refid, refspname, read_size, sample)
+        with open(fastafile, "w") as out:
+            out.write(references.get(refid, ""))
+    return reference_cache
+
+def combined_alignment(target_dict, cpus, fastqfiltbysize, read_size, sample):
+    #Gather all the target references into a single fasta file and align the reads once against all of them
+    combinedfasta = sample + "_" + read_size + "_combined_targets.fa"
+    seen = set()
+    with open(combinedfasta, "w") as out:
+        for refid, refspname in target_dict.items():
+            combinedid, fastafile, index = target_file_names(refid, refspname, read_size, sample)
+            #the same record can be retrieved for several targets, only index it once
+            keep = False
+            with open(fastafile, 'r') as f:
+                for line in f:
+                    line = line.replace("'", "")
+                    if line.startswith(">"):
+                        refname = line[1:].split()[0]
+                        keep = refname not in seen
+                        seen.add(refname)
+                    if keep and line.strip() not in ("", "--"):
+                        out.write(line)
+
+    print("Building a bowtie index for all targets")
+    index = sample + "_" + read_size + "_combined_targets"
+    buildindex = ["bowtie-build","-f", combinedfasta, index]
+    subprocess.call(buildindex)
+
+    print("Aligning original reads to all targets into a sorted and indexed bam file")
+    bowtie_output = str(index + "_bowtie_log.txt")
+    sortedbamoutput = str(index + ".sorted.bam")
+    #report all the alignments of each read, so a read matching several targets is counted for each of them
+    #as when the reads are aligned to each target separately
+    timings = align_to_sorted_bam(index, fastqfiltbysize, sortedbamoutput, bowtie_output, cpus, all_alignments=True)
+    print(format_timings(timings))
+
+    for fl in glob(index + ".*ebwt"):
+        subprocess.call(["rm","-r", fl])
+    return sortedbamoutput
+
+def reference_alignments(sam_lines, refname):
+    #header and alignment lines of the sam records of one reference
+    #The reads were aligned with -a, so only the first alignment of each read to this reference is kept, as bowtie -k 1
+    #reports a single alignment per read when the reads are aligned to this target alone
+    seen = set()
+    for line in sam_lines:
+        if line.startswith("@"):
+            if line.startswith("@SQ") and ("\tSN:" + refname + "\t") not in line:
+                continue
+        else:
+            fields = line.split("\t", 3)
+            if fields[2] != refname or fields[0] in seen:
+                continue
+            seen.add(fields[0])
+            #the kept alignment is the primary alignment of the read in the single target bam file
+            line = "\t".join([fields[0], str(int(fields[1]) & ~256)] + fields[2:])
+        yield line
+
+def split_reference_bam(combined_bam, refname, sortedbamoutput):
+    #Only keep the alignments and the @SQ header line of one reference so that downstream tools
+    #(mpileup, coverage statistics) see a bam file matching the single target fasta file.
+    #The region is given as {name} so that a reference name containing ':' is not parsed as name:start-end
+    view = subprocess.Popen(["samtools", "view", "-h", combined_bam, "{" + refname + "}"], stdout=PIPE, universal_newlines=True)
+    tobam = subprocess.Popen(["samtools", "view", "-b", "-o", sortedbamoutput, "-"], stdin=PIPE, universal_newlines=True)
+    for line in reference_alignments(view.stdout, refname):
+        tobam.stdin.write(line)
+    tobam.stdin.close()
+    check_returncode("samtools view", view.wait())
+    check_returncode("samtools view -b", tobam.wait())
 
 if __name__ == "__main__":
     main()
@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 import pandas as pd
-from functools import reduce
-import glob
+from table_loader import load_tables
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
@@ -9,18 +8,12 @@ import time
 import math
 
 timestr = time.strftime("%Y%m%d-%H%M%S")
-run_data = pd.DataFrame()
-iterator=int(0)
-
-for fl in glob.glob("*_read_length_dist.txt"):
-    sample = (fl.replace('_read_length_dist.txt', ''))
-    sample_data = pd.read_csv(fl, header=None, sep='\t',index_col=None)
-    sample_data.columns = ["length", sample]
-    if iterator == 0:
-        run_data = run_data.append(sample_data)
-    else:
-        run_data = pd.merge(run_data, sample_data, how="outer", on=["length"])
-    iterator += 1
+#number of reads of each read length of all the samples, one column per sample
+read_lengths = load_tables("*_read_length_dist.txt", dtypes={"length": "int64", "count": "int64"}, header=None, names=["length", "count"],
+                           sample_name=lambda fl: fl.replace('_read_length_dist.txt', ''))
+run_data = read_lengths.pivot(index="length", columns="Sample", values="count").reset_index()
+run_data.columns.name = None
+iterator = read_lengths["Sample"].nunique()
 print('total sample count is', iterator)
 
 #length = ()
@@ -0,0 +1,128 @@
+"""
+Parsers of the logs written by the tools of the pipeline (cutadapt, bowtie, umi_tools and
+fastp), shared by the QC report scripts and the coverage statistics.
+The patterns are compiled once, the fastp report is read as JSON, and the metrics of each
+file are cached by path, modification time and size so a log requested several times is
+only parsed once. A metric missing from a log is returned as None.
+"""
+
+import functools
+import json
+import os
+import re
+from collections import OrderedDict
+
+CUTADAPT_PATTERNS = OrderedDict([("reads_processed", re.compile(r"Total reads processed:\s+([\d,]+)")),
+                                ("reads_written", re.compile(r"Reads written \(passing filters\):\s+([\d,]+)"))])
+BOWTIE_PATTERNS = OrderedDict([("reads_processed", re.compile(r"# reads processed:\s+(\d+)")),
+                            ("reads_aligned", re.compile(r"# reads with at least one alignment:\s+(\d+)")),
+                            ("reads_failed", re.compile(r"# reads that failed to align:\s+(\d+)"))])
+UMI_TOOLS_PATTERNS = OrderedDict([("input_reads", re.compile(r"Input Reads:\s+(\d+)")),
+                                ("reads_output", re.compile(r"Reads output:\s+(\d+)"))])
+#header line of each alignment in the log of the RNA source profile: "<rnatype> alignment:"
+RNA_SOURCE_HEADER = re.compile(r"^(\S+) alignment:\s*$")
+
+_cache = {}
+
+
+def cached(parser):
+    #reuse the metrics of a file as long as it is not modified
+    #(functools.wraps keeps the parsers picklable, so they can be sent to a process pool)
+    @functools.wraps(parser)
+    def parse(path):
+        stat = os.stat(path)
+        key = (parser.__name__, os.path.abspath(path))
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if key not in _cache or _cache[key][0] != signature:
+            _cache[key] = (signature, parser(path))
+        return _cache[key][1]
+    return parse
+
+
+def search_patterns(lines, patterns):
+    #the last match of each pattern, as the number of reads without thousands separators
+    metrics = OrderedDict((name, None) for name in patterns)
+    for line in lines:
+        for name, pattern in patterns.items():
+            match = pattern.search(line)
+            if match:
+                metrics[name] = int(match.group(1).replace(",", ""))
+    return metrics
+
+
+@cached
+def parse_cutadapt_log(path):
+    with open(path, 'r') as f:
+        return search_patterns(f, CUTADAPT_PATTERNS)
+
+
+@cached
+def parse_bowtie_log(path):
+    with open(path, 'r') as f:
+        return search_patterns(f, BOWTIE_PATTERNS)
+
+
+@cached
+def parse_umi_tools_log(path):
+    with open(path, 'r') as f:
+        return search_patterns(f, UMI_TOOLS_PATTERNS)
+
+
+@cached
+def parse_fastp_json(path):
+    #bases and GC content of the reads passing the fastp filters
+    with open(path, 'r') as f:
+        after_filtering = json.load(f).get("summary", {}).get("after_filtering", {})
+    return OrderedDict((name, after_filtering.get(name)) for name in ("total_reads", "total_bases", "q20_bases", "q30_bases", "gc_content"))
+
+
+@cached
+def parse_rna_source_log(path):
+    #the first line is the sample name, followed by the bowtie log of each RNA type in the order of the alignments
+    #returns the sample name and the bowtie metrics of each RNA type
+    sections = OrderedDict()
+    with open(path, 'r') as f:
+        sample = f.readline().strip()
+        lines = []
+        rnatype = None
+        for line in f:
+            header = RNA_SOURCE_HEADER.match(line)
+            if header:
+                if rnatype is not None:
+                    sections[rnatype] = search_patterns(lines, BOWTIE_PATTERNS)
+                rnatype = header.group(1)
+                lines = []
+            else:
+                lines.append(line)
+        if rnatype is not None:
+            sections[rnatype] = search_patterns(lines, BOWTIE_PATTERNS)
+    return sample, sections
+
+
+@cached
+def parse_rna_source_counts(path):
+    #counts table written by rna_source_classify.py, returned like parse_rna_source_log
+    sections = OrderedDict()
+    sample = None
+    with open(path, 'r') as f:
+        columns = f.readline().rstrip("\n").split("\t")
+        for line in f:
+            row = dict(zip(columns, line.rstrip("\n").split("\t")))
+            sample = row["sample"]
+            sections[row["rnatype"]] = OrderedDict((name, int(row[name])) for name in BOWTIE_PATTERNS)
+    return sample, sections
+
+
+@cached
+def read_counts(path):
+    #number of reads processed (input) and written (output) by cutadapt or umi_tools
+    with open(path, 'r') as f:
+        lines = f.readlines()
+    cutadapt = search_patterns(lines, CUTADAPT_PATTERNS)
+    umi_tools = search_patterns(lines, UMI_TOOLS_PATTERNS)
+    counts = {"input": cutadapt["reads_processed"], "output": cutadapt["reads_written"]}
+    if counts["input"] is None:
+        counts["input"] = umi_tools["input_reads"]
+    if counts["output"] is None:
+        counts["output"] = umi_tools["reads_output"]
+    return counts
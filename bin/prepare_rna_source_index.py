@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+"""
+One-time preparation of the combined bowtie index used by rna_source_classify.py.
+The sequences of the bowtie index of each RNA type in the bowtie_db_dir are extracted with
+bowtie-inspect, their names are prefixed with the RNA type (<rnatype>|<name>) and they are
+indexed together.
+# prepare_rna_source_index.py --bowtie_db_dir /path_to_bowtie_idx_directory --out /path_to_bowtie_idx_directory/rna_source_combined
+"""
+
+import argparse
+import os
+import subprocess
+from alignment_utils import check_returncode
+from rna_source_classify import RNA_TYPES
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the combined bowtie index of all the RNA types of the RNA source profile")
+    parser.add_argument("--bowtie_db_dir", type=str, required=True)
+    parser.add_argument("--out", type=str, required=True)
+    parser.add_argument("--rnatypes", type=str, nargs="+", default=RNA_TYPES)
+    args = parser.parse_args()
+    bowtie_db_dir = args.bowtie_db_dir
+    out = args.out
+
+    combined_fasta = out + ".fa"
+    with open(combined_fasta, "wb") as fasta:
+        for rnatype in args.rnatypes:
+            print("Extracting the sequences of " + rnatype)
+            inspect = subprocess.Popen(["bowtie-inspect", os.path.join(bowtie_db_dir, rnatype)], stdout=subprocess.PIPE)
+            for line in inspect.stdout:
+                if line.startswith(b">"):
+                    line = b">" + rnatype.encode() + b"|" + line[1:]
+                fasta.write(line)
+            inspect.stdout.close()
+            check_returncode("bowtie-inspect", inspect.wait())
+
+    print("Building the combined bowtie index")
+    check_returncode("bowtie-build", subprocess.call(["bowtie-build", "-f", combined_fasta, out]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""
+One-time preparation of the viral database for the COVSTATS_VIRAL_DB step.
+Indexes the viral database fasta file for random access and prebuilds the bowtie index
+of each reference in the reference cache, keyed by accession and checksum of the viral
+database, so that the coverage statistics of each sample reuse them.
+# prepare_viral_db.py --viral_db /path_to_viral_DB/PVirDB_v1.fasta --reference_cache /path/to/reference_cache --cpus 8
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from reference_cache import ReferenceCache, load_viral_db_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index the viral database and prebuild the bowtie indices of its references")
+    parser.add_argument("--viral_db", type=str, required=True)
+    parser.add_argument("--reference_cache", type=str, required=True)
+    parser.add_argument("--accessions", type=str)
+    parser.add_argument("--cpus", type=int, default=1)
+    args = parser.parse_args()
+    dbpath = args.viral_db
+    cpus = args.cpus
+
+    #no size limit here, all the references of the viral database are kept
+    cache = ReferenceCache(args.reference_cache)
+    checksum, viral_db_index = load_viral_db_index(dbpath, cache)
+    cache = cache.namespace("viral_db_" + checksum)
+
+    if args.accessions is not None:
+        #only prepare the references listed in this file, one accession per line
+        with open(args.accessions, 'r') as f:
+            accessions = [line.strip() for line in f if line.strip()]
+    else:
+        accessions = viral_db_index.canonical_accessions()
+    print("Preparing " + str(len(accessions)) + " reference(s) of " + dbpath + " (checksum " + checksum + ")")
+
+    for accession, record in viral_db_index.fetch(accessions).items():
+        cache.add(accession, record)
+        #also register the accession without version, as reported in the sacc column of the blast results
+        cache.add(accession.split(".")[0], record)
+
+    with ThreadPoolExecutor(max_workers=max(1, cpus)) as executor:
+        indices = list(executor.map(cache.bowtie_index, accessions))
+    print("Built or reused " + str(sum(index is not None for index in indices)) + " bowtie indices")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""
+Run-level summary of the COVSTATS profiles written by filter_and_derive_stats.py
+(*_covstats*_profile.tsv): time and memory spent in each stage across all the samples,
+and the targets that took the longest to process.
+# profile_summary.py --read_size 21-22 --top 20
+"""
+
+import argparse
+import glob
+import pandas as pd
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarise the per-stage profiles of the COVSTATS steps")
+    parser.add_argument("--read_size", type=str, required=True)
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+    read_size = args.read_size
+    top = args.top
+
+    profiles = [pd.read_csv(profile, header=0, index_col=None, sep="\t", keep_default_na=False) for profile in sorted(glob.glob("*_profile.tsv"))]
+    if len(profiles) == 0:
+        print("No profile found")
+        exit ()
+    profile_df = pd.concat(profiles, ignore_index=True)
+
+    stage_df = profile_df.groupby("stage", sort=False).agg(samples=("sample", "nunique"),
+                                                           calls=("stage", "size"),
+                                                           errors=("status", lambda status: (status == "error").sum()),
+                                                           wall_time_h=("wall_time_s", "sum"),
+                                                           cpu_time_h=("cpu_time_s", "sum"),
+                                                           max_wall_time_s=("wall_time_s", "max"),
+                                                           max_peak_rss_mb=("peak_rss_mb", "max"),
+                                                           input_mb=("input_mb", "sum"),
+                                                           output_mb=("output_mb", "sum")).reset_index()
+    stage_df["wall_time_h"] = stage_df["wall_time_h"] / 3600
+    stage_df["cpu_time_h"] = stage_df["cpu_time_h"] / 3600
+    stage_df["pct_wall_time"] = 100 * stage_df["wall_time_h"] / stage_df["wall_time_h"].sum()
+    stage_df = stage_df.sort_values("wall_time_h", ascending=False)
+    print(stage_df)
+    stage_df.to_csv("VirReport_covstats_profile_summary_" + read_size + ".txt", index=None, sep="\t", float_format="%.3f")
+
+    target_df = profile_df[profile_df["target"] != ""]
+    target_df = target_df.groupby(["sample", "target"]).agg(wall_time_s=("wall_time_s", "sum"),
+                                                           cpu_time_s=("cpu_time_s", "sum"),
+                                                           peak_rss_mb=("peak_rss_mb", "max")).reset_index()
+    target_df = target_df.sort_values("wall_time_s", ascending=False).head(top)
+    target_df.to_csv("VirReport_covstats_profile_slowest_targets_" + read_size + ".txt", index=None, sep="\t", float_format="%.3f")
+
+
+if __name__ == "__main__":
+    main()
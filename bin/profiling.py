@@ -0,0 +1,80 @@
+"""
+Instrumentation of the stages of a script: wall time, CPU time (of the script and of the
+subprocesses it waited for), peak RSS, sizes of the input and output files and target of
+each stage, written as a TSV and a JSON profile.
+CPU time and peak RSS are measured with getrusage for the whole process, so they overlap
+when several targets are processed concurrently, and the peak RSS is the high-water mark
+of the process and its subprocesses at the end of the stage.
+"""
+
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+PROFILE_COLUMNS = ["sample", "read_size", "stage", "target", "status", "wall_time_s", "cpu_time_s", "peak_rss_mb", "input_mb", "output_mb"]
+
+
+def cpu_time():
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage_self.ru_utime + usage_self.ru_stime + usage_children.ru_utime + usage_children.ru_stime
+
+
+def peak_rss_mb():
+    #ru_maxrss is in kilobytes on linux
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+def files_size_mb(paths):
+    total = 0
+    for path in paths:
+        if path and os.path.isfile(path):
+            total += os.path.getsize(path)
+    return total / 1024**2
+
+
+class Profiler(object):
+    def __init__(self, sample, read_size):
+        self.sample = sample
+        self.read_size = read_size
+        self.records = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, target="", inputs=(), outputs=()):
+        input_mb = files_size_mb(inputs)
+        start_wall = time.time()
+        start_cpu = cpu_time()
+        status = "ok"
+        try:
+            yield
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            record = {"sample": self.sample,
+                    "read_size": self.read_size,
+                    "stage": name,
+                    "target": target,
+                    "status": status,
+                    "wall_time_s": round(time.time() - start_wall, 3),
+                    "cpu_time_s": round(cpu_time() - start_cpu, 3),
+                    "peak_rss_mb": round(peak_rss_mb(), 1),
+                    "input_mb": round(input_mb, 3),
+                    "output_mb": round(files_size_mb(outputs), 3)}
+            with self.lock:
+                self.records.append(record)
+
+    def write(self, prefix):
+        #<prefix>_profile.tsv and <prefix>_profile.json
+        with self.lock:
+            records = list(self.records)
+        with open(prefix + "_profile.tsv", "w") as out:
+            out.write("\t".join(PROFILE_COLUMNS) + "\n")
+            for record in records:
+                out.write("\t".join(str(record[column]) for column in PROFILE_COLUMNS) + "\n")
+        with open(prefix + "_profile.json", "w") as out:
+            json.dump(records, out, indent=1)
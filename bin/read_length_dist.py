@@ -1,58 +1,149 @@
 #!/usr/bin/env python
 
 """
-This script will output read length distribution graph,
-text file with counts table of unique read length and
-fasta file of reads of wanted length specified with minlen and maxlen
-# read_length_dist.py --input seqs.fasta --minlen 21 --maxlen 22
+This script will output read length distribution graph and
+text file with counts table of unique read length.
+The reads of a fasta file (default), a fastq file (--fastq) or collapsed reads (--collapsed,
+see collapse_reads.py), plain or gzipped, are read in large chunks and their lengths are
+counted in a fixed size histogram, so the memory used does not depend on the number of reads.
+# read_length_dist.py --input seqs.fasta
+# read_length_dist.py --input sample_quality_trimmed.fastq --fastq
+# read_length_dist.py --input sample_collapsed_reads.tsv.gz --collapsed
 """
 
 ###############################################################################
 # Modules #
-import argparse, sys, time, getpass, locale
+import argparse, sys
 from argparse import RawTextHelpFormatter
-from Bio import SeqIO
 import numpy as np
+from fastq_utils import open_fastq, CHUNK_SIZE
+from collapsed_reads import collapsed_length_counts
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-from matplotlib.ticker import (MultipleLocator, FormatStrFormatter,
-                               AutoMinorLocator)
+
+#initial size of the histogram, enlarged if longer reads are found
+MAX_LENGTH = 1024
 
 ################################################################################
 
-parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter)
-parser.add_argument("--input", help="The fasta file to process", type=str)
-args        = parser.parse_args()
-input_path  = args.input
-lengths = list(map(len, SeqIO.parse(input_path, 'fasta')))
-sys.stderr.write("Read all lengths (%i sequences)\n" % len(lengths))
-sys.stderr.write("Longest sequence: %i bp\n" % max(lengths))
-sys.stderr.write("Shortest sequence: %i bp\n" % min(lengths))
-
-
-sys.stderr.write("Deriving read length distribution\n")
-sample = (args.input).replace(".rename.fa", "")
-print(sample)
-#build array to store all read lengths
-arr = np.array(lengths)
-#return counts for read lengths
-u, c = np.unique(np.array(lengths), return_counts=True)
-with open('%s_read_length_dist.txt' % sample, 'w') as f:
-    np.savetxt(f, np.stack([u, c]).T,delimiter='\t', fmt='%12s')
-
-sys.stderr.write("Making graph...\n")
-
-fig = plt.figure(figsize=(20, 5))
-labels, counts = np.unique(arr, return_counts=True)
-plt.bar(labels, counts, color='green', align='center', width=0.5)
-formatter = matplotlib.ticker.ScalarFormatter()
-formatter.set_powerlimits((-6,9))
-plt.gca().yaxis.set_major_formatter(formatter)
-plt.gca().set_xticks(labels)
-plt.xticks(rotation='vertical')
-plt.title(sample)
-plt.xlabel('read length (bp)')
-plt.ylabel('# of reads')
-plt.savefig('%s_read_length_dist.pdf' % sample, format='pdf')
-plt.savefig('%s_read_length_dist.png' % sample, format='png')
\ No newline at end of file
+
+class LengthHistogram(object):
+    #number of reads of each read length
+    def __init__(self, max_length=MAX_LENGTH):
+        self.counts = np.zeros(max_length + 1, dtype=np.int64)
+
+    def add(self, lengths, weights=None):
+        lengths = np.asarray(lengths, dtype=np.int64)
+        if lengths.size == 0:
+            return
+        longest = int(lengths.max())
+        if longest >= self.counts.size:
+            self.counts = np.concatenate([self.counts, np.zeros(longest + 1 - self.counts.size, dtype=np.int64)])
+        self.counts += np.bincount(lengths, weights=weights, minlength=self.counts.size).astype(np.int64)
+
+    def distribution(self):
+        #read lengths found and their number of reads
+        lengths = np.flatnonzero(self.counts)
+        return lengths, self.counts[lengths]
+
+
+def read_lines(path):
+    #yields the complete lines of each chunk of a plain or gzipped file, without their line ending
+    remainder = b""
+    with open_fastq(path) as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            lines = (remainder + chunk).split(b"\n")
+            remainder = lines.pop()
+            if b"\r" in chunk:
+                lines = [line.rstrip(b"\r") for line in lines]
+            yield lines
+    if remainder:
+        yield [remainder.rstrip(b"\r")]
+
+
+def fastq_length_histogram(path):
+    histogram = LengthHistogram()
+    #the sequence is the second line of each record, the records may span chunks
+    line_number = 0
+    for lines in read_lines(path):
+        first_sequence = (1 - line_number) % 4
+        histogram.add(np.fromiter(map(len, lines[first_sequence::4]), dtype=np.int64))
+        line_number += len(lines)
+    return histogram
+
+
+def fasta_length_histogram(path):
+    histogram = LengthHistogram()
+    #the sequence of a record may be split over several lines
+    length = None
+    for lines in read_lines(path):
+        lengths = []
+        for line in lines:
+            if line.startswith(b">"):
+                if length is not None:
+                    lengths.append(length)
+                length = 0
+            elif length is not None:
+                length += len(line.strip())
+        histogram.add(lengths)
+    if length is not None:
+        histogram.add([length])
+    return histogram
+
+
+def collapsed_length_histogram(path):
+    histogram = LengthHistogram()
+    length_counts = collapsed_length_counts(path)
+    histogram.add(list(length_counts.keys()), weights=list(length_counts.values()))
+    return histogram
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter)
+    parser.add_argument("--input", help="The fasta file to process", type=str)
+    input_format = parser.add_mutually_exclusive_group()
+    input_format.add_argument("--fastq", help="The input is a fastq file", action="store_true")
+    input_format.add_argument("--collapsed", help="The input holds collapsed reads", action="store_true")
+    args        = parser.parse_args()
+    input_path  = args.input
+    if args.fastq:
+        histogram = fastq_length_histogram(input_path)
+    elif args.collapsed:
+        histogram = collapsed_length_histogram(input_path)
+    else:
+        histogram = fasta_length_histogram(input_path)
+    u, c = histogram.distribution()
+    sys.stderr.write("Read all lengths (%i sequences)\n" % c.sum())
+    if u.size > 0:
+        sys.stderr.write("Longest sequence: %i bp\n" % u.max())
+        sys.stderr.write("Shortest sequence: %i bp\n" % u.min())
+
+
+    sys.stderr.write("Deriving read length distribution\n")
+    sample = (args.input).replace(".rename.fa", "")
+    print(sample)
+    with open('%s_read_length_dist.txt' % sample, 'w') as f:
+        np.savetxt(f, np.stack([u, c]).T,delimiter='\t', fmt='%12s')
+
+    sys.stderr.write("Making graph...\n")
+
+    fig = plt.figure(figsize=(20, 5))
+    plt.bar(u, c, color='green', align='center', width=0.5)
+    formatter = matplotlib.ticker.ScalarFormatter()
+    formatter.set_powerlimits((-6,9))
+    plt.gca().yaxis.set_major_formatter(formatter)
+    plt.gca().set_xticks(u)
+    plt.xticks(rotation='vertical')
+    plt.title(sample)
+    plt.xlabel('read length (bp)')
+    plt.ylabel('# of reads')
+    plt.savefig('%s_read_length_dist.pdf' % sample, format='pdf')
+    plt.savefig('%s_read_length_dist.png' % sample, format='png')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+"""
+Retrieval of the target reference sequences for the coverage statistics.
+In ncbi mode all the accessions are extracted from the blast database with a single
+blastdbcmd -entry_batch call. Accessions missing from the blast database are retrieved
+with esearch/efetch, or from a local fasta file standing in for NCBI.
+In viral_db mode the records are read from the viral database fasta file through an index
+of the file offset of each record.
+References can be kept in a persistent cache shared across samples and runs:
+<cache_dir>/objects/<sha1>/reference.fa (and its bowtie index reference.*.ebwt), stored once per sequence content
+<cache_dir>/accessions/<namespace>/<accession> holds the sha1 of the reference of this accession,
+the namespace is ncbi or viral_db_<sha1 of the viral database fasta file>
+<cache_dir>/viral_db/<sha1>.idx offsets of the records of a viral database fasta file
+Entries are written to a temporary directory and renamed so concurrent processes never see
+partial files. Once per run, the least recently used entries are evicted when the cache exceeds its
+maximum size (reference_cache_evict.py), sparing the entries used within a grace period as they may
+still be in use by another sample or run.
+"""
+
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+
+def accession_keys(header):
+    #names under which a fasta record can be requested: accession with and without version
+    keys = set()
+    fields = header.lstrip(">").split()
+    if len(fields) == 0:
+        return keys
+    for token in fields[0].split("|"):
+        if token:
+            keys.add(token)
+            keys.add(token.split(".")[0])
+    return keys
+
+
+def parse_fasta_records(text):
+    #return a list of (header, fasta record text)
+    records = []
+    header = None
+    lines = []
+    for line in text.splitlines():
+        line = line.strip().replace("'", "")
+        if not line or line == "--":
+            continue
+        if line.startswith(">"):
+            if header is not None:
+                records.append((header, "\n".join(lines) + "\n"))
+            header = line
+            lines = [line]
+        elif header is not None:
+            lines.append(line)
+    if header is not None:
+        records.append((header, "\n".join(lines) + "\n"))
+    return records
+
+
+def match_records(accessions, records):
+    #map each requested accession to the first record whose name matches it
+    by_key = {}
+    for header, record in records:
+        for key in accession_keys(header):
+            by_key.setdefault(key, record)
+    found = {}
+    for accession in accessions:
+        record = by_key.get(accession, by_key.get(accession.split(".")[0]))
+        if record is not None:
+            found[accession] = record
+    return found
+
+
+def blastdb_batch(accessions, blastdbpath):
+    #extract all the accessions from the blast database in a single blastdbcmd call
+    if len(accessions) == 0:
+        return {}
+    with tempfile.NamedTemporaryFile("w", suffix=".entries", dir=".", delete=False) as f:
+        f.write("\n".join(accessions) + "\n")
+        entry_batch = f.name
+    command_line = ["blastdbcmd", "-db", blastdbpath, "-entry_batch", entry_batch, "-target_only", "-outfmt", "%f"]
+    p = subprocess.run(command_line, stdout=subprocess.PIPE, universal_newlines=True)
+    os.remove(entry_batch)
+    return match_records(accessions, parse_fasta_records(p.stdout))
+
+
+def fallback_fetch(accession, fallback_fasta=None):
+    #retrieve an accession missing from the blast database from NCBI, or from a local fasta file standing in for NCBI
+    if fallback_fasta is not None:
+        with open(fallback_fasta, 'r') as f:
+            return match_records([accession], parse_fasta_records(f.read())).get(accession)
+    p1 = subprocess.Popen(["esearch", "-db", "nucleotide", "-query", accession], stdout=subprocess.PIPE)
+    p2 = subprocess.run(["efetch", "-format", "fasta"], stdin=p1.stdout, stdout=subprocess.PIPE, universal_newlines=True)
+    p1.wait()
+    records = parse_fasta_records(p2.stdout)
+    if len(records) == 0:
+        return None
+    return records[0][1]
+
+
+def fetch_references(accessions, blastdbpath, cache=None, fallback_fasta=None):
+    #return a dictionary of accession -> fasta record text, only retrieving the accessions missing from the cache
+    references = {}
+    missing = []
+    for accession in accessions:
+        record = cache.lookup(accession) if cache is not None else None
+        if record is not None:
+            references[accession] = record
+        else:
+            missing.append(accession)
+    if cache is not None:
+        print(str(len(references)) + " reference(s) found in the cache, " + str(len(missing)) + " to retrieve")
+
+    retrieved = blastdb_batch(missing, blastdbpath)
+    for accession in missing:
+        if accession not in retrieved:
+            print("Retrieval of " + accession + " from blast db failed")
+            record = fallback_fetch(accession, fallback_fasta)
+            if record is not None:
+                retrieved[accession] = record
+    for accession, record in retrieved.items():
+        if cache is not None:
+            cache.add(accession, record)
+        references[accession] = record
+    return references
+
+
+def file_checksum(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(16 * 1024 * 1024), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def index_fasta_offsets(fasta):
+    #single pass over the fasta file recording the header and file offset of each record
+    offsets = []
+    offset = 0
+    with open(fasta, 'rb') as f:
+        for line in f:
+            if line.startswith(b">"):
+                offsets.append((offset, line.strip().decode()))
+            offset += len(line)
+    return offsets
+
+
+def read_fasta_record(f, offset):
+    #return the fasta record starting at offset of a file opened in binary mode
+    f.seek(offset)
+    lines = [f.readline().decode()]
+    for line in f:
+        if line.startswith(b">"):
+            break
+        if line.strip():
+            lines.append(line.decode())
+    return "".join(line.rstrip("\r\n") + "\n" for line in lines)
+
+
+class ViralDbIndex(object):
+    #random access to the records of the viral database fasta file, by accession
+    def __init__(self, dbpath, offsets):
+        self.dbpath = dbpath
+        self.offsets = offsets
+        self.by_key = {}
+        for offset, header in offsets:
+            for key in accession_keys(header):
+                self.by_key.setdefault(key, offset)
+
+    def find(self, accession):
+        offset = self.by_key.get(accession, self.by_key.get(accession.split(".")[0]))
+        if offset is None:
+            #same as the former grep on the whole header line
+            for record_offset, header in self.offsets:
+                if accession in header:
+                    return record_offset
+        return offset
+
+    def fetch(self, accessions):
+        #return a dictionary of accession -> fasta record text
+        records = {}
+        with open(self.dbpath, 'rb') as f:
+            for accession in accessions:
+                offset = self.find(accession)
+                if offset is not None:
+                    records[accession] = read_fasta_record(f, offset)
+        return records
+
+    def canonical_accessions(self):
+        #accession (first word of the header) of each record
+        return [header.lstrip(">").split()[0] for offset, header in self.offsets if header.lstrip(">").split()]
+
+
+def load_viral_db_index(dbpath, cache=None):
+    #return the checksum of the viral database and its index, reusing the index stored in the cache
+    #when the viral database file is unchanged (same path, size and modification time)
+    if cache is None:
+        return None, ViralDbIndex(dbpath, index_fasta_offsets(dbpath))
+    viral_db_dir = os.path.join(cache.cache_dir, "viral_db")
+    os.makedirs(viral_db_dir, exist_ok=True)
+    stat = os.stat(dbpath)
+    source = "\t".join([os.path.realpath(dbpath), str(stat.st_size), str(int(stat.st_mtime))])
+    source_path = os.path.join(viral_db_dir, hashlib.sha1(os.path.realpath(dbpath).encode()).hexdigest() + ".source")
+    checksum = None
+    try:
+        with open(source_path, 'r') as f:
+            stored_source, stored_checksum = f.read().rstrip("\n").rsplit("\t", 1)
+        if stored_source == source:
+            checksum = stored_checksum
+    except (OSError, ValueError):
+        pass
+    if checksum is None:
+        print("Computing the checksum of " + dbpath)
+        checksum = file_checksum(dbpath)
+    index_path = os.path.join(viral_db_dir, checksum + ".idx")
+    offsets = []
+    if os.path.exists(index_path):
+        with open(index_path, 'r') as f:
+            for line in f:
+                offset, header = line.rstrip("\n").split("\t", 1)
+                offsets.append((int(offset), header))
+    else:
+        print("Indexing " + dbpath)
+        offsets = index_fasta_offsets(dbpath)
+        cache.write_atomic(index_path, "".join(str(offset) + "\t" + header + "\n" for offset, header in offsets))
+    cache.write_atomic(source_path, source + "\t" + checksum + "\n")
+    return checksum, ViralDbIndex(dbpath, offsets)
+
+
+def fetch_viral_db_references(accessions, dbpath, cache=None):
+    #return the cache holding the references of this viral database (None without cache) and a
+    #dictionary of accession -> fasta record text, only reading the accessions missing from the cache
+    checksum, viral_db_index = load_viral_db_index(dbpath, cache)
+    if cache is not None:
+        cache = cache.namespace("viral_db_" + checksum)
+    references = {}
+    missing = []
+    for accession in accessions:
+        record = cache.lookup(accession) if cache is not None else None
+        if record is not None:
+            references[accession] = record
+        else:
+            missing.append(accession)
+    for accession, record in viral_db_index.fetch(missing).items():
+        if cache is not None:
+            cache.add(accession, record)
+        references[accession] = record
+    for accession in accessions:
+        if accession not in references:
+            print("Retrieval of " + accession + " from the viral database failed")
+    return cache, references
+
+
+class ReferenceCache(object):
+    def __init__(self, cache_dir, max_bytes=None, namespace="ncbi"):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.objects_dir = os.path.join(cache_dir, "objects")
+        self.accessions_dir = os.path.join(cache_dir, "accessions", namespace)
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.accessions_dir, exist_ok=True)
+
+    def namespace(self, namespace):
+        #view of the same cache with the accessions of another database
+        return ReferenceCache(self.cache_dir, self.max_bytes, namespace)
+
+    def _accession_path(self, accession):
+        return os.path.join(self.accessions_dir, accession.replace(os.sep, "_"))
+
+    def _object_dir(self, accession):
+        try:
+            with open(self._accession_path(accession), 'r') as f:
+                digest = f.read().strip()
+        except OSError:
+            return None
+        object_dir = os.path.join(self.objects_dir, digest)
+        if not os.path.exists(os.path.join(object_dir, "reference.fa")):
+            return None
+        return object_dir
+
+    def _touch(self, object_dir):
+        #the modification time of an entry records when it was last used, for the eviction
+        now = time.time()
+        try:
+            os.utime(object_dir, (now, now))
+        except OSError:
+            pass
+
+    def write_atomic(self, path, text):
+        #write a file of the cache through a temporary file so concurrent processes never read it partially
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp_")
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+    def lookup(self, accession):
+        object_dir = self._object_dir(accession)
+        if object_dir is None:
+            return None
+        self._touch(object_dir)
+        with open(os.path.join(object_dir, "reference.fa"), 'r') as f:
+            return f.read()
+
+    def add(self, accession, record):
+        digest = hashlib.sha1(record.encode()).hexdigest()
+        object_dir = os.path.join(self.objects_dir, digest)
+        if not os.path.exists(object_dir):
+            tmp_dir = tempfile.mkdtemp(dir=self.objects_dir, prefix=".tmp_")
+            with open(os.path.join(tmp_dir, "reference.fa"), "w") as f:
+                f.write(record)
+            try:
+                os.rename(tmp_dir, object_dir)
+            except OSError:
+                #another process stored the same reference in the meantime
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        self._touch(object_dir)
+        self.write_atomic(self._accession_path(accession), digest + "\n")
+        return object_dir
+
+    def bowtie_index(self, accession):
+        #return the prefix of the bowtie index of a cached reference, building it the first time it is used
+        object_dir = self._object_dir(accession)
+        if object_dir is None:
+            return None
+        index = os.path.join(object_dir, "reference")
+        if not os.path.exists(index + ".1.ebwt"):
+            tmp_dir = tempfile.mkdtemp(dir=object_dir, prefix=".tmp_")
+            subprocess.call(["bowtie-build", "-q", "-f", os.path.join(object_dir, "reference.fa"), os.path.join(tmp_dir, "reference")])
+            #the .1.ebwt file is moved last as it marks the index as complete
+            for fl in sorted(os.listdir(tmp_dir), key=lambda fl: fl == "reference.1.ebwt"):
+                os.replace(os.path.join(tmp_dir, fl), os.path.join(object_dir, fl))
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self._touch(object_dir)
+        return index
+
+    def size(self, object_dir):
+        total = 0
+        for root, dirs, files in os.walk(object_dir):
+            for fl in files:
+                total += os.path.getsize(os.path.join(root, fl))
+        return total
+
+    def evict(self, grace_seconds=24 * 3600):
+        #remove the least recently used references until the cache fits within max_bytes.
+        #The references used within the grace period are kept whatever the size of the cache,
+        #as the samples of this run or of a concurrent run may still be aligning reads to them.
+        if self.max_bytes is None:
+            return
+        entries = []
+        total = 0
+        for digest in os.listdir(self.objects_dir):
+            object_dir = os.path.join(self.objects_dir, digest)
+            if digest.startswith(".tmp_") or not os.path.isdir(object_dir):
+                continue
+            size = self.size(object_dir)
+            total += size
+            entries.append((os.path.getmtime(object_dir), object_dir, size))
+        for mtime, object_dir, size in sorted(entries):
+            if total <= self.max_bytes or mtime > time.time() - grace_seconds:
+                break
+            print("Evicting " + os.path.basename(object_dir) + " from the reference cache")
+            shutil.rmtree(object_dir, ignore_errors=True)
+            total -= size
+        #drop the accessions pointing to evicted references
+        for accession in os.listdir(self.accessions_dir):
+            if self._object_dir(accession) is None and not accession.startswith(".tmp_"):
+                try:
+                    os.remove(self._accession_path(accession))
+                except OSError:
+                    pass
@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+"""
+Eviction of the least recently used references of the reference cache, run once at the end of
+the COVSTATS steps of a run rather than by each sample.
+References used within the grace period are kept, as another run sharing the cache may be using them.
+# reference_cache_evict.py --reference_cache /path/to/reference_cache --max_gb 20 --grace_hours 24
+"""
+
+import argparse
+from reference_cache import ReferenceCache
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evict the least recently used references of the reference cache")
+    parser.add_argument("--reference_cache", type=str, required=True)
+    parser.add_argument("--max_gb", type=float, default=20)
+    parser.add_argument("--grace_hours", type=float, default=24)
+    args = parser.parse_args()
+
+    cache = ReferenceCache(args.reference_cache, int(args.max_gb * 1024**3))
+    cache.evict(grace_seconds=args.grace_hours * 3600)
+
+
+if __name__ == "__main__":
+    main()
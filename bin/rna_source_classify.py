@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+"""
+RNA source profile of a sample in a single alignment step: the reads are collapsed into
+distinct sequences, aligned once (bowtie -v 1 -k --max_alignments) against the combined index
+of all the RNA types built by prepare_rna_source_index.py, and each read is assigned to the
+first RNA type it aligns to, in the order of --rnatypes. The alignments of repetitive sequences
+(e.g. rRNA) are capped at --max_alignments, so the few sequences reaching the cap without aligning
+to the first RNA type are aligned again to the index of each RNA type of the --bowtie_db_dir in turn.
+This gives the same counts as aligning the reads to each RNA type in turn and only passing the
+reads that failed to align to the next one.
+The reads are given as a fastq file or as the collapsed reads of the sample (collapse_reads.py),
+only keeping the collapsed sequences of at least --min_length nt.
+Writes <sample>_rna_source_counts.tsv (reads processed, aligned and failed to align for
+each RNA type) and a <sample>_bowtie.log in the format of the successive bowtie logs.
+# rna_source_classify.py --fastq sample_quality_trimmed.fastq --sample sample --index /path/to/bowtie_db_dir/rna_source_combined --bowtie_db_dir /path/to/bowtie_db_dir --cpus 4
+# rna_source_classify.py --collapsed sample_collapsed_reads.tsv.gz --min_length 15 --sample sample --index /path/to/bowtie_db_dir/rna_source_combined --bowtie_db_dir /path/to/bowtie_db_dir --cpus 4
+"""
+
+import argparse
+import os
+import subprocess
+import numpy as np
+from alignment_utils import check_returncode
+from collapsed_reads import collapse_fastq, read_collapsed, write_collapsed_fasta, collapsed_index
+
+RNA_TYPES = ["rRNA", "miRNA", "plant_tRNA", "plant_pt_mt_other_genes", "plant_noncoding", "artefacts", "plant_virus_viroid"]
+RNA_SOURCE_COLUMNS = ["sample", "rnatype", "reads_processed", "reads_aligned", "reads_failed"]
+MAX_ALIGNMENTS = 20
+
+
+def classify(collapsed_fasta, n_sequences, index, rnatypes, cpus, max_alignments=MAX_ALIGNMENTS):
+    #rank (in rnatypes) of the first RNA type each collapsed sequence aligns to, len(rnatypes) if none, and the
+    #sequences whose alignments reached max_alignments, which may also align to a RNA type ranked before
+    unassigned = len(rnatypes)
+    ranks = np.full(n_sequences, unassigned, dtype=np.uint8)
+    reported = np.zeros(n_sequences, dtype=np.int64)
+    rank_of = {rnatype.encode(): rank for rank, rnatype in enumerate(rnatypes)}
+    #only report the read name and the reference name of each alignment
+    aligning = subprocess.Popen(["bowtie", "-f", "-v", "1", "-k", str(max_alignments), "-p", str(cpus), "--suppress", "2,4,5,6,7,8", index, collapsed_fasta],
+                                stdout=subprocess.PIPE, bufsize=1024 * 1024)
+    for line in aligning.stdout:
+        name, reference = line.rstrip(b"\n").split(b"\t")
+        rank = rank_of.get(reference.split(b"|")[0], unassigned)
+        sequence = collapsed_index(name)
+        reported[sequence] += 1
+        if rank < ranks[sequence]:
+            ranks[sequence] = rank
+    aligning.stdout.close()
+    check_returncode("bowtie", aligning.wait())
+    return ranks, np.flatnonzero((reported >= max_alignments) & (ranks > 0))
+
+
+def resolve_capped(collapsed, sequences, ranks, bowtie_db_dir, rnatypes, cpus, fasta):
+    #align the sequences whose alignments were capped to the index of each RNA type in turn, as the successive
+    #bowtie steps did, down to the RNA type they were assigned to
+    pending = set(int(sequence) for sequence in sequences)
+    for rank, rnatype in enumerate(rnatypes):
+        pending = set(sequence for sequence in pending if ranks[sequence] > rank)
+        if len(pending) == 0:
+            break
+        with open(fasta, "wb") as out:
+            for sequence in sorted(pending):
+                seq, count = collapsed[sequence]
+                out.write(b">" + str(sequence).encode() + b"_x" + str(count).encode() + b"\n" + seq + b"\n")
+        #only report the read name
+        aligning = subprocess.Popen(["bowtie", "-f", "-v", "1", "-k", "1", "-p", str(cpus), "--suppress", "2,3,4,5,6,7,8", os.path.join(bowtie_db_dir, rnatype), fasta],
+                                    stdout=subprocess.PIPE)
+        for line in aligning.stdout:
+            ranks[collapsed_index(line.rstrip(b"\n"))] = rank
+        aligning.stdout.close()
+        check_returncode("bowtie", aligning.wait())
+    if os.path.exists(fasta):
+        os.remove(fasta)
+    return ranks
+
+
+def cascade_counts(ranks, counts, rnatypes):
+    #reads processed, aligned and failed to align at each RNA type, as if each RNA type only received the reads
+    #that failed to align to the previous ones
+    aligned = np.bincount(ranks, weights=counts, minlength=len(rnatypes) + 1).astype(np.int64)
+    remaining = int(counts.sum())
+    rows = []
+    for rank, rnatype in enumerate(rnatypes):
+        rows.append([rnatype, remaining, int(aligned[rank]), remaining - int(aligned[rank])])
+        remaining -= int(aligned[rank])
+    return rows
+
+
+def percent(count, total):
+    return "{:.2f}%".format(100 * count / total) if total > 0 else "0.00%"
+
+
+def write_outputs(sample, rows, counts_tsv, bowtie_log):
+    with open(counts_tsv, "w") as out:
+        out.write("\t".join(RNA_SOURCE_COLUMNS) + "\n")
+        for row in rows:
+            out.write("\t".join(str(value) for value in [sample] + row) + "\n")
+    with open(bowtie_log, "w") as out:
+        out.write(sample + "\n")
+        for rnatype, processed, aligned, failed in rows:
+            out.write(rnatype + " alignment:\n")
+            out.write("# reads processed: " + str(processed) + "\n")
+            out.write("# reads with at least one alignment: " + str(aligned) + " (" + percent(aligned, processed) + ")\n")
+            out.write("# reads that failed to align: " + str(failed) + " (" + percent(failed, processed) + ")\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Derive the RNA source profile of a sample with a single alignment of the collapsed reads")
+    reads = parser.add_mutually_exclusive_group(required=True)
+    reads.add_argument("--fastq", type=str)
+    reads.add_argument("--collapsed", type=str)
+    parser.add_argument("--min_length", type=int, default=0)
+    parser.add_argument("--sample", type=str, required=True)
+    parser.add_argument("--index", type=str, required=True)
+    parser.add_argument("--bowtie_db_dir", type=str, required=True)
+    parser.add_argument("--max_alignments", type=int, default=MAX_ALIGNMENTS)
+    parser.add_argument("--rnatypes", type=str, nargs="+", default=RNA_TYPES)
+    parser.add_argument("--cpus", type=int, default=1)
+    args = parser.parse_args()
+    sample = args.sample
+    rnatypes = args.rnatypes
+
+    if args.collapsed is not None:
+        print("Reading collapsed reads")
+        read_counts = dict(read_collapsed(args.collapsed, min_length=args.min_length))
+    else:
+        print("Collapsing reads")
+        read_counts = collapse_fastq(args.fastq)
+    collapsed_fasta = sample + "_rna_source_collapsed.fa"
+    collapsed = write_collapsed_fasta(read_counts, collapsed_fasta)
+    counts = np.array([count for seq, count in collapsed], dtype=np.int64)
+    print(str(int(counts.sum())) + " reads collapsed into " + str(len(collapsed)) + " distinct sequences")
+
+    print("Aligning the distinct sequences to all RNA types")
+    ranks, capped = classify(collapsed_fasta, len(collapsed), args.index, rnatypes, args.cpus, args.max_alignments)
+    if len(capped) > 0:
+        print("Aligning the " + str(len(capped)) + " distinct sequences reaching " + str(args.max_alignments) + " alignments to each RNA type in turn")
+        ranks = resolve_capped(collapsed, capped, ranks, args.bowtie_db_dir, rnatypes, args.cpus, sample + "_rna_source_capped.fa")
+    rows = cascade_counts(ranks, counts, rnatypes)
+    write_outputs(sample, rows, sample + "_rna_source_counts.tsv", sample + "_bowtie.log")
+    os.remove(collapsed_fasta)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,6 @@
 import pandas as pd
 from functools import reduce
 import glob
-import re
 import csv
 import os
 import matplotlib
@@ -10,95 +9,24 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import collections
 import time
+from log_parsers import parse_rna_source_counts, parse_rna_source_log
 
 
 def main():
     timestr = time.strftime("%Y%m%d-%H%M%S")
     read_origin_dict = {}
-    for umitools_out in glob.glob("*bowtie.log"):
-        sample = ()
-        total_reads = ()
-        rRNA = ()
-        mt_pt_other = ()
-        miRNA = ()
-        plant_tRNA = ()
-        plant_nc = ()
-        artefacts = ()
-        viral = ()
-        leftover = ()
-
-        #sample = umitools_out.replace('_bowtie.log', '')
-        with open(umitools_out, 'r') as f:
-            sample = f.readline().strip('\n')
-            print(sample)
-            for line in f:
-                
-                if ("rRNA alignment:") in line:
-                    line = next(f)
-                    elements = line.split("# reads processed: ")
-                    total_reads = int(elements[1].strip())
-                    line = next(f)
-                    elements2 = line.split("# reads with at least one alignment: ")
-                    rRNA = elements2[1].strip()
-                    rRNA = int(re.sub(r' \(.*\)', '', rRNA).strip())
-
-                elif ("miRNA alignment:") in line:
-                    line = next(f)
-                    line = next(f)
-                    elements = line.split("# reads with at least one alignment: ")
-                    miRNA = elements[1].strip()
-                    miRNA = int(re.sub(r' \(.*\)', '', miRNA).strip())
-
-                elif ("plant_tRNA alignment:") in line:
-                    line = next(f)
-                    line = next(f)
-                    elements = line.split("# reads with at least one alignment: ")
-                    plant_tRNA = elements[1].strip()
-                    plant_tRNA = int(re.sub(r' \(.*\)', '', plant_tRNA).strip())
-
-                elif ("plant_pt_mt_other_genes alignment:") in line:
-                    line = next(f)
-                    line = next(f)
-                    elements = line.split("# reads with at least one alignment: ")
-                    mt_pt_other = elements[1].strip()
-                    mt_pt_other = int(re.sub(r' \(.*\)', '', mt_pt_other).strip())
-        
-                elif ("miRNA alignment:") in line:
-                    line = next(f)
-                    line = next(f)
-                    elements = line.split("# reads with at least one alignment: ")
-                    miRNA = elements[1].strip()
-                    miRNA = int(re.sub(r' \(.*\)', '', miRNA).strip())
-                
-                elif ("plant_noncoding alignment:") in line:
-                    line = next(f)
-                    line = next(f)
-                    elements = line.split("# reads with at least one alignment: ")
-                    plant_nc = elements[1].strip()
-                    plant_nc = int(re.sub(r' \(.*\)', '', plant_nc).strip())
-                
-                
-                elif ("artefacts alignment:") in line:
-                    line = next(f)
-                    line = next(f)
-                    elements = line.split("# reads with at least one alignment: ")
-                    artefacts = elements[1].strip()
-                    artefacts = int(re.sub(r' \(.*\)', '', artefacts).strip())
-                
-                elif ("plant_virus_viroid alignment:") in line:
-                    line = next(f)
-                    line = next(f)
-                    elements = line.split("# reads with at least one alignment: ")
-                    viral = elements[1].strip()
-                    viral = int(re.sub(r' \(.*\)', '', viral).strip())
-                    line = next(f)
-                    elements2 = line.split("# reads that failed to align: ")
-                    leftover = elements2[1].strip()
-                    leftover = int(re.sub(r' \(.*\)', '', leftover).strip())
-                    
-        f.close()
-        read_origin_dict[sample] = [rRNA, plant_tRNA, mt_pt_other, plant_nc, artefacts,\
-                                    miRNA, viral, leftover, total_reads]
+    #counts tables of rna_source_classify.py, or the logs of the successive bowtie alignments
+    #the counts table of a sample is used rather than its log when both are present
+    rna_source_files = [(bowtie_log, parse_rna_source_log) for bowtie_log in sorted(glob.glob("*bowtie.log"))]
+    rna_source_files += [(counts_tsv, parse_rna_source_counts) for counts_tsv in sorted(glob.glob("*_rna_source_counts.tsv"))]
+    for rna_source_file, parse in rna_source_files:
+        sample, sections = parse(rna_source_file)
+        print(sample)
+        read_origin_dict[sample] = [rna_type_metric(sections, "rRNA"), rna_type_metric(sections, "plant_tRNA"),\
+                                    rna_type_metric(sections, "plant_pt_mt_other_genes"), rna_type_metric(sections, "plant_noncoding"),\
+                                    rna_type_metric(sections, "artefacts"), rna_type_metric(sections, "miRNA"),\
+                                    rna_type_metric(sections, "plant_virus_viroid"), rna_type_metric(sections, "plant_virus_viroid", "reads_failed"),\
+                                    rna_type_metric(sections, "rRNA", "reads_processed")]
         #sort dictionary by key (ie sample name)
         read_origin_dict = collections.OrderedDict(sorted(read_origin_dict.items()))
     
@@ -132,5 +60,11 @@ def main():
     print(pc_df)
     pc_df.to_csv('read_origin_pc_summary.' + timestr + '.txt', sep="\t", float_format="%.2f")
 
+def rna_type_metric(sections, rnatype, metric="reads_aligned"):
+    #bowtie metric of the alignment to one RNA type, None if this alignment is missing from the log
+    if rnatype not in sections:
+        return None
+    return sections[rnatype][metric]
+
 if __name__ == '__main__':
     main()
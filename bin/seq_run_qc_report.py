@@ -2,148 +2,38 @@
 import argparse
 import pandas as pd
 import numpy as np
-from functools import reduce
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import glob
-import re
 import os
 import time
+from log_parsers import parse_bowtie_log, parse_cutadapt_log, parse_fastp_json, parse_umi_tools_log
+
+#log of each step of a sample: suffix of the log file, parser and (report column, metric of the parser)
+LOG_FAMILIES = [("_umi_tools.log", parse_umi_tools_log, [("raw_reads", "input_reads"), ("umi_cleaned_reads", "reads_output")]),
+                ("_qual_filtering_cutadapt.log", parse_cutadapt_log, [("quality_filtered_reads_>_18bp", "reads_written")]),
+                ("_fastp.json", parse_fastp_json, [("total_filtered_bases", "total_bases"), ("q20_bases", "q20_bases"), ("q30_bases", "q30_bases"), ("percent_gc_content", "gc_content")]),
+                ("_blacklist_filter.log", parse_bowtie_log, [("informative_reads_reads", "reads_failed")]),
+                ("_18-25nt_cutadapt.log", parse_cutadapt_log, [("informative_reads_18-25_nt", "reads_written")]),
+                ("_21-22nt_cutadapt.log", parse_cutadapt_log, [("informative_reads_21-22_nt", "reads_written")]),
+                ("_24nt_cutadapt.log", parse_cutadapt_log, [("informative_reads_24_nt", "reads_written")])]
+QC_COLUMNS = [column for suffix, parser, metrics in LOG_FAMILIES for column, metric in metrics]
+COUNT_COLUMNS = [column for column in QC_COLUMNS if column != "percent_gc_content"]
 
 def main():
     parser = argparse.ArgumentParser(description="Derive a qc report")
     parser.add_argument("--sampleinfopath", type=str)
     parser.add_argument("--samplesheetpath", type=str)
+    parser.add_argument("--cpus", type=int, default=1)
     args = parser.parse_args()
     sampleinfo = args.sampleinfopath
     samplesheet = args.samplesheetpath
+    cpus = args.cpus
 
     timestr = time.strftime("%Y%m%d-%H%M%S")
 
-    raw_read_counts_dict = {}
-    for umitools_out in glob.glob("*_umi_tools.log"):
-        raw_reads = ()
-        umi_cleaned_reads = ()
-        line_number = 0
-        sample = (os.path.basename(umitools_out).replace('_umi_tools.log', ''))
-        with open(umitools_out, 'r') as f:
-            for line in f:
-                string_to_search1 = ("Input Reads")
-                string_to_search2 = ("Reads output")
-                line_number += 1
-                if string_to_search1 in line:
-                    elements = line.split("Input Reads: ")
-                    raw_reads = int(elements[1].strip())
-                elif string_to_search2 in line:
-                    elements = line.split("Reads output: ")
-                    umi_cleaned_reads = int(elements[1].strip())
-        raw_read_counts_dict[sample] = [raw_reads, umi_cleaned_reads]
-        f.close()
-    
-    for cutadapt_qual_filt_out in glob.glob("*_qual_filtering_cutadapt.log"):
-        qfiltered_reads = ()
-        line_number = 0
-        sample = (os.path.basename(cutadapt_qual_filt_out).replace('_qual_filtering_cutadapt.log', ''))
-        with open(cutadapt_qual_filt_out, 'r') as f:
-            for line in f:
-                string_to_search1 = ("Reads written (passing filters):")
-                line_number += 1
-                if string_to_search1 in line:
-                    qfiltered_reads = line.split("Reads written (passing filters): ")[1]
-                    qfiltered_reads = re.sub(r' \(.*\)', '', qfiltered_reads).strip()
-                    qfiltered_reads = int(re.sub(r',', '', qfiltered_reads).strip())
-        raw_read_counts_dict[sample].append(qfiltered_reads)
-        f.close()
-
-    for fastp_out in glob.glob("*_fastp.json"):
-        total_filtered_bases = ()
-        q20_bases = ()
-        q30_bases = ()
-        gc_content = ()
-
-        line_number = 0
-        sample = (os.path.basename(fastp_out).replace('_fastp.json', ''))
-        with open(fastp_out, 'r') as f:
-            for line in f:
-                string_to_search1 = ("total_bases")
-                string_to_search2 = ("gc_content")
-                line_number += 1
-                if string_to_search1 in line:
-                    total_filtered_bases = line.split(":")[1]
-                    total_filtered_bases = int(re.sub(r',', '', total_filtered_bases).strip())
-                    q20_bases = f.readline().split(":")[1]
-                    q20_bases = int(re.sub(r',', '', q20_bases).strip())
-                    q30_bases = f.readline().split(":")[1]
-                    q30_bases = int(re.sub(r',', '', q30_bases).strip())
-                elif string_to_search2 in line:
-                    gc_content = float(line.split(":")[1].strip())
-        f.close()
-        raw_read_counts_dict[sample].append(total_filtered_bases)
-        raw_read_counts_dict[sample].append(q20_bases)
-        raw_read_counts_dict[sample].append(q30_bases)
-        raw_read_counts_dict[sample].append(gc_content)
-
-
-    for bowtie_blacklist_out in glob.glob("*_blacklist_filter.log"):
-        usable_source_reads = ()
-        line_number = 0
-        sample = (os.path.basename(bowtie_blacklist_out).replace('_blacklist_filter.log', ''))
-        with open(bowtie_blacklist_out, 'r') as f:
-            for line in f:
-                string_to_search1 = ("reads that failed to align")
-                line_number += 1
-                if string_to_search1 in line:
-                    elements = line.split(": ")
-                    usable_source_reads = elements[1].strip()
-                    usable_source_reads = int(re.sub(r' \(.*\)', '', usable_source_reads).strip())
-        f.close()
-        raw_read_counts_dict[sample].append(usable_source_reads)
+    run_data_df = aggregate_logs(".", cpus)
 
-    for cutadapt_18_25_out in glob.glob("*_18-25nt_cutadapt.log"):
-        usable_reads_18_25 = ()
-        line_number = 0
-        sample = (os.path.basename(cutadapt_18_25_out).replace('_18-25nt_cutadapt.log', ''))
-        with open(cutadapt_18_25_out, 'r') as f:
-            for line in f:
-                string_to_search1 = ("Reads written (passing filters):")
-                line_number += 1
-                if string_to_search1 in line:
-                    usable_reads_18_25 = line.split("Reads written (passing filters): ")[1]
-                    usable_reads_18_25 = re.sub(r' \(.*\)', '', usable_reads_18_25).strip()
-                    usable_reads_18_25 = int(re.sub(r',', '', usable_reads_18_25).strip())
-        f.close()
-        raw_read_counts_dict[sample].append(usable_reads_18_25)
-
-    for cutadapt_21_22_out in glob.glob("*_21-22nt_cutadapt.log"):
-        usable_reads_21_22 = ()
-        line_number = 0
-        sample = (os.path.basename(cutadapt_21_22_out).replace('_21-22nt_cutadapt.log', ''))
-        with open(cutadapt_21_22_out, 'r') as f:
-            for line in f:
-                string_to_search1 = ("Reads written (passing filters):")
-                line_number += 1
-                if string_to_search1 in line:
-                    usable_reads_21_22 = line.split("Reads written (passing filters): ")[1]
-                    usable_reads_21_22 = re.sub(r' \(.*\)', '', usable_reads_21_22).strip()
-                    usable_reads_21_22 = int(re.sub(r',', '', usable_reads_21_22).strip())
-        f.close()
-        raw_read_counts_dict[sample].append(usable_reads_21_22)
-
-    for cutadapt_24_out in glob.glob("*_24nt_cutadapt.log"):
-        usable_reads_24 = ()
-        line_number = 0
-        sample = (os.path.basename(cutadapt_24_out).replace('_24nt_cutadapt.log', ''))
-        with open(cutadapt_24_out, 'r') as f:
-            for line in f:
-                string_to_search1 = ("Reads written (passing filters):")
-                line_number += 1
-                if string_to_search1 in line:
-                    usable_reads_24 = line.split("Reads written (passing filters): ")[1]
-                    usable_reads_24 = re.sub(r' \(.*\)', '', usable_reads_24).strip()
-                    usable_reads_24 = int(re.sub(r',', '', usable_reads_24).strip())
-        f.close()
-        raw_read_counts_dict[sample].append(usable_reads_24) 
-    
-    run_data_df = pd.DataFrame([([k] + v) for k, v in raw_read_counts_dict.items()], columns=['Sample','raw_reads','umi_cleaned_reads', 'quality_filtered_reads_>_18bp', 'total_filtered_bases', 'q20_bases', 'q30_bases', 'percent_gc_content', 'informative_reads_reads', 'informative_reads_18-25_nt', 'informative_reads_21-22_nt', 'informative_reads_24_nt'])
-    
     run_data_df['percent_UMI_incorporation'] = run_data_df['umi_cleaned_reads'] / run_data_df['raw_reads'] * 100
     run_data_df['percent_quality_filtered'] = run_data_df['quality_filtered_reads_>_18bp'] / run_data_df['raw_reads'] * 100
     run_data_df['percent_informative_reads_18-25_nt'] = run_data_df['informative_reads_18-25_nt'] / run_data_df['raw_reads'] * 100
@@ -163,14 +53,12 @@ def main():
     #print(run_data_df.dtypes)
 
     run_data_df.set_index('Sample')
-    #For all columns in the dataframe that are of dtype int64, add commas
-    run_data_df.update(run_data_df.select_dtypes(include=['int64']).applymap('{:,}'.format))
-    #Retain 2 decimal point format for GC content column
-    run_data_df.loc[:, 'percent_gc_content'] = run_data_df['percent_gc_content'].map('{:.2f}'.format)
-    run_data_df.loc[:, 'percent_UMI_incorporation'] = run_data_df['percent_UMI_incorporation'].map('{:.2f}'.format)
-    run_data_df.loc[:, 'percent_quality_filtered'] = run_data_df['percent_quality_filtered'].map('{:.2f}'.format)
-    run_data_df.loc[:, 'percent_informative_reads_18-25_nt'] = run_data_df['percent_informative_reads_18-25_nt'].map('{:.2f}'.format)
-    run_data_df.loc[:, 'percent_informative_reads_21-22_nt'] = run_data_df['percent_informative_reads_21-22_nt'].map('{:.2f}'.format)
+    #Add commas to the read and base counts, the metrics missing from the logs are reported as NA
+    for column in COUNT_COLUMNS:
+        run_data_df[column] = run_data_df[column].map(lambda x: "NA" if pd.isna(x) else '{:,}'.format(int(x)))
+    #Retain 2 decimal point format for GC content and percentage columns
+    for column in ['percent_gc_content', 'percent_UMI_incorporation', 'percent_quality_filtered', 'percent_informative_reads_18-25_nt', 'percent_informative_reads_21-22_nt']:
+        run_data_df[column] = run_data_df[column].map(lambda x: "NA" if pd.isna(x) else '{:.2f}'.format(x))
     run_data_df = run_data_df.sort_values("Sample")     
 
     if sampleinfo is not None:
@@ -192,5 +80,39 @@ def main():
 
     run_data_df.to_csv("run_qc_report_" + timestr + ".txt", index = None, sep="\t")
 
+def parse_log(task):
+    #metrics of one log file, run in the worker processes
+    path, family = task
+    suffix, parser, metrics = LOG_FAMILIES[family]
+    sample = os.path.basename(path)[:-len(suffix)]
+    parsed = parser(path)
+    return sample, [(column, parsed[metric]) for column, metric in metrics]
+
+def aggregate_logs(logdir, cpus=1):
+    #one row per sample with every metric of QC_COLUMNS, NaN when the log (or the metric) of a sample is missing
+    tasks = []
+    for family, (suffix, parser, metrics) in enumerate(LOG_FAMILIES):
+        tasks.extend((path, family) for path in sorted(glob.glob(os.path.join(logdir, "*" + suffix))))
+
+    if cpus > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=cpus) as executor:
+            results = list(executor.map(parse_log, tasks, chunksize=max(1, len(tasks) // (cpus * 4))))
+    else:
+        results = [parse_log(task) for task in tasks]
+
+    samples = OrderedDict()
+    for sample, values in results:
+        record = samples.setdefault(sample, OrderedDict((column, np.nan) for column in QC_COLUMNS))
+        for column, value in values:
+            if value is not None:
+                record[column] = value
+    run_data_df = pd.DataFrame([[sample] + list(record.values()) for sample, record in samples.items()], columns=['Sample'] + QC_COLUMNS)
+    #counts stay integers when no sample misses them
+    for column in COUNT_COLUMNS:
+        if run_data_df[column].notna().all():
+            run_data_df[column] = run_data_df[column].astype('int64')
+    run_data_df['percent_gc_content'] = run_data_df['percent_gc_content'].astype(float)
+    return run_data_df
+
 if __name__ == '__main__':
     main()
@@ -1,33 +1,40 @@
 #!/usr/bin/env python
 import argparse
+import io
 import pandas as pd
-import collections
 from collections import OrderedDict
-from operator import itemgetter
+from blast_summary import format_summary, summary_rows, write_summary
 
 def main():
     parser = argparse.ArgumentParser(description="Load blast results")
     parser.add_argument("--virus_list", type=str)
+    parser.add_argument("--blast", type=str)
+    parser.add_argument("--program", type=str, default="blastn", choices=["blastn", "blastp"])
+    parser.add_argument("--summary_out", type=str)
     parser.add_argument("--contig_fasta", type=str)
     parser.add_argument("--out", type=str)
     args = parser.parse_args()
     viruslist = args.virus_list
     contigs_fasta = args.contig_fasta
     out = args.out
+    blastfile = args.blast
+    program = args.program
+    summary_out = args.summary_out
 
 
-    with open(contigs_fasta, 'r') as file:
-        counter = collections.Counter()
-        header = None
-        for line in file:
-            line = line.strip()
-            if line.startswith(">"):
-                header = line[1:]
-                continue
-            counter[header] += len(line)
+    #index the contigs once: name -> [length, offset of the header line]
+    contig_index = index_fasta(contigs_fasta)
+    contig_file = open(contigs_fasta, 'rb')
 
     #print(counter)
-    raw_data = pd.read_csv(viruslist, header=0, sep="\t",index_col=None)
+    if blastfile is not None:
+        #summarise the blast hits in-process, the summary is parsed like the BlastTools summary file
+        rows = summary_rows(blastfile, program)
+        if summary_out is not None:
+            write_summary(rows, summary_out)
+        raw_data = pd.read_csv(io.StringIO(format_summary(rows)), header=0, sep="\t",index_col=None)
+    else:
+        raw_data = pd.read_csv(viruslist, header=0, sep="\t",index_col=None)
     #print(raw_data)
     full_length_list = []
     full_unique_list = []
@@ -46,26 +53,16 @@ def main():
         #extract length of each contig
         contig_len_dic = {}
         for i in unique_list:
-            ind_length = (list(counter.values())[list(counter.keys()).index(i)])
+            ind_length = contig_index[i][0]
             length_list.append(ind_length)
             contig_len_dic[i] = ind_length
         contig_string = ', '.join(map(str,unique_list))
 
         sort_orders = sorted(contig_len_dic.items(), key=lambda x: x[1])
-        sorted_dict = OrderedDict(sorted(contig_len_dic.items(), key = itemgetter(1)))
-        print(sorted_dict)
-        longest_contig = list(sorted_dict.keys())[-1]
-
-        contig_seq = ""
-        string = ">" + longest_contig
-        with open(contigs_fasta, 'r') as f:
-            for line in f:
-                if string in line:
-                    contig_seq += line.strip()
-                    contig_seq += ' '
-                    contig_seq += next(f).strip()
-
-            contig_seq = contig_seq.replace('"', '')
+        longest_contig = sort_orders[-1][0]
+
+        contig_seq = fetch_record(contig_file, contig_index[longest_contig][1])
+        contig_seq = contig_seq.replace('"', '')
         longest_contig_list.append(contig_seq)
 
         sum_numbers = sum(length_list)
@@ -78,6 +75,8 @@ def main():
         min_list.append(min_length)
         contig_count_list.append(contig_count)
 
+    contig_file.close()
+
     raw_data['unique_contig_list'] = pd.Series(full_unique_list)
     raw_data['contig_ind_lengths'] = pd.Series(full_length_list)
 
@@ -99,5 +98,31 @@ def main():
     print(raw_data)
     raw_data.to_csv(out, index=None, sep="\t",float_format="%.2f")  
 
+def index_fasta(fasta):
+    #single pass over the fasta file recording the length and file offset of each sequence
+    index = OrderedDict()
+    header = None
+    offset = 0
+    with open(fasta, 'rb') as f:
+        for line in f:
+            if line.startswith(b">"):
+                header = line[1:].strip().decode()
+                index[header] = [0, offset]
+            elif header is not None:
+                index[header][0] += len(line.strip())
+            offset += len(line)
+    return index
+
+def fetch_record(f, offset):
+    #return the header and sequence of the record starting at offset as a single line
+    f.seek(offset)
+    header = f.readline().strip().decode()
+    seq = []
+    for line in f:
+        if line.startswith(b">"):
+            break
+        seq.append(line.strip().decode())
+    return header + ' ' + ''.join(seq)
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
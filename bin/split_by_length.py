@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""
+Split a fastq file into read length bins in a single pass, instead of running cutadapt -m/-M
+once per bin. Each bin gets a cutadapt-like log (<prefix>_<bin>nt_cutadapt.log) with the
+number of reads processed and written, and optionally its reads (<prefix>_<bin>nt.fastq)
+and a compressed copy written at the same time with pigz (<prefix>_<bin>nt.fastq.gz, at
+--level, 9 by default like pigz --best).
+A bin is written as MIN-MAX or as LEN for a single length.
+# split_by_length.py --fastq sample_cleaned.fastq --prefix sample --bins 18-25 21-22 24 --write 21-22 --compress 21-22 --level 9 --cpus 4
+"""
+
+import argparse
+import gzip
+import shutil
+import subprocess
+from fastq_utils import open_fastq
+
+BUFFER_SIZE = 8 * 1024 * 1024
+
+
+class BinWriter(object):
+    #buffered output of the reads of one bin, to a plain file and/or to a compressed file
+    def __init__(self, fastq=None, fastq_gz=None, threads=1, level=9):
+        self.buffer = []
+        self.buffered = 0
+        self.outputs = []
+        self.proc = None
+        if fastq is not None:
+            self.outputs.append(open(fastq, 'wb'))
+        if fastq_gz is not None:
+            if shutil.which("pigz") is not None:
+                #pigz compresses in its own process while the reads are being split
+                self.gz = open(fastq_gz, 'wb')
+                self.proc = subprocess.Popen(["pigz", "-" + str(level), "-p", str(threads), "-c"], stdin=subprocess.PIPE, stdout=self.gz)
+                self.outputs.append(self.proc.stdin)
+            else:
+                self.outputs.append(gzip.open(fastq_gz, 'wb', compresslevel=level))
+
+    def write(self, record):
+        self.buffer.append(record)
+        self.buffered += len(record)
+        if self.buffered >= BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        data = b"".join(self.buffer)
+        for out in self.outputs:
+            out.write(data)
+        self.buffer = []
+        self.buffered = 0
+
+    def close(self):
+        self.flush()
+        for out in self.outputs:
+            out.close()
+        if self.proc is not None:
+            returncode = self.proc.wait()
+            self.gz.close()
+            if returncode != 0:
+                raise OSError("pigz exited with code " + str(returncode))
+
+
+def parse_bin(name):
+    #"18-25" -> (18, 25), "24" -> (24, 24)
+    bounds = name.split("-")
+    return int(bounds[0]), int(bounds[-1])
+
+
+def split_by_length(fastq, bins, writers):
+    #bins: list of (min, max) lengths, writers: BinWriter (or None) of each bin
+    #returns the number of reads and bases processed and, for each bin, the reads and bases written, too short and too long
+    stats = [{"written": 0, "written_bp": 0, "too_short": 0, "too_long": 0} for b in bins]
+    max_length = max(maximum for minimum, maximum in bins)
+    #bins matching each read length up to the longest bin, longer reads match no bin
+    bins_of_length = [[i for i, (minimum, maximum) in enumerate(bins) if minimum <= length <= maximum] for length in range(max_length + 1)]
+    length_counts = {}
+    reads = 0
+    with open_fastq(fastq) as f:
+        lines = iter(f)
+        for header, seq, plus, qual in zip(lines, lines, lines, lines):
+            length = len(seq.rstrip(b"\r\n"))
+            length_counts[length] = length_counts.get(length, 0) + 1
+            if length <= max_length:
+                for i in bins_of_length[length]:
+                    if writers[i] is not None:
+                        writers[i].write(header + seq + plus + qual)
+            reads += 1
+
+    bases = 0
+    for length, count in length_counts.items():
+        bases += length * count
+        for (minimum, maximum), bin_stats in zip(bins, stats):
+            if length < minimum:
+                bin_stats["too_short"] += count
+            elif length > maximum:
+                bin_stats["too_long"] += count
+            else:
+                bin_stats["written"] += count
+                bin_stats["written_bp"] += length * count
+    return reads, bases, stats
+
+
+def percent(count, total):
+    return "{:.1%}".format(count / total) if total > 0 else "0.0%"
+
+
+def write_log(logfile, fastq, output, minimum, maximum, reads, bases, bin_stats):
+    #same summary lines as cutadapt so the log is read by the same parsers
+    with open(logfile, "w") as out:
+        out.write("This is cutadapt-compatible output of split_by_length.py\n")
+        out.write("Command line parameters: -m " + str(minimum) + " -M " + str(maximum) + " -o " + output + " " + fastq + "\n\n")
+        out.write("=== Summary ===\n\n")
+        out.write("Total reads processed:           {:>12,}\n".format(reads))
+        out.write("Reads that were too short:       {:>12,} ({})\n".format(bin_stats["too_short"], percent(bin_stats["too_short"], reads)))
+        out.write("Reads that were too long:        {:>12,} ({})\n".format(bin_stats["too_long"], percent(bin_stats["too_long"], reads)))
+        out.write("Reads written (passing filters): {:>12,} ({})\n\n".format(bin_stats["written"], percent(bin_stats["written"], reads)))
+        out.write("Total basepairs processed:       {:>12,} bp\n".format(bases))
+        out.write("Total written (filtered):        {:>12,} bp ({})\n".format(bin_stats["written_bp"], percent(bin_stats["written_bp"], bases)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Split a fastq file into read length bins in a single pass")
+    parser.add_argument("--fastq", type=str, required=True)
+    parser.add_argument("--prefix", type=str, required=True)
+    parser.add_argument("--bins", type=str, nargs="+", required=True)
+    parser.add_argument("--write", type=str, nargs="*", default=[])
+    parser.add_argument("--compress", type=str, nargs="*", default=[])
+    parser.add_argument("--level", type=int, default=9, choices=range(1, 10))
+    parser.add_argument("--cpus", type=int, default=1)
+    args = parser.parse_args()
+    fastq = args.fastq
+    prefix = args.prefix
+
+    #the same bin requested twice (e.g. minlen-maxlen is 21-22) is only split once
+    names = list(dict.fromkeys(args.bins + args.write + args.compress))
+    bins = [parse_bin(name) for name in names]
+    threads = max(1, args.cpus // max(1, len(args.compress)))
+    writers = []
+    for name in names:
+        fastq_out = prefix + "_" + name + "nt.fastq" if name in args.write else None
+        fastq_gz = prefix + "_" + name + "nt.fastq.gz" if name in args.compress else None
+        writers.append(BinWriter(fastq_out, fastq_gz, threads, args.level) if fastq_out is not None or fastq_gz is not None else None)
+
+    reads, bases, stats = split_by_length(fastq, bins, writers)
+    for writer in writers:
+        if writer is not None:
+            writer.close()
+
+    for name, (minimum, maximum), bin_stats in zip(names, bins, stats):
+        print(name + " nt: " + str(bin_stats["written"]) + " of " + str(reads) + " reads")
+        write_log(prefix + "_" + name + "nt_cutadapt.log", fastq, prefix + "_" + name + "nt.fastq", minimum, maximum, reads, bases, bin_stats)
+
+
+if __name__ == "__main__":
+    main()
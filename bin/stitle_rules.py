@@ -0,0 +1,41 @@
+"""
+Clean up of the blast hit descriptions (stitle) using the regex substitutions
+and exclusion patterns listed in stitle_rules.json.
+The rules are compiled once and each unique description is only processed once.
+"""
+
+import json
+import os
+import re
+
+DEFAULT_RULES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stitle_rules.json")
+
+
+def load_rules(rules_path=None):
+    #return the compiled substitutions (applied in order) and a single pattern matching any exclusion
+    if rules_path is None:
+        rules_path = DEFAULT_RULES
+    with open(rules_path, 'r') as f:
+        rules = json.load(f)
+    substitutions = [(re.compile(rule["pattern"]), rule["replacement"]) for rule in rules.get("substitutions", [])]
+    exclusions = rules.get("exclusions", [])
+    exclusion = re.compile("|".join("(?:" + pattern + ")" for pattern in exclusions)) if exclusions else None
+    return substitutions, exclusion
+
+
+def normalise_title(title, substitutions):
+    for pattern, replacement in substitutions:
+        title = pattern.sub(replacement, title)
+    return title
+
+
+def normalise_titles(titles, rules):
+    #return the cleaned up titles and a boolean series flagging the titles matching an exclusion pattern
+    substitutions, exclusion = rules
+    normalised_titles = {}
+    excluded_titles = {}
+    for title in titles.unique():
+        normalised = normalise_title(str(title), substitutions)
+        normalised_titles[title] = normalised
+        excluded_titles[title] = exclusion is not None and exclusion.search(normalised) is not None
+    return titles.map(normalised_titles), titles.map(excluded_titles).astype(bool)
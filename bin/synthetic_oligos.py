@@ -1,155 +1,149 @@
 #!/usr/bin/env python
+"""
+Count the reads of the synthetic oligo spike-ins of a sample in a single pass over the quality
+filtered reads, without building a bowtie index or a bam file.
+A read matches an oligo if it is found within the oligo sequence (or its reverse complement)
+with at most one mismatch, like an end-to-end bowtie -v 1 alignment. All the substrings of the
+oligos and their one mismatch variants are indexed once, so each read is matched with a single
+lookup. The matching reads are deduplicated on their UMI (the last _ separated field of the read
+name, added by umi_tools extract) and their position with the directional method of
+umi_tools dedup.
+Writes <sample>_<read_size>_synthetic_oligos_stats.txt with the read count, dedup read count,
+FPKM and dup % of each oligo of the panel (--oligos fasta file, celmiR39, celmiR54 and
+celmiR238 by default).
+# synthetic_oligos.py --sample sample --rawfastq sample.fastq.gz --fastqfiltbysize sample_quality_trimmed.fastq --read_size 21-22
+"""
+
 import argparse
 import pandas as pd
-import subprocess
-from functools import reduce
-from subprocess import run, PIPE
+from collections import OrderedDict
+from fastq_utils import open_fastq, raw_read_count
 
+SYNTHETIC_OLIGOS = OrderedDict([("celmiR39", "TCACCGGGTGTAAATCAGCTTG"),
+                                ("celmiR54", "TACCCGTAATCTTCATAATCCGAG"),
+                                ("celmiR238", "TTTGTACTCCGATGCCATTCAGA")])
+SYNTHETIC_OLIGO_COLUMNS = ["Sample", "Synthetic oligos", "Read count", "Dedup read count", "FPKM", "Dup %"]
+COMPLEMENT = bytes.maketrans(b"ACGTN", b"TGCAN")
+
+
+def read_oligos(fasta):
+    #name (first word of the header) and sequence of each oligo of a fasta file
+    oligos = OrderedDict()
+    with open(fasta, 'r') as f:
+        name = None
+        for line in f:
+            line = line.strip()
+            if line.startswith(">"):
+                name = line[1:].split()[0]
+                oligos[name] = ""
+            elif name is not None:
+                oligos[name] += line.upper()
+    return oligos
+
+
+def oligo_matches(oligos, min_length, mismatches=1):
+    #sequence (bytes) -> (oligo, strand, position) of each read sequence matching an oligo
+    #the position is the 5' end of the match on the oligo (forward) or its 3' end (reverse), as used by umi_tools dedup
+    #exact matches are indexed first so they are preferred to one mismatch matches, then the first oligo and position
+    matches = {}
+    for allowed in range(mismatches + 1):
+        for name, oligo in oligos.items():
+            forward = oligo.encode()
+            for strand, reference in (("+", forward), ("-", forward.translate(COMPLEMENT)[::-1])):
+                size = len(reference)
+                for start in range(size):
+                    for end in range(start + max(min_length, 1), size + 1):
+                        position = start if strand == "+" else size - start
+                        for seq in variants(reference[start:end], allowed):
+                            matches.setdefault(seq, (name, strand, position))
+    return matches
+
+
+def variants(seq, mismatches):
+    #the sequence itself, or its sequences with exactly one mismatch
+    if mismatches == 0:
+        return [seq]
+    return [seq[:i] + base + seq[i + 1:] for i in range(len(seq)) for base in (b"A", b"C", b"G", b"T", b"N") if base != seq[i:i + 1]]
+
+
+def count_oligo_reads(fastq, matches, oligos):
+    #number of matching reads and of reads of each UMI at each position of each oligo
+    read_counts = OrderedDict((name, 0) for name in oligos)
+    umi_counts = OrderedDict((name, {}) for name in oligos)
+    with open_fastq(fastq) as f:
+        lines = iter(f)
+        for header, seq, plus, qual in zip(lines, lines, lines, lines):
+            match = matches.get(seq.rstrip(b"\r\n"))
+            if match is None:
+                continue
+            name, strand, position = match
+            read_counts[name] += 1
+            umi = header.split()[0].rsplit(b"_", 1)[-1]
+            umis = umi_counts[name].setdefault((strand, position), {})
+            umis[umi] = umis.get(umi, 0) + 1
+    return read_counts, umi_counts
+
+
+def hamming_one(a, b):
+    return len(a) == len(b) and sum(x != y for x, y in zip(a, b)) == 1
+
+
+def directional_groups(umis):
+    #number of UMI groups at one position with the umi_tools directional method: a UMI is merged with a UMI one mismatch
+    #away with at least 2n-1 reads, following the edges from the most abundant UMIs
+    ordered = sorted(umis, key=lambda umi: (-umis[umi], umi))
+    edges = {umi: [other for other in ordered if umis[umi] >= 2 * umis[other] - 1 and hamming_one(umi, other)] for umi in ordered}
+    found = set()
+    groups = 0
+    for umi in ordered:
+        if umi in found:
+            continue
+        groups += 1
+        queue = [umi]
+        found.add(umi)
+        while queue:
+            for other in edges[queue.pop()]:
+                if other not in found:
+                    found.add(other)
+                    queue.append(other)
+    return groups
 
-def main():
-    ################################################################################
-    parser = argparse.ArgumentParser(description="Load blast results")
 
-    # All the required arguments #
+def main():
+    parser = argparse.ArgumentParser(description="Count the reads of the synthetic oligos")
     parser.add_argument("--rawfastq", type=str)
+    parser.add_argument("--rawfastq_log", type=str)
     parser.add_argument("--fastqfiltbysize", type=str)
     parser.add_argument("--sample", type=str)
     parser.add_argument("--read_size", type=str)
+    parser.add_argument("--oligos", type=str)
+    parser.add_argument("--min_length", type=int, default=18)
     args = parser.parse_args()
-    
+
     sample = args.sample
-    rawfastq = args.rawfastq
-    fastqfiltbysize = args.fastqfiltbysize
     read_size = args.read_size
-
-    rawfastq_read_counts = (len(open(rawfastq).readlines(  ))/4)
-    read_counts_dict = {}
-    dedup_read_counts_dict = {}
-    dup_pc_dict = {}
-    fpkm_dict = {}
-
-    #oligo = str("celmiR39")
-    #fastafile = (sample + "_" + read_size + "_" + oligo + ".fa").replace(" ","_")
-    #single_fasta_entry = open(fastafile, "w")
-    #single_fasta_entry.write(">celmir39\nTCACCGGGTGTAAATCAGCTTG")
-    #single_fasta_entry.close()
-
-    fastafile = ("celmiR39.fa")
-    single_fasta_entry = open(fastafile, "w")
-    single_fasta_entry.write(">celmir39\nTCACCGGGTGTAAATCAGCTTG")
-    single_fasta_entry.close()
-
-    # fastafile = ("celmiR54.fa")
-    # single_fasta_entry = open(fastafile, "w")
-    # single_fasta_entry.write(">celmiR54\nTACCCGTAATCTTCATAATCCGAG")
-    # single_fasta_entry.close()
-    
-    # fastafile = ("celmiR238.fa")
-    # single_fasta_entry = open(fastafile, "w")
-    # single_fasta_entry.write(">celmir238\nTTTGTACTCCGATGCCATTCAGA")
-    # single_fasta_entry.close()
-
-    #gene_list = ('celmiR39', 'celmiR54', 'celmiR238')
-    index = 'celmiR39'
-    #for index in gene_list:
-    #print("Building a bowtie index")
-    #index = (sample + "_" + read_size + "_" + oligo)
-    #print(index)
-    #buildindex = ["bowtie-build", "-f", fastafile, index]
-    buildindex = ["bowtie-build", "-f", index + ".fa", index]
-    subprocess.call(buildindex)
-    
-    print("Aligning original reads")
-    samoutput = str(index + ".sam")
-    bowtie_output = str(index + "_bowtie_log.txt")
-    aligning = ["bowtie", "-q", "-v", "1", "-k", "1", "-p", "4", "-x", index, fastqfiltbysize, "-S", samoutput]
-    subprocess.call(aligning, stderr=open(bowtie_output,"w"))
-
-    print("Derive a bam file")
-    bamoutput = str(index + ".bam")
-    derivebam = ["samtools", "view", "-@", "4", "-bS", samoutput]
-    subprocess.call(derivebam, stdout=open(bamoutput,"w"))
-
-    print("Sorting bam file")
-    sortedbamoutput = str(index + ".sorted.bam")
-    sorting = ["samtools", "sort", "-@", "4", bamoutput, "-o", sortedbamoutput]
-    subprocess.call(sorting)
-
-    print("Indexing bam file")
-    bamindex = str(index + ".sorted.bam.bai")
-    indexing = ["samtools", "index", sortedbamoutput]
-    subprocess.call(indexing, stdout=open(bamindex,"w"))
-
-    print("Deduping bam file")
-    dedupbamoutput = str(index + ".dedup.bam")
-    umi_dedup_log = str(index + "_umi_tools.log")
-    dedup = ["umi_tools", "dedup", "-I", sortedbamoutput, "-L", umi_dedup_log]
-    subprocess.call(dedup, stdout=open(dedupbamoutput,"w"))
-
-    print("Indexing dedup bam file")
-    dedupbamindex = str(index + ".dedup.bam.bai")
-    dedup_indexing = ["samtools", "index", dedupbamoutput]
-    subprocess.call(dedup_indexing, stdout=open(dedupbamindex,"w"))
-
-    subprocess.call(["rm","-r", samoutput])
-    subprocess.call(["rm","-r", bamoutput])
-    subprocess.call(["rm","-r", sortedbamoutput])
-    subprocess.call(["rm","-r", bamindex])
-
-    reflen = ()
-    print("Deriving synthetic oligo length")
-    bamheaderout = str(index + "_bam_header.txt")
-    header = ["samtools", "view", "-H", dedupbamoutput]
-    subprocess.call(header, stdout=open(bamheaderout,"w"))
-
-    with open(bamheaderout, 'r') as f:
-        for line in f:
-            string_to_search1 = ("@HD")
-            if string_to_search1 in line:
-                line = next(f)
-                elements = line.split("LN:")
-                reflen = int(elements[1].strip())
-    f.close()
-
-    dup_pc = ()
-    read_counts = ()
-    dedup_read_counts = ()
-    fpkm = ()
-
-    dup_pc_dict[index] = dup_pc
-    p = run(["samtools", "view", "-c", "-F", "260", dedupbamoutput], stdout=PIPE, encoding='ascii')
-    dedup_read_counts = p.stdout.replace("\n","")
-    dedup_read_counts_dict[index] = dedup_read_counts
-    print(dedup_read_counts_dict)
-    
-    with open(bowtie_output) as bo:
-        a = " "
-        while(a):
-            a = bo.readline()
-            l = a.find("# reads with at least one alignment:") #Gives a non-negative value when there is a match
-            if ( l >= 0 ):
-                print(a)
-                read_counts = a.split(" ")[7]
-
-    read_counts_dict[index] = read_counts
-    fpkm = round(int(dedup_read_counts)/(int(reflen)/1000*int(rawfastq_read_counts)/1000000))
-    fpkm_dict[index] = fpkm
-    dup_pc = round(100-(int(dedup_read_counts)*100/(int(read_counts)+0.1)))
-    dup_pc_dict[index] = dup_pc
-
-    read_counts_df = pd.DataFrame(read_counts_dict.items(),columns=["Synthetic oligos", "Read count"])
-    read_counts_dedup_df = pd.DataFrame(dedup_read_counts_dict.items(),columns=["Synthetic oligos", "Dedup read count"]) 
-    dup_pc_df = pd.DataFrame(dup_pc_dict.items(),columns=["Synthetic oligos", "Dup %"]) 
-    fpkm_df = pd.DataFrame(fpkm_dict.items(),columns=["Synthetic oligos", "FPKM"])
-
-    dfs = [read_counts_df, read_counts_dedup_df, fpkm_df, dup_pc_df]
-    full_table = reduce(lambda left,right: pd.merge(left,right,on="Synthetic oligos"), dfs)
-
+    oligos = read_oligos(args.oligos) if args.oligos is not None else SYNTHETIC_OLIGOS
+
+    rawfastq_read_counts = int(raw_read_count(args.rawfastq, args.rawfastq_log))
+    print("Indexing the synthetic oligos")
+    matches = oligo_matches(oligos, args.min_length)
+    print("Matching reads to the synthetic oligos")
+    read_counts, umi_counts = count_oligo_reads(args.fastqfiltbysize, matches, oligos)
+
+    rows = []
+    for name, oligo in oligos.items():
+        read_count = read_counts[name]
+        dedup_read_count = sum(directional_groups(umis) for umis in umi_counts[name].values())
+        fpkm = round(dedup_read_count / (len(oligo) / 1000 * rawfastq_read_counts / 1000000)) if rawfastq_read_counts > 0 else 0
+        dup_pc = round(100 - (dedup_read_count * 100 / (read_count + 0.1)))
+        print(name + ": " + str(read_count) + " reads, " + str(dedup_read_count) + " dedup reads")
+        rows.append([sample, name, read_count, dedup_read_count, fpkm, dup_pc])
+
+    full_table = pd.DataFrame(rows, columns=SYNTHETIC_OLIGO_COLUMNS)
     full_table["Dup %"] = full_table["Dup %"].astype(float)
-    
-    full_table.insert(0, "Sample", sample)
     print(full_table)
-    full_table.to_csv(sample + "_" + read_size + "_synthetic_oligos_stats.txt", index=None, sep="\t",float_format="%.2f")
+    full_table.to_csv(sample + "_" + read_size + "_synthetic_oligos_stats.txt", index=None, sep="\t", float_format="%.2f")
+
 
 if __name__ == "__main__":
     main()
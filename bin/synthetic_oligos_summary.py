@@ -2,11 +2,12 @@
 import argparse
 import pandas as pd
 import numpy as np
-from functools import reduce
-import glob
-import re
-import os
 import time
+from table_loader import load_tables, read_table
+
+SYNTHETIC_OLIGO_COLUMNS = ['Sample', 'Synthetic oligos', 'Read count', 'Dedup read count', 'FPKM', 'Dup %']
+#the read counts are only passed through to the summary, so they are kept as written
+SYNTHETIC_OLIGO_DTYPES = {'Sample': str, 'Synthetic oligos': str, 'Read count': str, 'Dedup read count': str, 'FPKM': float, 'Dup %': float}
 
 
 def main():
@@ -18,25 +19,22 @@ def main():
 
     timestr = time.strftime("%Y%m%d-%H%M%S")
     
-    synthetic_df = pd.DataFrame(columns=['Sample', 'Synthetic oligos', 'Read count', 'Dedup read count', 'FPKM', 'Dup %'])
-    
-    for synthetic_oligo_count in glob.glob("*synthetic_oligos_stats.txt"):
-        individual_df = pd.read_csv(synthetic_oligo_count, header=0,index_col=None,sep="\t")
-        synthetic_df = synthetic_df.append(individual_df, ignore_index=True)
+    synthetic_df = load_tables("*synthetic_oligos_stats.txt", SYNTHETIC_OLIGO_COLUMNS, SYNTHETIC_OLIGO_DTYPES)
 
     synthetic_flag(synthetic_df, 5)
     print(synthetic_df)
 
     if sampleinfo is not None:
-        sampleinfo_data = pd.read_csv(sampleinfo, header=0, sep="\t",index_col=None)
+        sampleinfo_data = read_table(sampleinfo, ["Sample"], {"Sample": str})
         synthetic_df = pd.merge(sampleinfo_data, synthetic_df, on="Sample", how='outer').fillna('NA')
     
     synthetic_df.to_csv("synthetic_oligo_summary_" + timestr + ".txt", index = None, sep="\t")
 
 def synthetic_flag(df, threshold):
+    #each oligo is compared to the median FPKM of the same oligo in all the samples
     df["FPKM"] = df["FPKM"].astype(float)
-    mean_fpkm = df["FPKM"].median().astype(float)
-    print(mean_fpkm)
+    mean_fpkm = df.groupby("Synthetic oligos")["FPKM"].transform("median")
+    print(df.groupby("Synthetic oligos")["FPKM"].median())
     df['5Xflag'] = np.where((df['FPKM'] < (  mean_fpkm / threshold )) ^ (df['FPKM'] > (mean_fpkm * threshold)), "FLAG", "")
 
 if __name__ == '__main__':
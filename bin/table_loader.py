@@ -0,0 +1,43 @@
+"""
+Loader of the per-sample tables of a run (one tab separated file per sample), shared by the
+run summaries. The files are read concurrently with explicit types for the given columns,
+each file is checked for the required columns, the optional columns missing from a file are
+added as empty (NaN) columns, and the tables are concatenated once.
+"""
+
+import glob
+import os
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+
+
+def read_table(path, columns=(), dtypes=None, header=0, optional=(), **read_options):
+    #a tab separated file with all the required columns, and the optional columns (NaN when missing from the file)
+    table = pd.read_csv(path, sep="\t", header=header, index_col=None, dtype=dtypes, **read_options)
+    missing = [column for column in columns if column not in table.columns and column not in optional]
+    if missing:
+        raise ValueError(path + " is missing the columns: " + ", ".join(missing))
+    for column in optional:
+        if column not in table.columns:
+            table[column] = pd.Series(dtype=(dtypes or {}).get(column, float), index=table.index)
+    return table
+
+
+def load_tables(pattern, columns=(), dtypes=None, cpus=None, sample_name=None, optional=(), **read_options):
+    #concatenate the tables of all the files matching the pattern (or the list of files), in the order of the file names
+    #sample_name: function deriving the Sample column of each table from its file name
+    #optional: columns of the tables that may be missing from some of the files
+    paths = sorted(glob.glob(pattern)) if isinstance(pattern, str) else list(pattern)
+    if not paths:
+        #an empty table with the expected columns
+        return pd.DataFrame({column: pd.Series(dtype=(dtypes or {}).get(column, object)) for column in list(columns) + [column for column in optional if column not in columns]})
+
+    def load(path):
+        table = read_table(path, columns, dtypes, optional=optional, **read_options)
+        if sample_name is not None:
+            table.insert(0, "Sample", sample_name(os.path.basename(path)))
+        return table
+
+    with ThreadPoolExecutor(max_workers=cpus) as executor:
+        tables = list(executor.map(load, paths))
+    return pd.concat(tables, ignore_index=True, sort=False)
@@ -74,6 +74,26 @@ def helpMessage () {
                                                         Required if --contamination_detection option is specified
                                                         '0.01'
 
+      --covstats_parallel_targets '[value]'             Number of viral targets aligned concurrently in the COVSTATS steps.
+                                                        The cpus of the process are split evenly between these targets
+                                                        '1'
+
+      --covstats_alignment '[per_target/combined]'      Align the reads separately to each viral target (per_target) or once against
+                                                        a single index holding all the targets (combined) in the COVSTATS steps.
+                                                        combined reports all the alignments of each read, so a read matching several
+                                                        targets is counted for each of them as with per_target. Only the placement of
+                                                        a read with several alignments within the same target may differ
+                                                        'per_target'
+
+      --covstats_checkpoint_dir '[path]'                Directory where the metrics and output files of each viral target are saved
+                                                        once completed in the COVSTATS steps, so that a retry or a rerun with the
+                                                        same inputs only processes the remaining targets
+                                                        [null]
+
+      --covstats_profile_summary [True/False]           Summarise the time and memory spent in each stage of the COVSTATS steps
+                                                        across all samples (per-sample profiles are always written)
+                                                        [False]
+
       --dedup                                           Use UMI-tools dedup to remove duplicate reads  
       
       --maxlen '[value]'                                Maximum read length to extract
@@ -93,6 +113,29 @@ def helpMessage () {
       --qualityfilter [True/False]                      Perform adapter and quality filtering of fastq files
                                                         [False]
 
+      --reference_cache_dir '[path]'                    Directory of a persistent cache of the reference sequences (and their bowtie
+                                                        indices) retrieved in the COVSTATS steps, shared across samples and runs.
+                                                        Can be prepared for the viral database with bin/prepare_viral_db.py
+                                                        [null]
+
+      --reference_cache_max_gb '[value]'                Maximum size of the reference cache, the least recently used references
+                                                        are evicted beyond it once all the COVSTATS steps of the run are completed
+                                                        '20'
+
+      --reference_cache_grace_hours '[value]'           References of the cache used within this period are never evicted, as
+                                                        another run sharing the cache may still be using them
+                                                        '24'
+
+      --reference_fallback_fasta '[path]'               Local fasta file used instead of NCBI (esearch/efetch) to retrieve the
+                                                        references missing from the blast database
+                                                        [null]
+
+      --rna_source_index '[path]'                       Combined bowtie index of all the RNA types (built once with
+                                                        bin/prepare_rna_source_index.py). When specified, the RNA source profile
+                                                        aligns the collapsed reads once to this index instead of aligning the
+                                                        reads to each RNA type in turn
+                                                        [null]
+
       --rna_source_profile                              Evaluates the sRNA library content
                                                         [False]
 
@@ -118,8 +161,11 @@ def helpMessage () {
     Internal SSG usage only
       --diagno                                          Additional information will be added to each viral detection to facilitate interpretation 
                                                         [False]
-      --synthetic_oligos                                Reads will be aligned to specific synthetic oligos
+      --synthetic_oligos                                Reads will be matched to specific synthetic oligos
                                                         [False]
+      --synthetic_oligos_fasta '[path]'                 Fasta file of the synthetic oligos to count (celmiR39, celmiR54 and celmiR238
+                                                        by default)
+                                                        [null]
       --sampleinfo                                      Appends additional sample information to final summary to facilitate diagnostics reporting
                                                         [False]
       --sampleinfo_path                                 Path_to_sample_info to be appended
@@ -145,6 +191,12 @@ if (params.blast_viral_db_path != null) {
 if (params.virusdetect_db_path != null) {
     virusdetect_db_dir = file(params.virusdetect_db_path).parent
 }
+if (params.rna_source_index != null) {
+    rna_source_index_dir = file(params.rna_source_index).parent
+}
+if (params.synthetic_oligos_fasta != null) {
+    synthetic_oligos_dir = file(params.synthetic_oligos_fasta).parent
+}
 size_range = "${params.minlen}-${params.maxlen}nt"
 if (params.sampleinfo_path != null) {
     sampleinfo_dir = file(params.sampleinfo_path).parent
@@ -176,6 +228,18 @@ switch (workflow.containerEngine) {
         if (params.samplesheet_path != null) {
             bindbuild = (bindbuild + "-v ${samplesheet_dir}:${samplesheet_dir} ")
         }
+        if (params.reference_cache_dir != null) {
+            bindbuild = (bindbuild + "-v ${params.reference_cache_dir}:${params.reference_cache_dir} ")
+        }
+        if (params.covstats_checkpoint_dir != null) {
+            bindbuild = (bindbuild + "-v ${params.covstats_checkpoint_dir}:${params.covstats_checkpoint_dir} ")
+        }
+        if (params.rna_source_index != null) {
+            bindbuild = (bindbuild + "-v ${rna_source_index_dir}:${rna_source_index_dir} ")
+        }
+        if (params.synthetic_oligos_fasta != null) {
+            bindbuild = (bindbuild + "-v ${synthetic_oligos_dir}:${synthetic_oligos_dir} ")
+        }
         bindOptions = bindbuild;
         break;
     case "singularity":
@@ -198,6 +262,18 @@ switch (workflow.containerEngine) {
         if (params.samplesheet_path != null) {
             bindbuild = (bindbuild + "-B ${samplesheet_dir} ")
         }
+        if (params.reference_cache_dir != null) {
+            bindbuild = (bindbuild + "-B ${params.reference_cache_dir} ")
+        }
+        if (params.covstats_checkpoint_dir != null) {
+            bindbuild = (bindbuild + "-B ${params.covstats_checkpoint_dir} ")
+        }
+        if (params.rna_source_index != null) {
+            bindbuild = (bindbuild + "-B ${rna_source_index_dir} ")
+        }
+        if (params.synthetic_oligos_fasta != null) {
+            bindbuild = (bindbuild + "-B ${synthetic_oligos_dir} ")
+        }
         bindOptions = bindbuild;
         break;
     default:
@@ -257,6 +333,7 @@ process ADAPTER_TRIMMING {
     path("${sampleid}_umi_tools.log")
     path("${sampleid}_truseq_adapter_cutadapt.log")
     path("${sampleid}_umi_tools.log"), emit: umi_tools_results
+    tuple val(sampleid), path("${sampleid}_truseq_adapter_cutadapt.log"), emit: raw_read_count_log
     tuple val(sampleid), path(fastqfile), path("${sampleid}_umi_cleaned.fastq.gz"), emit: adapter_trimmed
     tuple val(sampleid), path("${sampleid}_umi_cleaned.fastq.gz"), emit: adapter_trimmed2
     
@@ -284,7 +361,7 @@ process ADAPTER_TRIMMING {
 process QUAL_TRIMMING_AND_QC {
     label "setting_3"
     tag "$sampleid"
-    publishDir "${params.outdir}/00_quality_filtering/${sampleid}", mode: 'link', overwrite: true, pattern: "*{log,json,html,trimmed.fastq.gz,zip,html,png,pdf,txt}"
+    publishDir "${params.outdir}/00_quality_filtering/${sampleid}", mode: 'link', overwrite: true, pattern: "*{log,json,html,trimmed.fastq.gz,collapsed_reads.tsv.gz,zip,html,png,pdf,txt}"
     
     input:
     tuple val(sampleid), path(fastqfile), path(fastq_filt_by_size)
@@ -298,8 +375,10 @@ process QUAL_TRIMMING_AND_QC {
     file "${sampleid}_read_length_dist.txt"
     file "${sampleid}_quality_trimmed.fastq.gz"
     file "${sampleid}_qual_filtering_cutadapt.log"
+    file "${sampleid}_collapsed_reads.tsv.gz"
 
     path("${sampleid}_qual_filtering_cutadapt.log"), emit: cutadapt_qual_filt_results
+    tuple val(sampleid), path("${sampleid}_collapsed_reads.tsv.gz"), emit: collapsed_reads
     tuple val(sampleid), file(fastqfile), path("${sampleid}_quality_trimmed.fastq"), emit: qual_trimmed
     path("${sampleid}_fastp.json"), emit: fastp_results
     path("${sampleid}_read_length_dist.txt"), emit: read_length_dist_results
@@ -329,13 +408,15 @@ process QUAL_TRIMMING_AND_QC {
             -o ${sampleid}_quality_trimmed_temp.fastq \
             ${sampleid}_umi_cleaned.fastq.gz
     
-    fastq2fasta.pl ${sampleid}_quality_trimmed_temp.fastq > ${sampleid}_quality_trimmed.fasta
+    #distinct sequences of the quality filtered reads > 5 bp long with their number of reads,
+    #shared with the steps that only need the read sequences and counts
+    collapse_reads.py --fastq ${sampleid}_quality_trimmed_temp.fastq --tsv ${sampleid}_collapsed_reads.tsv.gz
     
-    read_length_dist.py --input ${sampleid}_quality_trimmed.fasta
+    read_length_dist.py --input ${sampleid}_collapsed_reads.tsv.gz --collapsed
     
-    mv ${sampleid}_quality_trimmed.fasta_read_length_dist.txt ${sampleid}_read_length_dist.txt
-    mv ${sampleid}_quality_trimmed.fasta_read_length_dist.png ${sampleid}_read_length_dist.png
-    mv ${sampleid}_quality_trimmed.fasta_read_length_dist.pdf ${sampleid}_read_length_dist.pdf
+    mv ${sampleid}_collapsed_reads.tsv.gz_read_length_dist.txt ${sampleid}_read_length_dist.txt
+    mv ${sampleid}_collapsed_reads.tsv.gz_read_length_dist.png ${sampleid}_read_length_dist.png
+    mv ${sampleid}_collapsed_reads.tsv.gz_read_length_dist.pdf ${sampleid}_read_length_dist.pdf
     rm ${sampleid}_quality_trimmed_temp.fastq
     """
 }
@@ -347,14 +428,21 @@ process RNA_SOURCE_PROFILE {
     containerOptions "${bindOptions}"
 
     input:
-    tuple val(sampleid), file(fastqfile)
+    tuple val(sampleid), file(fastqfile), path(collapsed_reads)
     
     output:
     path("${sampleid}_bowtie.log")
     path("${sampleid}_bowtie.log"), emit: rna_source_bowtie_results
+    path("${sampleid}_rna_source_counts.tsv"), optional: true, emit: rna_source_counts
 
     script:
     """
+    if [[ "${params.rna_source_index}" != "null" ]]; then
+        #align the collapsed quality filtered reads > 15 bp long once to the combined index of all the RNA types
+        rna_source_classify.py --collapsed ${collapsed_reads} --min_length 15 --sample ${sampleid} --index ${params.rna_source_index} --bowtie_db_dir ${params.bowtie_db_dir} --cpus ${task.cpus}
+        exit 0
+    fi
+
     cutadapt -j ${task.cpus} \
             --trim-n --max-n 0 -m 15 -q 30 \
             -o ${sampleid}_quality_trimmed_temp2.fastq \
@@ -391,7 +479,7 @@ process RNA_SOURCE_PROFILE_REPORT {
     containerOptions "${bindOptions}"
 
     input:
-    path("*bowtie.log")
+    path('*')
 
     output:
     path("read_origin_pc_summary*.txt")
@@ -438,16 +526,14 @@ process DERIVE_USABLE_READS {
             ${qual_trimmed_fastqfile} \
             ${sampleid}_blacklist_match 2>${sampleid}_blacklist_filter.log
 
-    cutadapt -j ${task.cpus} -m 18 -M 25 -o ${sampleid}_18-25nt.fastq.gz ${sampleid}_cleaned.fastq > ${sampleid}_18-25nt_cutadapt.log
-    cutadapt -j ${task.cpus} -m 21 -M 22 -o ${sampleid}_21-22nt.fastq ${sampleid}_cleaned.fastq > ${sampleid}_21-22nt_cutadapt.log
-    cutadapt -j ${task.cpus} -m 24 -M 24 -o ${sampleid}_24nt.fastq.gz ${sampleid}_cleaned.fastq > ${sampleid}_24nt_cutadapt.log
-    if [[ ${params.minlen} != 21 ]] || [[ ${params.maxlen} != 22 ]]; then
-        cutadapt -j ${task.cpus} -m ${params.minlen} -M ${params.maxlen} -o ${sampleid}_${params.minlen}-${params.maxlen}nt.fastq ${sampleid}_cleaned.fastq > ${sampleid}_${params.minlen}-${params.maxlen}nt_cutadapt.log
-    fi
-
-    rm ${sampleid}_24nt.fastq.gz ${sampleid}_18-25nt.fastq.gz
-
-    pigz --best --force -p ${task.cpus} -r ${sampleid}_${params.minlen}-${params.maxlen}nt.fastq -c > ${sampleid}_${params.minlen}-${params.maxlen}nt.fastq.gz
+    #read the cleaned reads once to count the 18-25nt, 21-22nt and 24nt reads (cutadapt-like log for each bin)
+    #and write the 21-22nt and minlen-maxlen reads, the latter compressed at the same time (pigz --best)
+    split_by_length.py --fastq ${sampleid}_cleaned.fastq --prefix ${sampleid} \
+        --bins 18-25 21-22 24 ${params.minlen}-${params.maxlen} \
+        --write 21-22 ${params.minlen}-${params.maxlen} \
+        --compress ${params.minlen}-${params.maxlen} \
+        --level 9 \
+        --cpus ${task.cpus}
     """
 }
 /*
@@ -462,6 +548,7 @@ file("*qual_filtering_cutadapt.log")
     */
 
 process QCREPORT {
+    label "setting_3"
     publishDir "${params.outdir}/00_quality_filtering/qc_report", mode: 'link', overwrite: true
     containerOptions "${bindOptions}"
 
@@ -476,9 +563,9 @@ process QCREPORT {
     script:
     """
     if [[ ${params.sampleinfo} == true ]]; then
-        seq_run_qc_report.py --sampleinfopath ${params.sampleinfo_path} --samplesheetpath ${params.samplesheet_path}
+        seq_run_qc_report.py --sampleinfopath ${params.sampleinfo_path} --samplesheetpath ${params.samplesheet_path} --cpus ${task.cpus}
     else
-        seq_run_qc_report.py 
+        seq_run_qc_report.py --cpus ${task.cpus}
     fi
 
     grouped_bar_chart.py
@@ -495,6 +582,7 @@ process READPROCESSING {
     output:
     path("${sampleid}_${size_range}_cutadapt.log")
     path("${sampleid}_${size_range}.fastq")
+    tuple val(sampleid), path("${sampleid}_${size_range}_cutadapt.log"), emit: raw_read_count_log
     tuple val(sampleid),
           path("unzipped.fastq"),
           path("${sampleid}_${size_range}.fastq"),
@@ -652,14 +740,11 @@ process FILTER_BLASTN_VIRAL_DB_CAP3 {
     #retain 1st blast hit
     for var in ${sampleid}_cap3_${size_range}_megablast_vs_viral_db.bls ${sampleid}_cap3_${size_range}_blastn_vs_viral_db.bls;
         do 
-            cat \${var} | awk '{print \$1}' | sort | uniq > \${var}.top1.ids
-            for i in `cat \${var}.top1.ids`; do echo "fetching top hits..." \$i; grep \$i \${var} | head -1 >> \${var}.top1Hits.txt ; done
+            blast_top_hits.py --blast \${var} --top 1 --out \${var}.top1Hits.txt
             cat \${var}.top1Hits.txt | sed 's/ /_/g' > \${var}.txt
 
-            #summarise the blast files
-            java -jar ${projectDir}/bin/BlastTools.jar -t blastn \${var}.txt
-
-            sequence_length.py --virus_list summary_\${var}.txt --contig_fasta ${sampleid}_cap3_${size_range}.fasta --out summary_\${var}_with_contig_lengths.txt
+            #summarise the blast files and add the contig lengths
+            sequence_length.py --blast \${var}.txt --contig_fasta ${sampleid}_cap3_${size_range}.fasta --out summary_\${var}_with_contig_lengths.txt
 
             #only retain hits to plant viruses
             c1grep  "virus\\|viroid\\|Endogenous" summary_\${var}_with_contig_lengths.txt > summary_\${var}_filtered.txt
@@ -706,24 +791,21 @@ process FILTER_BLASTN_VIRAL_DB_CAP3 {
 process COVSTATS_VIRAL_DB {
     tag "$sampleid"
     label "setting_2"
-    publishDir "${params.outdir}/01_VirReport/${sampleid}/alignments/viral_db", mode: 'link', overwrite: true, pattern: "*{.fa*,.fasta,metrics.txt,scores.txt,targets.txt,stats.txt,log.txt,.bcf*,.vcf.gz*,.bam*}"
+    publishDir "${params.outdir}/01_VirReport/${sampleid}/alignments/viral_db", mode: 'link', overwrite: true, pattern: "*{.fa*,.fasta,metrics.txt,scores.txt,targets.txt,stats.txt,log.txt,.bcf*,.vcf.gz*,.bam*,profile.tsv,profile.json}"
     containerOptions "${bindOptions}"
     
     input:
-    tuple val(sampleid), path(fastqfile), path(fastq_filt_by_size), path(samplefile)
+    tuple val(sampleid), path(fastqfile), path(fastq_filt_by_size), path(samplefile), path(rawfastq_log)
     output:
     path("${sampleid}_${size_range}*")
     path("${sampleid}_${size_range}_top_scoring_targets_with_cov_stats_viral_db.txt"), emit: viral_db_detections_summary
+    path("${sampleid}_${size_range}_covstats_viral_db_profile.tsv"), optional: true, emit: covstats_profile
     
     script:
+    def reference_cache_param = (params.reference_cache_dir != null) ? "--reference_cache ${params.reference_cache_dir}" : ''
+    def checkpoint_param = (params.covstats_checkpoint_dir != null) ? "--checkpoint_dir ${params.covstats_checkpoint_dir}" : ''
     """
-     if [[ ${fastqfile} == *.gz ]];
-    then
-        gunzip -c ${fastqfile} > qfilt.fastq
-    else
-        ln ${fastqfile} qfilt.fastq
-    fi
-    filter_and_derive_stats.py --sample ${sampleid} --rawfastq qfilt.fastq --fastqfiltbysize  ${fastq_filt_by_size} --results ${samplefile} --read_size ${size_range} --blastdbpath ${blast_viral_db_dir}/${blast_viral_db_name} --dedup ${params.dedup} --mode viral_db --cpu ${task.cpus}
+    filter_and_derive_stats.py --sample ${sampleid} --rawfastq ${fastqfile} --rawfastq_log ${rawfastq_log} --fastqfiltbysize  ${fastq_filt_by_size} --results ${samplefile} --read_size ${size_range} --blastdbpath ${blast_viral_db_dir}/${blast_viral_db_name} --dedup ${params.dedup} --mode viral_db --cpu ${task.cpus} --parallel_targets ${params.covstats_parallel_targets} --alignment ${params.covstats_alignment} ${reference_cache_param} ${checkpoint_param}
     """
 }
 
@@ -777,13 +859,11 @@ process TBLASTN_VIRAL_DB {
         -max_target_seqs 10 \
         -outfmt '6 qseqid sseqid pident nident length mismatch gapopen gaps qstart qend qlen qframe sstart send slen evalue bitscore qcovhsp sallseqid stitle'
     
-    grep ">" ${sampleid}_cap3_${size_range}_getorf.all.fasta | sed 's/>//' | cut -f1 -d ' ' | sort | uniq > ${sampleid}_cap3_${size_range}_getorf.all_tblastn_vs_viral_db_out.wanted.ids
-    for i in `cat ${sampleid}_cap3_${size_range}_getorf.all_tblastn_vs_viral_db_out.wanted.ids`; do
-        grep \$i ${sampleid}_cap3_${size_range}_getorf.all_tblastn_vs_viral_db_out.bls | head -n5 >> ${sampleid}_cap3_${size_range}_getorf.all_tblastn_vs_viral_db_top5Hits.txt;
-    done
-
-    grep -i "Virus" ${sampleid}_cap3_${size_range}_getorf.all_tblastn_vs_viral_db_top5Hits.txt > ${sampleid}_cap3_${size_range}_getorf.all_tblastn_vs_viral_db_top5Hits_virus_viroids.txt  || [[ \$? == 1 ]]
-    grep -i "Viroid" ${sampleid}_cap3_${size_range}_getorf.all_tblastn_vs_viral_db_top5Hits.txt >> ${sampleid}_cap3_${size_range}_getorf.all_tblastn_vs_viral_db_top5Hits_virus_viroids.txt || [[ \$? == 1 ]]
+    #fetch the top 5 hits of each ORF and the subset of hits to viruses and viroids
+    blast_top_hits.py --blast ${sampleid}_cap3_${size_range}_getorf.all_tblastn_vs_viral_db_out.bls \
+        --top 5 \
+        --out ${sampleid}_cap3_${size_range}_getorf.all_tblastn_vs_viral_db_top5Hits.txt \
+        --virus_out ${sampleid}_cap3_${size_range}_getorf.all_tblastn_vs_viral_db_top5Hits_virus_viroids.txt
     
     #modify accordingly depending on version of viral_db
     cut -f2 ${sampleid}_cap3_${size_range}_getorf.all_tblastn_vs_viral_db_top5Hits_virus_viroids.txt | cut -f2 -d '|' > seq_ids.txt
@@ -844,49 +924,45 @@ process BLASTN_NT_CAP3 {
         -max_target_seqs 50 \
         -word_size 24
 
-    grep ">" ${cap3_fasta.baseName}.fasta | sed 's/>//' > ${cap3_fasta.baseName}.ids
-    
     #fetch top blastn hits
-    for i in `cat ${cap3_fasta.baseName}.ids`; do
-        grep \$i ${cap3_fasta.baseName}_blastn_vs_NT.bls | head -n5 >> ${cap3_fasta.baseName}_blastn_vs_NT_top5Hits.txt;
-    done
-    
-    grep -i "Virus" ${cap3_fasta.baseName}_blastn_vs_NT_top5Hits.txt > ${cap3_fasta.baseName}_blastn_vs_NT_top5Hits_virus_viroids_tmp.txt  || [[ \$? == 1 ]]
-    grep -i "Viroid" ${cap3_fasta.baseName}_blastn_vs_NT_top5Hits.txt >> ${cap3_fasta.baseName}_blastn_vs_NT_top5Hits_virus_viroids_tmp.txt || [[ \$? == 1 ]]
+    blast_top_hits.py --blast ${cap3_fasta.baseName}_blastn_vs_NT.bls \
+        --top 5 \
+        --out ${cap3_fasta.baseName}_blastn_vs_NT_top5Hits.txt \
+        --virus_out ${cap3_fasta.baseName}_blastn_vs_NT_top5Hits_virus_viroids_tmp.txt
     cat ${cap3_fasta.baseName}_blastn_vs_NT_top5Hits_virus_viroids_tmp.txt | sed 's/ /_/g' > ${cap3_fasta.baseName}_blastn_vs_NT_top5Hits_virus_viroids.txt
     cut -f3,26 ${cap3_fasta.baseName}_blastn_vs_NT_top5Hits_virus_viroids.txt | sort | uniq > ${cap3_fasta.baseName}_blastn_vs_NT_top5Hits_virus_viroids_seq_ids_taxonomy.txt
-    
-    java -jar ${projectDir}/bin/BlastTools.jar -t blastn ${cap3_fasta.baseName}_blastn_vs_NT_top5Hits_virus_viroids.txt
 
     rm taxdb.btd
     rm taxdb.bti
     
-    sequence_length.py --virus_list summary_${cap3_fasta.baseName}_blastn_vs_NT_top5Hits_virus_viroids.txt --contig_fasta ${cap3_fasta.baseName}.fasta --out summary_${cap3_fasta.baseName}_blastn_vs_NT_top5Hits_virus_viroids_final.txt
+    #summarise the blast hits and add the contig lengths
+    sequence_length.py --blast ${cap3_fasta.baseName}_blastn_vs_NT_top5Hits_virus_viroids.txt \
+        --summary_out summary_${cap3_fasta.baseName}_blastn_vs_NT_top5Hits_virus_viroids.txt \
+        --contig_fasta ${cap3_fasta.baseName}.fasta \
+        --out summary_${cap3_fasta.baseName}_blastn_vs_NT_top5Hits_virus_viroids_final.txt
     """
 }
 
 process COVSTATS_NT {
     tag "$sampleid"
     label "setting_2"
-    publishDir "${params.outdir}/01_VirReport/${sampleid}/alignments/NT", mode: 'link', overwrite: true, pattern: "*{.fa*,.fasta,metrics.txt,scores.txt,targets.txt,stats.txt,log.txt,.bcf*,.vcf.gz*,.bam*}"
+    publishDir "${params.outdir}/01_VirReport/${sampleid}/alignments/NT", mode: 'link', overwrite: true, pattern: "*{.fa*,.fasta,metrics.txt,scores.txt,targets.txt,stats.txt,log.txt,.bcf*,.vcf.gz*,.bam*,profile.tsv,profile.json}"
     containerOptions "${bindOptions}"
     
     input:
-    tuple val(sampleid), file(fastqfile), file(fastq_filt_by_size), file(samplefile), file(taxonomy)
+    tuple val(sampleid), file(fastqfile), file(fastq_filt_by_size), file(samplefile), file(taxonomy), file(rawfastq_log)
 
     output:
     path("${sampleid}_${size_range}*")
     path("${sampleid}_${size_range}_top_scoring_targets_*with_cov_stats.txt"), emit: viral_ncbi_detections_summary
+    path("${sampleid}_${size_range}_covstats_profile.tsv"), optional: true, emit: covstats_profile
     
     script:
+    def reference_cache_param = (params.reference_cache_dir != null) ? "--reference_cache ${params.reference_cache_dir}" : ''
+    def checkpoint_param = (params.covstats_checkpoint_dir != null) ? "--checkpoint_dir ${params.covstats_checkpoint_dir}" : ''
+    def reference_fallback_param = (params.reference_fallback_fasta != null) ? "--reference_fallback_fasta ${params.reference_fallback_fasta}" : ''
     """
-    if [[ ${fastqfile} == *.gz ]];
-    then
-        gunzip -c ${fastqfile} > qfilt.fastq
-    else
-        ln ${fastqfile} qfilt.fastq
-    fi
-    filter_and_derive_stats.py --sample ${sampleid} --rawfastq qfilt.fastq --fastqfiltbysize  ${fastq_filt_by_size} --results ${samplefile} --read_size ${size_range} --taxonomy ${taxonomy} --blastdbpath ${blastn_db_name} --dedup ${params.dedup} --cpu ${task.cpus} --mode ncbi
+    filter_and_derive_stats.py --sample ${sampleid} --rawfastq ${fastqfile} --rawfastq_log ${rawfastq_log} --fastqfiltbysize  ${fastq_filt_by_size} --results ${samplefile} --read_size ${size_range} --taxonomy ${taxonomy} --blastdbpath ${blastn_db_name} --dedup ${params.dedup} --cpu ${task.cpus} --mode ncbi --parallel_targets ${params.covstats_parallel_targets} --alignment ${params.covstats_alignment} ${reference_cache_param} ${reference_fallback_param} ${checkpoint_param}
     
     """
 }
@@ -912,6 +988,36 @@ process DETECTION_REPORT_NT {
     """
 }
 
+process COVSTATS_PROFILE_SUMMARY {
+    label "local"
+    publishDir "${params.outdir}/01_VirReport/Summary", mode: 'copy', overwrite: true
+    containerOptions "${bindOptions}"
+
+    input:
+    path('*')
+
+    output:
+    path("VirReport_covstats_profile_*.txt")
+
+    script:
+    """
+    profile_summary.py --read_size ${size_range}
+    """
+}
+
+process REFERENCE_CACHE_EVICT {
+    label "local"
+    containerOptions "${bindOptions}"
+
+    input:
+    path('*')
+
+    script:
+    """
+    reference_cache_evict.py --reference_cache ${params.reference_cache_dir} --max_gb ${params.reference_cache_max_gb} --grace_hours ${params.reference_cache_grace_hours}
+    """
+}
+
 //blastx jobs runs out of memory if only given 64Gb
 process BLASTX {
     label "setting_8"
@@ -961,19 +1067,14 @@ process BLASTX {
         -outfmt '6 qseqid sseqid pident nident length mismatch gapopen gaps qstart qend qlen qframe sstart send slen evalue bitscore qcovhsp sallseqid sscinames' \
         -max_target_seqs 1
 
-    #grep ">" ${cap3_fasta} | sed 's/>//' > ${cap3_fasta.baseName}.ids
-    cut -f1 ${cap3_fasta.baseName}_blastx_vs_NT.bls  | sed 's/ //' | sort | uniq > ${cap3_fasta.baseName}.ids
-    
-    #fetch top blastn hits
-    touch  ${cap3_fasta.baseName}_blastx_vs_NT_topHits.txt
-    for i in `cat ${cap3_fasta.baseName}.ids`; do
-        grep \$i ${cap3_fasta.baseName}_blastx_vs_NT.bls | head -n1 >> ${cap3_fasta.baseName}_blastx_vs_NT_topHits.txt;
-    done
-    grep -i "Virus" ${cap3_fasta.baseName}_blastx_vs_NT_topHits.txt > ${cap3_fasta.baseName}_blastx_vs_NT_topHits_virus_viroids.txt  || [[ \$? == 1 ]]
-    grep -i "Viroid" ${cap3_fasta.baseName}_blastx_vs_NT_topHits.txt >> ${cap3_fasta.baseName}_blastx_vs_NT_topHits_virus_viroids.txt  || [[ \$? == 1 ]]
+    #fetch top blastx hits
+    blast_top_hits.py --blast ${cap3_fasta.baseName}_blastx_vs_NT.bls \
+        --top 1 \
+        --out ${cap3_fasta.baseName}_blastx_vs_NT_topHits.txt \
+        --virus_out ${cap3_fasta.baseName}_blastx_vs_NT_topHits_virus_viroids.txt
     sed 's/ /_/g' ${cap3_fasta.baseName}_blastx_vs_NT_topHits_virus_viroids.txt  |  awk -v OFS='\\t' '{ print \$2,\$1,\$3,\$4,\$5,\$6,\$7,\$8,\$9,\$10,\$11,\$12,\$13,\$14,\$15,\$16,\$17,\$18,\$19,\$20}' > ${cap3_fasta.baseName}_blastx_vs_NT_topHits_virus_viroids_final.txt
     
-    java -jar ${projectDir}/bin/BlastTools.jar -t blastp ${cap3_fasta.baseName}_blastx_vs_NT_topHits_virus_viroids_final.txt
+    blast_summary.py --blast ${cap3_fasta.baseName}_blastx_vs_NT_topHits_virus_viroids_final.txt --program blastp
     rm taxdb.btd
     rm taxdb.bti
     """
@@ -1119,18 +1220,19 @@ process SYNTHETIC_OLIGOS {
     tag "$sampleid"
     label "setting_2"
     publishDir "${params.outdir}/00_quality_filtering/${sampleid}/synthetic_oligos", mode: 'copy', overwrite: true
+    containerOptions "${bindOptions}"
     
     input:
-    tuple val(sampleid), file(fastqfile), file(qual_filtered_fastqfile)
+    tuple val(sampleid), file(fastqfile), file(qual_filtered_fastqfile), file(rawfastq_log)
 
     output:
     file("${sampleid}_${size_range}_synthetic_oligos_stats.txt")
     path("${sampleid}_${size_range}_synthetic_oligos_stats.txt"), emit: synthetic_oligo_results
     
     script:
+    def oligos_param = (params.synthetic_oligos_fasta != null) ? "--oligos ${params.synthetic_oligos_fasta}" : ''
     """
-    gunzip -c ${fastqfile} > ${fastqfile.baseName}
-    synthetic_oligos.py --sample ${sampleid} --rawfastq ${fastqfile.baseName} --fastqfiltbysize ${qual_filtered_fastqfile} --read_size ${size_range}
+    synthetic_oligos.py --sample ${sampleid} --rawfastq ${fastqfile} --rawfastq_log ${rawfastq_log} --fastqfiltbysize ${qual_filtered_fastqfile} --read_size ${size_range} ${oligos_param}
     """
 }
 
@@ -1173,13 +1275,15 @@ workflow {
     FASTQC_RAW(samples_ch) 
     MERGE_LANES(samples_ch)
     ADAPTER_TRIMMING(MERGE_LANES.out.merged)
+    //the adapter trimming log records the number of reads of the merged fastq file, reused to derive RPM and FPKM values
+    raw_read_count_log_ch = ADAPTER_TRIMMING.out.raw_read_count_log
     QUAL_TRIMMING_AND_QC(ADAPTER_TRIMMING.out.adapter_trimmed)
     if (params.rna_source_profile) {
-      RNA_SOURCE_PROFILE(ADAPTER_TRIMMING.out.adapter_trimmed2)
-      RNA_SOURCE_PROFILE_REPORT(RNA_SOURCE_PROFILE.out.rna_source_bowtie_results.collect().ifEmpty([]))
+      RNA_SOURCE_PROFILE(ADAPTER_TRIMMING.out.adapter_trimmed2.join(QUAL_TRIMMING_AND_QC.out.collapsed_reads))
+      RNA_SOURCE_PROFILE_REPORT(RNA_SOURCE_PROFILE.out.rna_source_bowtie_results.mix(RNA_SOURCE_PROFILE.out.rna_source_counts).collect().ifEmpty([]))
       }
     if (params.synthetic_oligos) {
-      SYNTHETIC_OLIGOS(QUAL_TRIMMING_AND_QC.out.qual_trimmed)
+      SYNTHETIC_OLIGOS(QUAL_TRIMMING_AND_QC.out.qual_trimmed.join(raw_read_count_log_ch))
       SYNTHETIC_OLIGO_SUMMARY(SYNTHETIC_OLIGOS.out.synthetic_oligo_results.collect().ifEmpty([]))
     }
     DERIVE_USABLE_READS(QUAL_TRIMMING_AND_QC.out.qual_trimmed)
@@ -1208,13 +1312,14 @@ workflow {
     } else {
     // If user does not specify qualityfilter parameter, then only read size selection (using the minlen and maxlen params specified in the nextflow.config file) will be performed on the fastq file specified in the index file
     READPROCESSING(read_size_selection_ch)
+    raw_read_count_log_ch = READPROCESSING.out.raw_read_count_log
     DENOVO_ASSEMBLY(READPROCESSING.out.fastq)
     }
 
   if (params.virreport_viral_db) {
     BLASTN_VIRAL_DB_CAP3(DENOVO_ASSEMBLY.out.assembly_for_blastn)
     FILTER_BLASTN_VIRAL_DB_CAP3(BLASTN_VIRAL_DB_CAP3.out.blast_results)
-    COVSTATS_VIRAL_DB(FILTER_BLASTN_VIRAL_DB_CAP3.out.viral_db_blast_results)
+    COVSTATS_VIRAL_DB(FILTER_BLASTN_VIRAL_DB_CAP3.out.viral_db_blast_results.join(raw_read_count_log_ch))
     if (params.detection_reporting_viral_db) {
       DETECTION_REPORT_VIRAL_DB(COVSTATS_VIRAL_DB.out.viral_db_detections_summary.collect().ifEmpty([]))
     }
@@ -1222,7 +1327,7 @@ workflow {
   }
   if (params.virreport_ncbi) {
     BLASTN_NT_CAP3(DENOVO_ASSEMBLY.out.assembly_for_blastn)
-    COVSTATS_NT(BLASTN_NT_CAP3.out.viral_ncbi_blast_results)
+    COVSTATS_NT(BLASTN_NT_CAP3.out.viral_ncbi_blast_results.join(raw_read_count_log_ch))
     if (params.detection_reporting_nt) {
       DETECTION_REPORT_NT(COVSTATS_NT.out.viral_ncbi_detections_summary.collect().ifEmpty([]))
     }
@@ -1230,6 +1335,27 @@ workflow {
       BLASTX(BLASTN_NT_CAP3.out.viral_ncbi_blast_results_for_blastx)
     }
   }
+  if (params.covstats_profile_summary) {
+    covstats_profile_ch = Channel.empty()
+    if (params.virreport_viral_db) {
+      covstats_profile_ch = covstats_profile_ch.mix(COVSTATS_VIRAL_DB.out.covstats_profile)
+    }
+    if (params.virreport_ncbi) {
+      covstats_profile_ch = covstats_profile_ch.mix(COVSTATS_NT.out.covstats_profile)
+    }
+    COVSTATS_PROFILE_SUMMARY(covstats_profile_ch.collect().ifEmpty([]))
+  }
+  if (params.reference_cache_dir != null) {
+    //evict the reference cache once all the samples of the run are processed
+    covstats_done_ch = Channel.empty()
+    if (params.virreport_viral_db) {
+      covstats_done_ch = covstats_done_ch.mix(COVSTATS_VIRAL_DB.out.viral_db_detections_summary)
+    }
+    if (params.virreport_ncbi) {
+      covstats_done_ch = covstats_done_ch.mix(COVSTATS_NT.out.viral_ncbi_detections_summary)
+    }
+    REFERENCE_CACHE_EVICT(covstats_done_ch.collect().ifEmpty([]))
+  }
   if (params.virusdetect) {
     if (params.qualityfilter) {
       VIRUS_DETECT(DERIVE_USABLE_READS.out.usable_reads)
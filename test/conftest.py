@@ -0,0 +1,6 @@
+import os
+import sys
+
+#the scripts of bin/ import each other as top level modules, as they do on the PATH of the pipeline
+BIN_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bin")
+sys.path.insert(0, BIN_DIR)
@@ -0,0 +1,45 @@
+import os
+import shutil
+import subprocess
+import pytest
+from blast_summary import java_decimal, summary_rows, write_summary
+
+#blast hits of the blastn and blastx (blastp columns) searches of the pipeline, the jar and the expected summaries.
+#The expected summaries were reconstructed from the bytecode of the jar, without a java runtime, they are not the
+#output of the jar: the row order (java.util.HashMap order) and number formats are only confirmed by
+#test_jar_writes_saved_summary, which runs wherever java is installed. To replace them with the output of the jar:
+#cd test/blast_summary && java -jar BlastTools.jar -t blastn blastn_hits.txt && java -jar BlastTools.jar -t blastp blastp_hits.txt
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "blast_summary")
+PROGRAMS = ["blastn", "blastp"]
+
+
+def read_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("program", PROGRAMS)
+def test_summary_matches_saved_summary(program, tmp_path):
+    output = str(tmp_path / "summary.txt")
+    write_summary(summary_rows(os.path.join(FIXTURE_DIR, program + "_hits.txt"), program), output)
+    assert read_bytes(output) == read_bytes(os.path.join(FIXTURE_DIR, "summary_" + program + "_hits.txt"))
+
+
+@pytest.mark.skipif(shutil.which("java") is None, reason="java is not installed")
+@pytest.mark.parametrize("program", PROGRAMS)
+def test_jar_writes_saved_summary(program, tmp_path):
+    #the reconstructed summaries are those written by the jar
+    shutil.copy(os.path.join(FIXTURE_DIR, program + "_hits.txt"), str(tmp_path))
+    subprocess.check_call(["java", "-jar", os.path.join(FIXTURE_DIR, "BlastTools.jar"), "-t", program, program + "_hits.txt"], cwd=str(tmp_path))
+    assert read_bytes(str(tmp_path / ("summary_" + program + "_hits.txt"))) == read_bytes(os.path.join(FIXTURE_DIR, "summary_" + program + "_hits.txt"))
+
+
+def test_java_decimal_format():
+    #java.text.DecimalFormat with at most 3 decimals
+    assert java_decimal(0.0625) == "0.062"
+    assert java_decimal(0.0005) == "0.001"
+    assert java_decimal(2.0) == "2"
+    assert java_decimal(-0.0002) == "-0"
+    assert java_decimal(12345.6789) == "12,345.679"
+    assert java_decimal(float("nan")) == "NaN"
+    assert java_decimal(float("-inf")) == "-∞"
@@ -0,0 +1,24 @@
+from filter_and_derive_stats import reference_alignments
+
+HEADER = ["@HD\tVN:1.0\tSO:coordinate\n", "@SQ\tSN:refA\tLN:100\n", "@SQ\tSN:refB\tLN:80\n", "@PG\tID:Bowtie\n"]
+
+
+def record(name, flag, refname, pos):
+    return "\t".join([name, str(flag), refname, str(pos), "255", "21M", "*", "0", "0", "A" * 21, "I" * 21, "XA:i:0", "MD:Z:21", "NM:i:0"]) + "\n"
+
+
+def test_read_matching_several_targets_is_kept_for_each_of_them():
+    sam = HEADER + [record("r1_AAA", 0, "refA", 5), record("r1_AAA", 256, "refB", 9), record("r2_CCC", 16, "refB", 30)]
+    ref_a = list(reference_alignments(sam, "refA"))
+    ref_b = list(reference_alignments(sam, "refB"))
+    assert [line for line in ref_a if line.startswith("@SQ")] == ["@SQ\tSN:refA\tLN:100\n"]
+    assert [line.split("\t")[0] for line in ref_a if not line.startswith("@")] == ["r1_AAA"]
+    assert [line.split("\t")[:2] for line in ref_b if not line.startswith("@")] == [["r1_AAA", "0"], ["r2_CCC", "16"]]
+
+
+def test_single_alignment_per_read_within_a_target():
+    #bowtie -k 1 reports one alignment per read when aligning to the target alone
+    sam = HEADER + [record("r1_AAA", 0, "refA", 5), record("r1_AAA", 272, "refA", 60), record("r2_CCC", 0, "refA", 60)]
+    alignments = [line for line in reference_alignments(sam, "refA") if not line.startswith("@")]
+    assert [line.split("\t")[:4] for line in alignments] == [["r1_AAA", "0", "refA", "5"], ["r2_CCC", "0", "refA", "60"]]
+    assert alignments[0] == record("r1_AAA", 0, "refA", 5)
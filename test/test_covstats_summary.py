@@ -0,0 +1,33 @@
+import json
+import os
+from collections import OrderedDict
+import pandas as pd
+import pytest
+from filter_and_derive_stats import summary_table
+
+#each case holds the blast results of the targets of a sample (targets.txt), the metrics of each target as saved in the
+#checkpoints (stats.json) and the summary table written by the pipeline before the metrics were gathered in one table
+#(expected_cov_stats.txt)
+CASES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "covstats_summary")
+CASES = sorted(os.listdir(CASES_DIR))
+
+
+@pytest.mark.parametrize("case", CASES)
+def test_summary_table_matches_saved_table(case, tmp_path):
+    case_dir = os.path.join(CASES_DIR, case)
+    with open(os.path.join(case_dir, "stats.json")) as f:
+        record = json.load(f, object_pairs_hook=OrderedDict)
+    final_data = pd.read_csv(os.path.join(case_dir, "targets.txt"), header=0, sep="\t", index_col=None)
+    if record["mode"] == "viral_db":
+        final_data = final_data.rename(columns={"Species": "Species_updated"})
+    target_dict = OrderedDict((refid, refspname) for refid, refspname, stats in record["targets"])
+    target_results = [stats for refid, refspname, stats in record["targets"]]
+
+    full_table = summary_table(final_data, target_dict, target_results, record["sample"], record["mode"])
+    output = str(tmp_path / "cov_stats.txt")
+    full_table.to_csv(output, index=None, sep="\t", float_format="%.2f")
+
+    with open(os.path.join(case_dir, "expected_cov_stats.txt")) as f:
+        expected = f.read()
+    with open(output) as f:
+        assert f.read() == expected
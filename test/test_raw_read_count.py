@@ -0,0 +1,31 @@
+import os
+from fastq_utils import count_fastq_reads, raw_read_count
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+TEST_FASTQ = os.path.join(TEST_DIR, "test.fastq.gz")
+
+#summary of the log of the adapter trimming (cutadapt) of a sample, which reads the merged raw fastq file
+CUTADAPT_LOG = """This is cutadapt 3.5 with Python 3.7.12
+Command line parameters: -j 4 --no-indels -a AGATCGGAAGAGCACACGTCTGAACTCCAGTCA;min_overlap=12 --times 2 -o MT001_trimmed.fastq.gz MT001_R1.merged.fastq.gz
+Processing reads on 4 cores in single-end mode ...
+Finished in 31.09 s (2 us/read; 37.11 M reads/minute).
+
+=== Summary ===
+
+Total reads processed:              19,232,851
+Reads with adapters:                18,967,702 (98.6%)
+Reads written (passing filters):    19,232,851 (100.0%)
+"""
+
+
+def test_raw_read_count_from_adapter_trimming_log(tmp_path):
+    log = tmp_path / "MT001_truseq_adapter_cutadapt.log"
+    log.write_text(CUTADAPT_LOG)
+    #the fastq file is not read when the log records the number of reads
+    assert raw_read_count(str(tmp_path / "missing.fastq.gz"), str(log)) == 19232851
+
+
+def test_raw_read_count_without_count_in_log(tmp_path):
+    log = tmp_path / "MT001_truseq_adapter_cutadapt.log"
+    log.write_text("This is cutadapt 3.5 with Python 3.7.12\n")
+    assert raw_read_count(TEST_FASTQ, str(log)) == count_fastq_reads(TEST_FASTQ) > 0
@@ -0,0 +1,74 @@
+from collections import OrderedDict
+from synthetic_oligos import SYNTHETIC_OLIGOS, count_oligo_reads, directional_groups, oligo_matches
+
+#No bowtie or umi_tools is available to run the former bowtie -v 1 / umi_tools dedup chain on these reads, so the
+#expected counts are derived by hand following umi_tools dedup: reads are grouped by strand and position (alignment
+#start on the forward strand, alignment end on the reverse strand) and each position holds one read per directional
+#UMI group. The former script only reported celmiR39; the stats now have one row per oligo of the panel.
+CELMIR39 = "TCACCGGGTGTAAATCAGCTTG"
+
+
+def reverse_complement(seq):
+    return seq.translate(str.maketrans("ACGT", "TGCA"))[::-1]
+
+
+READS = [("r1_AAAAAA", CELMIR39),
+         ("r2_AAAAAA", CELMIR39),
+         ("r3_AAAAAA", CELMIR39),
+         #one mismatch away from AAAAAA, which has at least 2n-1 reads
+         ("r4_AAAAAC", CELMIR39),
+         ("r5_CCCCCC", CELMIR39),
+         #one mismatch (last base) with the oligo, aligned at the same position
+         ("r6_GGGGGG", CELMIR39[:-1] + "C"),
+         #reverse strand: the position is the alignment end, shared by reads of oligo[0:22] and oligo[2:22]
+         ("r7_AAAAAA", reverse_complement(CELMIR39)),
+         ("r8_AAAAAA", reverse_complement(CELMIR39[2:])),
+         #same alignment start as r7 but a different end
+         ("r9_AAAAAA", reverse_complement(CELMIR39[:20])),
+         ("r10_AAAAAA", "GATTACAGATTACAGATTACA")]
+
+
+def write_fastq(path, reads):
+    with open(path, "w") as f:
+        for name, seq in reads:
+            f.write("@" + name + " 1:N:0\n" + seq + "\n+\n" + "I" * len(seq) + "\n")
+
+
+def test_reverse_strand_position_is_the_alignment_end():
+    matches = oligo_matches(SYNTHETIC_OLIGOS, 18)
+    assert matches[CELMIR39.encode()] == ("celmiR39", "+", 0)
+    assert matches[CELMIR39[3:21].encode()] == ("celmiR39", "+", 3)
+    assert matches[reverse_complement(CELMIR39).encode()] == ("celmiR39", "-", 22)
+    assert matches[reverse_complement(CELMIR39[2:]).encode()] == ("celmiR39", "-", 22)
+    assert matches[reverse_complement(CELMIR39[:20]).encode()] == ("celmiR39", "-", 20)
+
+
+def test_exact_match_precedes_one_mismatch_match():
+    #ACGATGCA is one mismatch away from the first oligo but an exact match of the second one
+    oligos = OrderedDict([("first", "ACGTTGCA"), ("second", "ACGATGCA")])
+    matches = oligo_matches(oligos, 8)
+    assert matches[b"ACGATGCA"] == ("second", "+", 0)
+    assert matches[b"ACGTTGCA"] == ("first", "+", 0)
+    assert matches[b"ACGCTGCA"] == ("first", "+", 0)
+    assert b"ACGCTGCT" not in matches
+
+
+def test_directional_groups():
+    assert directional_groups({b"AAAA": 3, b"AAAT": 1}) == 1
+    #AAAT has more than (3 + 1) / 2 reads so it is not a sequencing error of AAAA
+    assert directional_groups({b"AAAA": 3, b"AAAT": 3}) == 2
+    #edges are followed from AAAT to AATT even though AATT is two mismatches away from AAAA
+    assert directional_groups({b"AAAA": 10, b"AAAT": 4, b"AATT": 1}) == 1
+    assert directional_groups({b"AAAA": 1, b"CCCC": 1}) == 2
+
+
+def test_count_oligo_reads(tmp_path):
+    fastq = str(tmp_path / "reads.fastq")
+    write_fastq(fastq, READS)
+    read_counts, umi_counts = count_oligo_reads(fastq, oligo_matches(SYNTHETIC_OLIGOS, 18), SYNTHETIC_OLIGOS)
+    assert read_counts == OrderedDict([("celmiR39", 9), ("celmiR54", 0), ("celmiR238", 0)])
+    assert umi_counts["celmiR39"] == {("+", 0): {b"AAAAAA": 3, b"AAAAAC": 1, b"CCCCCC": 1, b"GGGGGG": 1},
+                                      ("-", 22): {b"AAAAAA": 2},
+                                      ("-", 20): {b"AAAAAA": 1}}
+    #3 UMI groups at the forward position (AAAAAA with AAAAAC, CCCCCC, GGGGGG) and one at each reverse position
+    assert sum(directional_groups(umis) for umis in umi_counts["celmiR39"].values()) == 5
@@ -0,0 +1,65 @@
+import os
+import subprocess
+import sys
+import pandas as pd
+import pytest
+from conftest import BIN_DIR
+from table_loader import load_tables
+from filter_and_derive_stats import NCBI_TARGET_COLUMNS, TARGET_STAT_COLUMNS, write_empty_cov_stats
+
+STAT_COLUMNS = [column for column in TARGET_STAT_COLUMNS if column not in ("dedup_read_count", "duplication_rate")]
+
+
+def write_populated(path):
+    row = {"Sample": "S1", "sacc": "AB000001", "Species": "Virus A", "naccs": 2, "length": 300, "slen": 900, "cov": 33.3,
+           "av-pident": 98.5, "stitle": "Virus A complete genome", "qseqids": "c1,c2", "contig_ind_lengths": "150,150",
+           "cumulative_contig_len": 300, "contig_lenth_min": 150, "contig_lenth_max": 150, "longest_contig_fasta": "ACGT",
+           "total_score": 90, "mean_read_depth": 12.5, "read_count": 1000, "RPM": 100, "FPKM": 50, "PCT_1X": 0.9,
+           "PCT_5X": 0.8, "PCT_10X": 0.7, "PCT_20X": 0.5, "consensus_fasta": "ACGTN"}
+    pd.DataFrame([row], columns=["Sample"] + NCBI_TARGET_COLUMNS + STAT_COLUMNS).to_csv(path, index=None, sep="\t")
+
+
+def test_empty_sample_header_matches_cov_stats_columns(tmp_path):
+    empty = str(tmp_path / "S0_21-22nt_top_scoring_targets_with_cov_stats.txt")
+    write_empty_cov_stats(empty, NCBI_TARGET_COLUMNS, "false")
+    populated = str(tmp_path / "S1_21-22nt_top_scoring_targets_with_cov_stats.txt")
+    write_populated(populated)
+    assert list(pd.read_csv(empty, sep="\t").columns) == list(pd.read_csv(populated, sep="\t").columns)
+
+
+def test_optional_columns_missing_from_a_sample(tmp_path):
+    #table of a sample without any target written before its header had all the metrics
+    with open(str(tmp_path / "S0_stats.txt"), "w") as out:
+        out.write("\t".join(["Sample"] + NCBI_TARGET_COLUMNS + ["mean_read_depth", "read_count", "FPKM", "PCT_1X", "PCT_10X", "PCT_20X"]) + "\n")
+    write_populated(str(tmp_path / "S1_stats.txt"))
+    table = load_tables(str(tmp_path / "*_stats.txt"), ["Sample", "Species"], {"Sample": str}, optional=["RPM", "PCT_5X", "dedup_read_count"])
+    assert len(table) == 1
+    assert table.loc[0, "PCT_5X"] == 0.8
+    assert table["dedup_read_count"].isna().all()
+
+
+def test_missing_required_column(tmp_path):
+    with open(str(tmp_path / "S0_stats.txt"), "w") as out:
+        out.write("Sample\tsacc\nS0\tAB000001\n")
+    with pytest.raises(ValueError, match="Species"):
+        load_tables(str(tmp_path / "*_stats.txt"), ["Sample", "Species"])
+
+
+@pytest.mark.parametrize("header", ["cov_stats", "truncated"])
+def test_detection_report_with_an_empty_sample(tmp_path, header):
+    empty = str(tmp_path / "S0_21-22nt_top_scoring_targets_with_cov_stats.txt")
+    if header == "cov_stats":
+        write_empty_cov_stats(empty, NCBI_TARGET_COLUMNS, "false")
+    else:
+        #header without PCT_5X written by earlier versions for the samples without blast hits
+        with open(empty, "w") as out:
+            out.write("\t".join(["Sample"] + NCBI_TARGET_COLUMNS + ["mean_read_depth", "read_count", "RPM", "FPKM", "PCT_1X", "PCT_10X", "PCT_20X", "consensus_fasta"]))
+    write_populated(str(tmp_path / "S1_21-22nt_top_scoring_targets_with_cov_stats.txt"))
+    env = dict(os.environ, PYTHONPATH=BIN_DIR)
+    subprocess.check_call([sys.executable, os.path.join(BIN_DIR, "detection_report.py"), "--read_size", "21-22nt", "--threshold", "0.01",
+                           "--dedup", "false", "--diagno", "false"], cwd=str(tmp_path), env=env, stdout=subprocess.DEVNULL)
+    reports = [name for name in os.listdir(str(tmp_path)) if name.startswith("VirReport_detection_summary_21-22nt_ncbi")]
+    assert len(reports) == 1
+    report = pd.read_csv(str(tmp_path / reports[0]), sep="\t")
+    assert list(report["Sample"]) == ["S1"]
+    assert report.loc[0, "PCT_5X"] == 0.8
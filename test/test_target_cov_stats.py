@@ -0,0 +1,30 @@
+from collections import OrderedDict
+import pandas as pd
+import filter_and_derive_stats
+from filter_and_derive_stats import duplication_rate, summary_table, target_cov_stats
+
+
+def test_duplication_rate_of_zero_read_target_is_empty():
+    assert duplication_rate(0, "0") is None
+    assert duplication_rate(40, "100") == 60
+
+
+def test_failing_target_leaves_empty_stats(tmp_path, monkeypatch):
+    #a target without any aligned read used to raise a ZeroDivisionError that aborted the whole sample
+    monkeypatch.chdir(tmp_path)
+    def split_reference_bam(combined_bam, refname, sortedbamoutput):
+        raise ZeroDivisionError("division by zero")
+    monkeypatch.setattr(filter_and_derive_stats, "split_reference_bam", split_reference_bam)
+    target_dict = OrderedDict([("AB000001.1", "Virus A"), ("AB000002.1", "Virus B")])
+    with open("S1_21-22_AB000001.1_Virus_A.fa", "w") as f:
+        f.write(">AB000001.1\nACGTACGTACGTACGTACGT\n")
+
+    stats = target_cov_stats("AB000001.1", "Virus A", "1", "false", "S1.fastq", 1000, "21-22", "S1", combined_bam="S1_combined.bam")
+    assert stats == {}
+
+    target_results = [stats, {"read_count": "10", "mean_read_depth": 5.0, "PCT_1X": 1.0, "PCT_5X": 0.5, "PCT_10X": 0.0, "PCT_20X": 0.0, "RPM": 10000, "FPKM": 500, "consensus_fasta": ">AB000002.1 ACGT"}]
+    final_data = pd.DataFrame({"Species_updated": ["Virus A", "Virus B"], "sacc": ["AB000001.1", "AB000002.1"]})
+    full_table = summary_table(final_data, target_dict, target_results, "S1", "viral_db")
+    assert list(full_table["Species"]) == ["Virus A", "Virus B"]
+    assert full_table["read_count"].isna().tolist() == [True, False]
+    assert full_table["mean_read_depth"].isna().tolist() == [True, False]